@@ -16,8 +16,10 @@ CORS(app)
 # set log level
 log.getLogger().setLevel(log.INFO)
 
-from flask_sqlalchemy import SQLAlchemy
 from tippicserver import config, ssm, stellar
+from tippicserver.sharding import RoutingSQLAlchemy, ShardRouter
+from tippicserver.replica import Replica, REPLICA_BIND
+from tippicserver.db_pool import pool_options
 
 from .utils import increment_metric
 increment_metric('server-starting')
@@ -39,6 +41,7 @@ print("kin horizon: %s" % config.STELLAR_HORIZON_URL)
 myenv = kin.Environment('CUSTOM', config.STELLAR_HORIZON_URL, config.STELLAR_NETWORK)
 app.kin_sdk = kin.KinClient(myenv)
 app.kin_account = app.kin_sdk.kin_account(base_seed, channel_seeds, "TIPC")
+app.kin_channels_count = max(1, len(channel_seeds))  # the payout engine sends on all the channels in parallel
 log.info('Kin account status: %s' % app.kin_account.get_status())
 
 # init encryption util
@@ -49,18 +52,22 @@ app.encryption = AESCipher(key, iv)
 # create an sqlalchemy engine with "autocommit" to tell sqlalchemy NOT to use un-needed transactions.
 # see this: http://oddbird.net/2014/06/14/sqlalchemy-postgres-autocommit/
 # and this: https://github.com/mitsuhiko/flask-sqlalchemy/pull/67
-class MySQLAlchemy(SQLAlchemy):
+class MySQLAlchemy(RoutingSQLAlchemy):
     def apply_driver_hacks(self, app, info, options):
         options['isolation_level'] = 'AUTOCOMMIT'
         super(MySQLAlchemy, self).apply_driver_hacks(app, info, options)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = config.DB_CONNSTR
+if config.DB_REPLICA_CONNSTR and not config.DB_SHARDS:
+    app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: config.DB_REPLICA_CONNSTR}
 
-# SQLAlchemy timeouts
-app.config['SQLALCHEMY_POOL_SIZE'] = 1000
-app.config['SQLALCHEMY_POOL_TIMEOUT'] = 5
-app.config['SQLALCHEMY_MAX_OVERFLOW'] = 100
-app.config['SQLALCHEMY_POOL_RECYCLE'] = 60*5
+# SQLAlchemy pools: sized from this process's threads and its share of the host's db connections (see db_pool)
+db_pool_options = pool_options(extra_threads=app.kin_channels_count)  # the payouts job sends on all the channels at once
+print('db pool size: %(pool_size)s, max overflow: %(max_overflow)s (per engine)' % db_pool_options)
+app.config['SQLALCHEMY_POOL_SIZE'] = db_pool_options['pool_size']
+app.config['SQLALCHEMY_POOL_TIMEOUT'] = db_pool_options['pool_timeout']
+app.config['SQLALCHEMY_MAX_OVERFLOW'] = db_pool_options['max_overflow']
+app.config['SQLALCHEMY_POOL_RECYCLE'] = db_pool_options['pool_recycle']
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
@@ -72,7 +79,24 @@ if config.DEPLOYMENT_ENV in ['prod', 'stage']:
     print('starting sqlalchemy in autocommit mode')
     db = MySQLAlchemy(app)
 else:
-    db = SQLAlchemy(app)
+    db = RoutingSQLAlchemy(app)
+
+if config.DB_SHARDS:
+    # the per-user tables are spread over the default db and the shards, by user_id
+    if not config.PICTURE_TIPS_SUM_MATERIALIZED:
+        # the tips of a picture are on all the shards - they can't be summed in the picture summary's query
+        log.error('sharding requires PICTURE_TIPS_SUM_MATERIALIZED - aborting')
+        sys.exit(-1)
+    print('sharding users over %s shards' % (len(config.DB_SHARDS) + 1))
+    shard_engine_options = dict(db_pool_options)
+    if config.DEPLOYMENT_ENV in ['prod', 'stage']:
+        shard_engine_options['isolation_level'] = 'AUTOCOMMIT'
+    db.enable_sharding(ShardRouter(db, config.DB_SHARDS, config.SHARD_VIRTUAL_NODES, shard_engine_options))
+    if config.DB_REPLICA_CONNSTR:
+        log.warning('the read replica is not used with sharding')
+elif config.DB_REPLICA_CONNSTR:
+    print('reading from the replica when its lag is under %s secs' % config.DB_REPLICA_MAX_LAG_SECS)
+    db.enable_replica(Replica(db, config.DB_REPLICA_MAX_LAG_SECS, config.DB_REPLICA_LAG_CHECK_SECS))
 
 #SQLAlchemy logging
 #import logging
@@ -94,6 +118,10 @@ app.redis.setex('temp-key', 1, 'temp-value')
 # start the rq queue connection
 app.rq_fast = Queue('tippicserver-%s-fast' % config.DEPLOYMENT_ENV, connection=redis.Redis(host=config.REDIS_ENDPOINT, port=config.REDIS_PORT, db=0), default_timeout=200)
 app.rq_slow = Queue('tippicserver-%s-slow' % config.DEPLOYMENT_ENV, connection=redis.Redis(host=config.REDIS_ENDPOINT, port=config.REDIS_PORT, db=0), default_timeout=7200)
+# reported txs are verified against horizon on a dedicated worker, so a slow horizon can't back up the other queues
+app.rq_verify = Queue('tippicserver-%s-verify' % config.DEPLOYMENT_ENV, connection=redis.Redis(host=config.REDIS_ENDPOINT, port=config.REDIS_PORT, db=0), default_timeout=600)
+# the payouts job waits for the payouts in flight to settle - on its own worker, so it doesn't hold up the fast queue
+app.rq_payouts = Queue('tippicserver-%s-payouts' % config.DEPLOYMENT_ENV, connection=redis.Redis(host=config.REDIS_ENDPOINT, port=config.REDIS_PORT, db=0), default_timeout=600)
 
 # useful prints:
 state = 'enabled' if config.PHONE_VERIFICATION_ENABLED else 'disabled'
@@ -121,9 +149,19 @@ app.blocked_phone_prefixes = literal_eval(config.BLOCKED_PHONE_PREFIXES)
 app.allowed_phone_prefixes = literal_eval(config.ALLOWED_PHONE_PREFIXES)
 app.blocked_country_codes = literal_eval(config.BLOCKED_COUNTRY_CODES)
 
-# initialize geoip instance
-from geolite2 import geolite2
-app.geoip_reader = geolite2.reader()
+# push publishers, one per push env. their channel pools connect on first use
+app.amqp_publishers = {}
+for push_env in ('beta', 'prod'):
+    app.amqp_publishers[push_env] = AmqpPublisher()
+    if config.ESHU_RABBIT_ADDRESS:
+        app.amqp_publishers[push_env].init_config(push_env, config.ESHU_RABBIT_ADDRESS, config.ESHU_QUEUE,
+                                                  config.ESHU_EXCHANGE, config.ESHU_VIRTUAL_HOST, config.ESHU_USERNAME,
+                                                  config.ESHU_PASSWORD, config.ESHU_HEARTBEAT, config.ESHU_APPID,
+                                                  config.PUSH_TTL_SECS)
+
+# initialize geoip instance. the database is opened on first use
+from tippicserver.geoip import GeoIPService
+app.geoip = GeoIPService()
 
 # print db creation statements
 if config.DEBUG:
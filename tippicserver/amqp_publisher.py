@@ -9,6 +9,9 @@ messages.
 Implementation details:
 - The pool is initialized upon the first call to publish().
 - The size of the pool is configurable via the CHANNEL_POOL_SIZE parameter.
+- Idle channels wait in a queue: get_channel() blocks until one is released, without polling.
+- Channels run in transaction mode: a batch of messages is published back-to-back and
+acknowledged by the broker with a single commit, instead of a confirm round trip per message.
 - Ideally, the pool can be torn-down with the tear_down() function.
 - If the connection is lost, the pool should re-establish one and recreate the
 channels.
@@ -16,10 +19,11 @@ channels.
 """
 
 from json import dumps
+from queue import Queue, Empty
 from threading import RLock
-from time import sleep
 from datetime import datetime
 from amqpstorm import Connection
+import logging as log
 
 
 class AmqpPublisher:
@@ -41,8 +45,10 @@ class AmqpPublisher:
                        'HEARTBEAT': '',
                        'APP_ID': '',
                        'TTL': '',
-                       'CHANNEL_POOL_SIZE': 10}
+                       'CHANNEL_POOL_SIZE': 10,
+                       'PUBLISH_BATCH_SIZE': 1000}
         self._channels_manager = None
+        self._lock = RLock()
         self._inited = False
 
     def get_config(self):
@@ -73,14 +79,15 @@ class AmqpPublisher:
 
     def send_apns_voip(self, routing_key, payload, tokens):
         """Send the given payload to the given tokens - as voip apns."""
-        self.internal_send_apns(routing_key, payload, tokens, True, self.ESHU_CONFIG['TTL'])
+        return self.internal_send_apns(routing_key, payload, tokens, True, self.ESHU_CONFIG['TTL'])
 
     def send_apns(self, routing_key, payload, tokens):
         """Send the given payload to the given tokens - as apns."""
-        self.internal_send_apns(routing_key, payload, tokens, False, self.ESHU_CONFIG['TTL'])
+        return self.internal_send_apns(routing_key, payload, tokens, False, self.ESHU_CONFIG['TTL'])
 
     def send_gcm(self, routing_key, payload, tokens, dry_run, ttl):
         """Send a gcm message to the given tokens with the given payload, ttl"""
+        messages = []
         for token in tokens:
             message = {'app_id': self.ESHU_CONFIG['APP_ID'],
                        'data': {
@@ -92,80 +99,108 @@ class AmqpPublisher:
                                    }
                             }
                         }
-            self.publish(routing_key, dumps(message))
+            messages.append(dumps(message))
+        return self.publish_many(routing_key, messages)
 
     def internal_send_apns(self, routing_key, payload, tokens, is_voip, ttl):
+        messages = []
         for token in tokens:
-            message = dumps({'app_id': self.ESHU_CONFIG['APP_ID'],
+            messages.append(dumps({'app_id': self.ESHU_CONFIG['APP_ID'],
                 'data': {
                     'ttl': ttl,
                     'apns': {
                         'device_token': token,
                         'voip': is_voip,
                         'data': payload
-                    }}})
-            self.publish(routing_key, message)
+                    }}}))
+        return self.publish_many(routing_key, messages)
+
+    def get_channels_manager(self):
+        """Return the channels manager, creating it (and the pool) on first use."""
+        if self._channels_manager is None:
+            with self._lock:
+                if self._channels_manager is None:
+                    self._channels_manager = ChannelsManager(self.ESHU_CONFIG)
+        return self._channels_manager
 
     def publish(self, routing_key, payload, retry=True):
         """Publish the given payload."""
-        if not self.inited:
-            log.error('cant publish payload: lib not yet inited')
-            return
-
-        if self._channels_manager is None:
-            self._channels_manager = ChannelsManager(self.ESHU_CONFIG)
+        return self.publish_many(routing_key, [payload], retry) == 1
 
-        channel = self._channels_manager.get_channel()
+    def publish_many(self, routing_key, payloads, retry=True):
+        """Publish the given payloads over a single channel.
 
+        Payloads are committed in batches of PUBLISH_BATCH_SIZE - one broker round trip per batch.
+        A batch that fails is re-sent once over a new connection. Returns the number of published payloads.
+        """
+        if not self.inited:
+            log.error('cant publish payload: lib not yet inited')
+            return 0
+
+        batch_size = self.ESHU_CONFIG['PUBLISH_BATCH_SIZE']
+        published = 0
+        for i in range(0, len(payloads), batch_size):
+            batch = payloads[i:i + batch_size]
+            if not self._publish_batch(routing_key, batch, retry):
+                print('amqp_publisher: dropped %s messages' % (len(payloads) - published))
+                break
+            published += len(batch)
+        return published
+
+    def _publish_batch(self, routing_key, batch, retry):
+        channels_manager = self.get_channels_manager()
+        channel = channels_manager.get_channel()
         try:
-            # Publish a message to the queue.
-            channel.publish(payload, routing_key)
+            # Publish the messages to the queue.
+            channel.publish_many(batch, routing_key)
         except Exception as e:
-            print('amqp_publisher: failed to publish message to amqp. exception: %s' % e)
-            self._channels_manager.release_channel(channel)
+            print('amqp_publisher: failed to publish %s messages to amqp. exception: %s' % (len(batch), e))
+            channels_manager.release_channel(channel)
             print('amqp_publisher: attempting to re-establish connection...')
-            self._channels_manager.establish_connection()
+            channels_manager.establish_connection(channel.generation)
             if retry:
-                print('amqp_publisher: attempting to re-send message...')
-                self.publish(routing_key, payload, retry=False)
+                print('amqp_publisher: attempting to re-send messages...')
+                return self._publish_batch(routing_key, batch, retry=False)
+            return False
         else:
-            self._channels_manager.release_channel(channel)
+            channels_manager.release_channel(channel)
+            return True
 
 
 class Channel:
     """Channel object."""
 
-    _busy = False
     _index = -1
+    _generation = 0
     _exchange_name = None
     _channel = None
     _config = None
     _app_id = None
 
-    def __init__(self, connection, index, exchange_name, app_id):
+    def __init__(self, connection, index, exchange_name, app_id, generation=0):
         """Ctor for this channel."""
         self._index = index
+        self._generation = generation
         self._exchange_name = exchange_name
-        self._busy = False
         self._app_id = app_id
         self._channel = connection.channel()
         #self._channel.queue.declare(ESHU_CONFIG['QUEUE_NAME'], durable=True)
-        self._channel.confirm_deliveries()
-
-    def acquire(self):
-        """Acquire this channel."""
-        self._busy = True
-
-    def release(self):
-        """Release this channel."""
-        self._busy = False
+        # amqpstorm waits for the confirm of every message published on a confirming channel, so the
+        # channel is put in transaction mode instead: publishes are written without waiting, and the
+        # commit returns once the broker has taken all of them.
+        self._channel.tx.select()
 
-    def is_busy(self):
-        """Return True if the channel is taken."""
-        return self._busy
+    @property
+    def generation(self):
+        """The connection generation this channel was created on."""
+        return self._generation
 
     def publish(self, payload, routing_key):
         """Publish the given payload via this channel."""
+        self.publish_many([payload], routing_key)
+
+    def publish_many(self, payloads, routing_key):
+        """Publish the given payloads via this channel and commit them at once."""
 
         # If connection is blocked, wait before trying to publish again.
         #while self._channel.is_blocked:
@@ -175,18 +210,31 @@ class Channel:
         # Set a bunch of message-level properties
         props = {'app_id': self._app_id, 'content_encoding': 'UTF-8', 'content_type': 'text/plain', 'timestamp': datetime.utcnow()}
 
-        self._channel.basic.publish(body=payload, routing_key=routing_key, exchange=self._exchange_name, properties=props)
+        try:
+            for payload in payloads:
+                self._channel.basic.publish(body=payload, routing_key=routing_key, exchange=self._exchange_name, properties=props)
+            self._channel.tx.commit()
+        except Exception:
+            try:
+                self._channel.tx.rollback()
+            except Exception:
+                pass  # the channel is dead anyway
+            raise
 
     def close(self):
         """Close the channel."""
-        self._channel.close()
+        try:
+            self._channel.close()
+        except Exception as e:
+            print('amqp_publisher: failed to close channel %s. exception: %s' % (self._index, e))
 
 
 class ChannelsManager:
     """Manages AMQP channels over a single connection."""
 
-    IDLE = 0.01
     _channels = []
+    _idle = None
+    _generation = 0
     _connection = None
     _lock = RLock()
     _config = None
@@ -195,6 +243,8 @@ class ChannelsManager:
         """Init the connection and channels."""
         self._config = config
         self._channels = []
+        self._idle = Queue()
+        self._generation = 0
         self._connection = None
         self._lock = RLock()
 
@@ -205,55 +255,67 @@ class ChannelsManager:
 
         Does nothing if the connection is already up.
         """
-        if self._connection and self._connection.is_open:
-            return
-        elif self._connection and self._connection.is_opening:
-            while self._connection.is_opening:
-                sleep(ChannelsManager.IDLE)
-            return
-        else:
+        with self._lock:
+            if self._connection and (self._connection.is_open or self._connection.is_opening):
+                return
             # create/recreate the connection and overwrite the channels
             self.establish_connection()
 
-    def establish_connection(self):
-        self._connection = Connection(self._config['ADDRESS'],
-                                      self._config['USER'],
-                                      self._config['PASSWORD'],
-                                      virtual_host=self._config['VIRTUAL_HOST'],
-                                      heartbeat=self._config['HEARTBEAT'])
-        # clear previous channels if they exist
-        for channel in self._channels:
-            channel.close()
-        # create new channels
-        self._channels = []
-        for i in range(self._config['CHANNEL_POOL_SIZE']):
-            print('creating an amqpl channel...')
-            self._channels.append(Channel(self._connection, i, self._config['EXCHANGE_NAME'], self._config['APP_ID']))
-
-    def get_channel(self):
-        """Acquire a channel from the pool. Blocks if none are available."""
-        while True:
-            with self._lock:
-
-                self.init_pool()  # does nothing if the pool exists. recreates it on error
+    def establish_connection(self, failed_generation=None):
+        """(Re)create the connection and the channels.
 
-                for channel in self._channels:
-                    if not channel.is_busy():
-                        channel.acquire()
-                        return channel
-            sleep(ChannelsManager.IDLE)
+        When failed_generation is given, does nothing if the pool was already recreated since then -
+        so concurrent failures over the same dead connection reconnect once.
+        """
+        with self._lock:
+            if failed_generation is not None and failed_generation != self._generation:
+                return
+            self._generation += 1
+
+            # clear previous channels if they exist. channels that are still in use are dropped when released
+            for channel in self._channels:
+                channel.close()
+            self._channels = []
+            while True:
+                try:
+                    self._idle.get_nowait()
+                except Empty:
+                    break
+            if self._connection:
+                try:
+                    self._connection.close()
+                except Exception as e:
+                    print('amqp_publisher: failed to close the connection. exception: %s' % e)
+
+            self._connection = Connection(self._config['ADDRESS'],
+                                          self._config['USER'],
+                                          self._config['PASSWORD'],
+                                          virtual_host=self._config['VIRTUAL_HOST'],
+                                          heartbeat=self._config['HEARTBEAT'])
+            # create new channels
+            for i in range(self._config['CHANNEL_POOL_SIZE']):
+                print('creating an amqpl channel...')
+                channel = Channel(self._connection, i, self._config['EXCHANGE_NAME'], self._config['APP_ID'], self._generation)
+                self._channels.append(channel)
+                self._idle.put(channel)
+
+    def get_channel(self, timeout=None):
+        """Acquire a channel from the pool. Blocks until one is available (raises queue.Empty on timeout)."""
+        self.init_pool()  # does nothing if the pool exists. recreates it on error
+        return self._idle.get(timeout=timeout)
 
     def release_channel(self, channel):
-        """Release the given channel back to the pool."""
+        """Release the given channel back to the pool. Channels of a previous connection are dropped."""
         with self._lock:
-            for c in self._channels:
-                if c == channel:
-                    channel.release()
-                    return True
-            return False
+            if channel.generation != self._generation:
+                return False
+            self._idle.put(channel)
+            return True
 
     def tear_down(self):
         """Close all channels in the pool and the connection."""
-        for channel in self._channels:
-            channel.close()
-        self._connection.close()
\ No newline at end of file
+        with self._lock:
+            for channel in self._channels:
+                channel.close()
+            self._channels = []
+            self._connection.close()
@@ -0,0 +1,61 @@
+"""a long-running process that applies the queued app launches to user_app_data, in batches.
+
+launches that arrive while a batch is written are coalesced into the next one, so the write volume stays
+flat as the launch rate grows. a launch is lost if the process dies between popping and writing it - the
+user's next launch writes the same data again.
+
+usage: python3 -m tippicserver.app_launch_writer
+"""
+import logging as log
+import time
+
+from tippicserver import app, db
+from tippicserver.models import APP_LAUNCHES_QUEUE_KEY, pop_app_launches, apply_app_launches
+from tippicserver.utils import increment_metric, gauge_metric
+
+APP_LAUNCH_WRITER_BATCH_SIZE = 1000
+APP_LAUNCH_WRITER_FLUSH_SECS = 1  # the longest a launch waits to be written, when the queue is short
+APP_LAUNCH_WRITER_MAX_BACKOFF_SECS = 30
+
+
+def write_app_launches():
+    """writes everything that's queued. returns the number of launches popped"""
+    popped = 0
+    while True:
+        launches = pop_app_launches(APP_LAUNCH_WRITER_BATCH_SIZE)
+        if not launches:
+            return popped
+        popped += len(launches)
+        try:
+            apply_app_launches(launches)
+        except Exception as e:
+            increment_metric('app-launch-writer-error')
+            log.error('app launch writer: dropping %s launches. e: %s' % (len(launches), e))
+        if len(launches) < APP_LAUNCH_WRITER_BATCH_SIZE:
+            return popped
+
+
+def run_writer():
+    """writes forever, once every APP_LAUNCH_WRITER_FLUSH_SECS (or right away while the queue is long)"""
+    backoff = 1
+    while True:
+        started = time.time()
+        try:
+            gauge_metric('app-launches-queued', app.redis.llen(APP_LAUNCHES_QUEUE_KEY))
+            popped = write_app_launches()
+            backoff = 1
+        except Exception as e:
+            increment_metric('app-launch-writer-error')
+            log.error('app launch writer: failed. e: %s' % e)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, APP_LAUNCH_WRITER_MAX_BACKOFF_SECS)
+            continue
+        finally:
+            db.session.remove()
+
+        if popped < APP_LAUNCH_WRITER_BATCH_SIZE:
+            time.sleep(max(0, APP_LAUNCH_WRITER_FLUSH_SECS - (time.time() - started)))
+
+
+if __name__ == '__main__':
+    run_writer()
@@ -3,18 +3,50 @@
 DEPLOYMENT_ENV = 'test'
 DEBUG = True
 DB_CONNSTR = "postgresql://localhost/tippic_localhost"
+DB_SHARDS = {}  # shard name -> connstr. the users are sharded over DB_CONNSTR and these when set
+SHARD_VIRTUAL_NODES = 100  # points per shard on the hash ring
+DB_REPLICA_CONNSTR = ''  # the read-only helpers read from this replica in GET requests when set
+DB_REPLICA_MAX_LAG_SECS = 5  # reads go to the primary while the replica lags more than this
+DB_REPLICA_LAG_CHECK_SECS = 1
+DB_CONNECTIONS_PER_HOST = 80  # split evenly between the processes on a host
+DB_PROCESSES_PER_HOST = 9  # 3 uwsgi workers, 4 rq workers (fast, slow, verify, payouts), the app launch writer and the ledger ingester
+DB_POOL_BACKGROUND_THREADS = 2  # threads besides the request threads that may hold a connection
+DB_POOL_TIMEOUT_SECS = 5
+DB_POOL_RECYCLE_SECS = 300
+DB_PGBOUNCER = False  # the connstrs point at pgbouncer in transaction pooling mode
+DB_CONNECTION_LEAK_SECS = 30  # connections held longer are logged with the stack that checked them out. 0 disables
 REDIS_ENDPOINT = 'localhost'
 REDIS_PORT = 6379
 
-STELLAR_TIMEOUT_SEC = 10  # waitloop for tx data to be available
+STELLAR_TIMEOUT_SEC = 10  # max secs a /user/transaction/report?wait= request waits for the tx to be verified
+TX_VERIFICATION_MAX_AGE_SECS = 120  # reported txs that don't show up on horizon by then are rejected
+TX_VERIFICATION_BATCH_SIZE = 100
+TX_VERIFICATION_HORIZON_CONCURRENCY = 10
+LEDGER_INGESTER_ENABLED = False  # payments are streamed into ledger_payment - skip horizon for recent reports
+LEDGER_INGESTER_GRACE_SECS = 15  # how far behind the ingester may be before falling back to horizon
+TX_VERIFICATION_INLINE = True  # verify the reported txs in the request, with no retries, instead of on the verify queue (tests)
+PAYOUTS_INLINE = True  # send the queued payouts in the calling process instead of on the payouts queue (tests)
+ONBOARDING_INLINE = True  # run the onboarding job in the request instead of on the fast queue (tests)
+APP_LAUNCH_UPDATES_INLINE = True  # write app launches in the request instead of through the app launch writer (tests)
 STELLAR_INITIAL_ACCOUNT_BALANCE = 0
 PUSH_TTL_SECS = 60 * 60 * 24
 
+ESHU_RABBIT_ADDRESS = ''  # no push publishing when empty
+ESHU_QUEUE = 'eshu-queue'
+ESHU_EXCHANGE = 'eshu-exchange'
+ESHU_VIRTUAL_HOST = 'kinapp'
+ESHU_USERNAME = ''
+ESHU_PASSWORD = ''
+ESHU_HEARTBEAT = 30
+ESHU_APPID = 'tippic'
+
 STELLAR_HORIZON_URL = 'https://horizon-testnet.kin.org'
 STELLAR_NETWORK ='Kin Testnet ; December 2018'
 STELLAR_KIN_ISSUER_ADDRESS = 'GBC3SG6NGTSZ2OMH3FFGB7UVRQWILW367U4GSOOF4TFSZONV42UJXUH7'
 
 KMS_KEY_AWS_REGION = 'us-east-1'
+SSM_CACHE_TTL_SECS = 300  # ssm values are kept in memory this long, and refreshed in the background
+PHONE_NUMBER_INDEX_ONLY = False  # match phone numbers by their blind index alone. set once the indexes are backfilled
 
 PHONE_VERIFICATION_REQUIRED = False
 PHONE_VERIFICATION_ENABLED = True
@@ -23,6 +55,8 @@ P2P_TRANSFERS_ENABLED = True # leave this on for tests
 P2P_MIN_KIN_AMOUNT = 300
 P2P_MAX_KIN_AMOUNT = 12500
 
+PICTURE_TIPS_SUM_MATERIALIZED = False  # read the picture summary tips from picture.tips_sum. set after migration 0009
+
 DISCOVERY_APPS_ANDROID_URL = 'https://discover.kin.org/android_stage.json'
 DISCOVERY_APPS_OSX_URL = 'https://cdn.kinitapp.com/discovery_apps_osx_stage.json'
 
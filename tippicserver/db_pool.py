@@ -0,0 +1,165 @@
+"""sizing and instrumenting the db connection pools.
+
+every process on a host gets an even share of the host's connection budget (DB_CONNECTIONS_PER_HOST over
+DB_PROCESSES_PER_HOST), split evenly between the engines it opens (the default db, and the replica or the shards).
+each engine's pool keeps a connection for each thread that may hold one - the uwsgi request threads, the payout
+channel threads and DB_POOL_BACKGROUND_THREADS - and may overflow up to its share, but never beyond it.
+
+the pools report how long checkouts waited for a connection (db-pool-wait-ms) and how long they held it
+(db-pool-checkout-ms). connections held longer than DB_CONNECTION_LEAK_SECS are logged once, with the stack that
+checked them out, and counted in db-pool-leak.
+
+with DB_PGBOUNCER, the connstrs point at pgbouncer in transaction pooling mode: consecutive transactions of a
+connection may run on different server connections, so nothing may rely on server-side state. psycopg2 never
+prepares statements on the server, and the server-side (named) cursors are turned off - see server_side_cursors().
+"""
+import logging as log
+import os
+import threading
+import time
+import traceback
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+from tippicserver import config
+from tippicserver.utils import histogram_metric, increment_metric
+
+LEAK_CHECK_INTERVAL_SECS = 5
+LEAK_STACK_DEPTH = 40
+
+
+def worker_threads():
+    """the number of request threads in this process: uwsgi's --threads, or 1 (workers, scripts)"""
+    try:
+        import uwsgi
+    except ImportError:
+        return 1
+    return max(1, int(uwsgi.opt.get('threads', 1)))
+
+
+def pool_sizes(threads, background_threads, connections_budget, processes, engines=1):
+    """returns (pool_size, max_overflow) of each of the process's engines: a connection per thread, all within the
+    engine's part of the process's share of the budget
+    """
+    share = max(1, connections_budget // max(1, processes) // max(1, engines))
+    pool_size = min(threads + background_threads, share)
+    return pool_size, share - pool_size
+
+
+def db_engines():
+    """the number of engines this process opens: the default db, and either the shards or the replica"""
+    if config.DB_SHARDS:
+        return 1 + len(config.DB_SHARDS)
+    return 2 if config.DB_REPLICA_CONNSTR else 1
+
+
+def pool_options(extra_threads=0):
+    """the options of every engine this process creates. extra_threads are the app's own threads that use the db"""
+    pool_size, max_overflow = pool_sizes(worker_threads(), config.DB_POOL_BACKGROUND_THREADS + extra_threads,
+                                         config.DB_CONNECTIONS_PER_HOST, config.DB_PROCESSES_PER_HOST, db_engines())
+    return {'poolclass': InstrumentedQueuePool, 'pool_size': pool_size, 'max_overflow': max_overflow,
+            'pool_timeout': config.DB_POOL_TIMEOUT_SECS, 'pool_recycle': config.DB_POOL_RECYCLE_SECS}
+
+
+def server_side_cursors():
+    """whether server-side cursors may be used. they live on a server connection, which pgbouncer reassigns"""
+    return not config.DB_PGBOUNCER
+
+
+class CheckoutTracker(object):
+    """tracks the checked out connections of this process, and reports the ones held too long"""
+
+    def __init__(self):
+        self._checkouts = {}  # connection record -> [checked out at, stack, reported]
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def checked_out(self, record):
+        stack = traceback.extract_stack(limit=LEAK_STACK_DEPTH) if config.DB_CONNECTION_LEAK_SECS else None
+        self._checkouts[record] = [time.time(), stack, False]
+        self._ensure_monitor()
+
+    def checked_in(self, record):
+        """returns how long the given connection was checked out, in seconds (or None if it wasn't tracked)"""
+        checkout = self._checkouts.pop(record, None)
+        return time.time() - checkout[0] if checkout else None
+
+    def leaked(self, now=None):
+        """returns the (secs held, stack) of the connections held longer than DB_CONNECTION_LEAK_SECS"""
+        if not config.DB_CONNECTION_LEAK_SECS:
+            return []
+        now = now or time.time()
+        return [(now - checked_out_at, stack) for checked_out_at, stack, _ in list(self._checkouts.values())
+                if now - checked_out_at > config.DB_CONNECTION_LEAK_SECS]
+
+    def report_leaks(self, now=None):
+        """logs the leaked connections that weren't reported yet. returns their number"""
+        if not config.DB_CONNECTION_LEAK_SECS:
+            return 0
+        now = now or time.time()
+        reported = 0
+        for checkout in list(self._checkouts.values()):
+            checked_out_at, stack, was_reported = checkout
+            if was_reported or now - checked_out_at <= config.DB_CONNECTION_LEAK_SECS:
+                continue
+            checkout[2] = True
+            reported += 1
+            log.error('db connection held for %.1f secs. checked out at:\n%s'
+                      % (now - checked_out_at, ''.join(traceback.format_list(stack or []))))
+        if reported:
+            increment_metric('db-pool-leak', reported)
+        return reported
+
+    def _ensure_monitor(self):
+        # the monitor thread doesn't survive the fork of the uwsgi workers - start one per process
+        if not config.DB_CONNECTION_LEAK_SECS or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._monitor, name='db-leak-monitor', daemon=True).start()
+
+    def _monitor(self):
+        while True:
+            time.sleep(min(LEAK_CHECK_INTERVAL_SECS, config.DB_CONNECTION_LEAK_SECS))
+            try:
+                self.report_leaks()
+            except Exception as e:
+                log.error('db leak monitor: cant check the checkouts. e: %s' % e)
+
+
+checkout_tracker = CheckoutTracker()
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    checkout_tracker.checked_out(connection_record)
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    if connection_record is None:
+        return  # detached
+    held_secs = checkout_tracker.checked_in(connection_record)
+    if held_secs is not None:
+        histogram_metric('db-pool-checkout-ms', held_secs * 1000)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """a QueuePool that reports its wait and checkout times, and tracks its checkouts for leaks"""
+
+    def __init__(self, creator, **kw):
+        listeners_copied = '_dispatch' in kw  # a recreated pool (after dispose) inherits the old one's listeners
+        super(InstrumentedQueuePool, self).__init__(creator, **kw)
+        if not listeners_copied:
+            event.listen(self, 'checkout', _on_checkout)
+            event.listen(self, 'checkin', _on_checkin)
+
+    def _do_get(self):
+        started_at = time.time()
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        finally:
+            histogram_metric('db-pool-wait-ms', (time.time() - started_at) * 1000)
+
+    def capacity(self):
+        return self.size() + self._max_overflow
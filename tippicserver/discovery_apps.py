@@ -0,0 +1,155 @@
+"""a cache for the discovery-apps json served by the CDN.
+
+the json used to be fetched on every /user/transactions call. it is now kept per worker and in redis,
+revalidated with ETag/Last-Modified, and served stale while a background thread refreshes it - so a slow
+CDN never blocks the request path (unless the cached copy is too old to be trusted).
+"""
+import json
+import logging as log
+import threading
+import time
+
+import requests
+
+from tippicserver import app
+from tippicserver.utils import increment_metric
+
+DISCOVERY_APPS_FRESH_SECS = 5 * 60  # serve without revalidating
+DISCOVERY_APPS_MAX_STALE_SECS = 24 * 60 * 60  # serve stale (while refreshing in the background) up to this age
+DISCOVERY_APPS_FETCH_TIMEOUT_SECS = 3
+DISCOVERY_APPS_REDIS_TTL_SECS = 2 * DISCOVERY_APPS_MAX_STALE_SECS
+
+_entries = {}  # link -> DiscoveryApps
+_refreshing = set()  # links currently being refreshed by a background thread
+_lock = threading.Lock()
+
+
+class DiscoveryApps(object):
+    """a fetched discovery-apps list, with a memo -> app index"""
+
+    def __init__(self, apps, etag=None, last_modified=None, fetched_at=None):
+        self.apps = apps
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+        self.index = {item['memo']: item for item in apps if item.get('memo')}
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def find(self, tx_for_item_id):
+        """returns the app whose memo appears in the given tx_for_item_id, or None"""
+        if not tx_for_item_id:
+            return None
+        app_data = self.index.get(tx_for_item_id)
+        if app_data:
+            return app_data
+        # memos are usually one of the dash-separated parts of the item id
+        for part in tx_for_item_id.split('-'):
+            app_data = self.index.get(part)
+            if app_data:
+                return app_data
+        # fallback: the original substring match
+        return next((item for item in self.apps if item.get('memo') and item['memo'] in tx_for_item_id), None)
+
+    def to_json(self):
+        return json.dumps({'apps': self.apps, 'etag': self.etag, 'last_modified': self.last_modified,
+                           'fetched_at': self.fetched_at})
+
+    @classmethod
+    def from_json(cls, data):
+        d = json.loads(data)
+        return cls(d['apps'], d.get('etag'), d.get('last_modified'), d.get('fetched_at'))
+
+
+def _redis_key(link):
+    return 'discovery-apps:%s' % link
+
+
+def _read_from_redis(link):
+    try:
+        data = app.redis.get(_redis_key(link))
+        return DiscoveryApps.from_json(data.decode()) if data else None
+    except Exception as e:
+        log.error('cant read discovery apps for %s from redis. e: %s' % (link, e))
+        return None
+
+
+def _write_to_redis(link, entry):
+    try:
+        app.redis.setex(_redis_key(link), DISCOVERY_APPS_REDIS_TTL_SECS, entry.to_json())
+    except Exception as e:
+        log.error('cant write discovery apps for %s to redis. e: %s' % (link, e))
+
+
+def fetch_discovery_apps(link, current=None):
+    """fetches the discovery apps from the given link, revalidating the current entry if given.
+
+    returns the new (or revalidated) entry, or None on failure.
+    """
+    headers = {}
+    if current is not None:
+        if current.etag:
+            headers['If-None-Match'] = current.etag
+        if current.last_modified:
+            headers['If-Modified-Since'] = current.last_modified
+    try:
+        res = requests.get(link, headers=headers, timeout=DISCOVERY_APPS_FETCH_TIMEOUT_SECS)
+        if res.status_code == 304 and current is not None:
+            return DiscoveryApps(current.apps, current.etag, current.last_modified)
+        res.raise_for_status()
+        return DiscoveryApps(res.json()['apps'], res.headers.get('ETag'), res.headers.get('Last-Modified'))
+    except Exception as e:
+        increment_metric('discovery-apps-fetch-error')
+        log.error('cant fetch discovery apps from %s. e: %s' % (link, e))
+        return None
+
+
+def refresh_discovery_apps(link):
+    """brings the worker's entry up to date - from redis if another worker already did the work, else from the CDN"""
+    current = _entries.get(link)
+    shared = _read_from_redis(link)
+    if shared is not None and (current is None or shared.fetched_at > current.fetched_at):
+        current = _entries[link] = shared
+        if current.age() < DISCOVERY_APPS_FRESH_SECS:
+            return current
+
+    fetched = fetch_discovery_apps(link, current)
+    if fetched is None:
+        return current  # keep serving whatever we have
+    _entries[link] = fetched
+    _write_to_redis(link, fetched)
+    return fetched
+
+
+def _background_refresh(link):
+    try:
+        refresh_discovery_apps(link)
+    finally:
+        with _lock:
+            _refreshing.discard(link)
+
+
+def get_discovery_apps(link):
+    """returns the DiscoveryApps for the given link, or None if they can't be fetched at all"""
+    entry = _entries.get(link)
+    if entry is not None and entry.age() < DISCOVERY_APPS_FRESH_SECS:
+        return entry
+
+    if entry is None or entry.age() > DISCOVERY_APPS_MAX_STALE_SECS:
+        # nothing usable in memory - must block on redis/the CDN
+        return refresh_discovery_apps(link)
+
+    # stale-while-revalidate: serve what we have, refresh in the background (once per link)
+    with _lock:
+        start_refresh = link not in _refreshing
+        if start_refresh:
+            _refreshing.add(link)
+    if start_refresh:
+        threading.Thread(target=_background_refresh, args=(link,), daemon=True).start()
+    return entry
+
+
+def clear_discovery_apps_cache():
+    """drops the worker's entries. the redis copies are left intact"""
+    _entries.clear()
@@ -1,36 +1,65 @@
 '''AWS encrypt and decrypt utilities'''
 import base64
+import binascii
 import hashlib
+import hmac
 from Crypto import Random
 from Crypto.Cipher import AES
 
+BLIND_INDEX_SIZE = 32  # bytes of a blind index (hmac-sha256)
+
+
+def _xor_block(block, prev):
+    return (int.from_bytes(block, 'big') ^ int.from_bytes(prev, 'big')).to_bytes(AES.block_size, 'big')
+
 
 class AESCipher(object):
+    """deterministic (fixed iv) AES-CBC, so the ciphertexts can be compared.
+
+    the block cipher is keyed once: an ECB context does the block encryption and the CBC chaining is done here,
+    which is byte-for-byte the same as a new CBC cipher per call. blind_index() returns a keyed hash of a value,
+    which is what lookups should compare - it's a fraction of the size of the (hex of the base64 of) ciphertext.
+    """
 
     def __init__(self, key, iv):
         # hash the key to get it in the right size
         self.key = hashlib.sha256(key.encode()).digest()
         self.iv = iv
+        self._ecb = AES.new(self.key, AES.MODE_ECB)
+        # a separate key for the blind index, so a leaked index reveals nothing about the encryption key
+        self._index_key = hmac.new(self.key, b'blind-index', hashlib.sha256).digest()
 
     def encrypt(self, raw):
-        raw = self._pad(raw)
-        #iv = Random.new().read(AES.block_size)
-        cipher = AES.new(self.key, AES.MODE_CBC, self.iv)
-        return base64.b64encode(self.iv + cipher.encrypt(raw)).hex()
+        data = self._pad(raw.encode() if isinstance(raw, str) else bytes(raw))
+        out = bytearray(self.iv)
+        prev = self.iv
+        for i in range(0, len(data), AES.block_size):
+            prev = self._ecb.encrypt(_xor_block(data[i:i + AES.block_size], prev))
+            out += prev
+        return base64.b64encode(out).hex()
 
     def decrypt(self, enc):
-        enc = bytes.fromhex(enc)
-        enc = base64.b64decode(enc)
-        iv = enc[:AES.block_size]
-        cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        return self._unpad(cipher.decrypt(enc[AES.block_size:])).decode('utf-8')
+        enc = memoryview(base64.b64decode(binascii.unhexlify(enc)))
+        out = bytearray()
+        prev = enc[:AES.block_size]
+        for i in range(AES.block_size, len(enc), AES.block_size):
+            block = enc[i:i + AES.block_size]
+            out += _xor_block(self._ecb.decrypt(block.tobytes()), prev)
+            prev = block
+        return self._unpad(bytes(out)).decode('utf-8')
+
+    def blind_index(self, raw):
+        """returns a fixed-size keyed hash of the given value, for equality lookups"""
+        return hmac.new(self._index_key, raw.encode() if isinstance(raw, str) else raw, hashlib.sha256).digest()
 
-    def _pad(self, s):
-        return s + (AES.block_size - len(s) % AES.block_size) * chr(AES.block_size - len(s) % AES.block_size)
+    @staticmethod
+    def _pad(b):
+        padding = AES.block_size - len(b) % AES.block_size
+        return b + bytes((padding,)) * padding
 
     @staticmethod
-    def _unpad(s):
-        return s[:-ord(s[len(s)-1:])]
+    def _unpad(b):
+        return b[:-b[-1]]
 
 if __name__ == "__main__":
     o = AESCipher('theforceisstrong', bytes.fromhex('0cc60592a486dabf7aeda283d5e3391f'))
@@ -0,0 +1,100 @@
+"""ip address -> country iso code, from the packaged geolite2 database.
+
+the database is opened on first use (after the workers fork) and mmapped, so all the processes on a host share
+its pages. lookups are cached per network - the network the database holds the ip's record under, as returned by
+get_with_prefix_len - so every ip of a cached network is answered from the cache, and never from a neighbouring
+network's record.
+"""
+import collections
+import ipaddress
+import logging as log
+import threading
+
+GEOIP_CACHE_SIZE = 100000
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class GeoIPService(object):
+    """a lazily-opened geolite2 reader with an lru cache of the looked up networks"""
+
+    def __init__(self, filename=None, cache_size=GEOIP_CACHE_SIZE):
+        self.filename = filename
+        self.cache_size = cache_size
+        self._reader = None
+        self._lock = threading.Lock()
+        self._networks = collections.OrderedDict()  # (version, prefix_len, network bits) -> iso code, lru first
+        self._prefix_lens = {4: set(), 6: set()}  # the prefix lens of the cached networks
+        self._cache_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            with self._lock:
+                if self._reader is None:
+                    import maxminddb
+                    filename = self.filename
+                    if filename is None:
+                        from geolite2 import geolite2
+                        filename = geolite2.filename
+                    # MODE_AUTO maps the file (with the c extension, if installed) - it is never read into memory
+                    self._reader = maxminddb.open_database(filename, maxminddb.MODE_AUTO)
+                    log.info('opened the geoip database at %s' % filename)
+        return self._reader
+
+    @staticmethod
+    def network_key(address, prefix_len):
+        """the cache key of the network of the given prefix len the given address is in"""
+        return address.version, prefix_len, int(address) >> (address.max_prefixlen - prefix_len)
+
+    def _cached(self, address):
+        """returns (True, iso code) if the address is in a cached network, (False, None) otherwise"""
+        with self._cache_lock:
+            # the database's networks don't overlap - at most one matches
+            for prefix_len in self._prefix_lens[address.version]:
+                key = self.network_key(address, prefix_len)
+                if key in self._networks:
+                    self._networks.move_to_end(key)
+                    self._hits += 1
+                    return True, self._networks[key]
+            self._misses += 1
+            return False, None
+
+    def _cache(self, address, prefix_len, country):
+        with self._cache_lock:
+            self._networks[self.network_key(address, prefix_len)] = country
+            self._prefix_lens[address.version].add(prefix_len)
+            while len(self._networks) > self.cache_size:
+                self._networks.popitem(last=False)
+
+    def _lookup_uncached(self, address):
+        record, prefix_len = self.reader.get_with_prefix_len(address)
+        try:
+            country = record['country']['iso_code']
+        except (KeyError, TypeError):
+            country = None
+        self._cache(address, prefix_len, country)
+        return country
+
+    def lookup(self, ip_addr):
+        """returns the country iso code of the given ip, or None"""
+        try:
+            address = ipaddress.ip_address(ip_addr.strip())
+        except (ValueError, AttributeError):
+            return None
+        try:
+            found, country = self._cached(address)
+            return country if found else self._lookup_uncached(address)
+        except Exception as e:
+            log.error('cant convert ip %s to country code. e: %s' % (ip_addr, e))
+            return None
+
+    def lookup_many(self, ip_addrs):
+        """returns a dict of ip -> country iso code (or None) for the given ips. each network is looked up once"""
+        return {ip_addr: self.lookup(ip_addr) for ip_addr in set(ip_addrs)}
+
+    def cache_info(self):
+        with self._cache_lock:
+            return CacheInfo(self._hits, self._misses, self.cache_size, len(self._networks))
@@ -11,11 +11,11 @@ tippic_prod_tg_arn='arn:aws:elasticloadbalancing:us-east-1:935522987944:targetgr
 MIN_CHECKEDOUT_CONN = 50
 DEREGISTER_TIMEOUT_SECS = 60
 
-def get_checkout_connections():
+def get_db_stats():
     try:
         response = requests.get('http://localhost:80/internal/stats/db')
         response.raise_for_status()
-        return json.loads(response.text)['stats']['checkedout']
+        return json.loads(response.text)['stats']
     except Exception as e:
         print(e)
         return None
@@ -119,9 +119,14 @@ def get_instance_id():
     return requests.get('http://169.254.169.254/latest/meta-data/instance-id').text
 
 
-conn_count = get_checkout_connections()
-if conn_count < MIN_CHECKEDOUT_CONN:
-    print('current conn count: %s. no need to reboot. aborting' % conn_count)
+db_stats = get_db_stats()
+if db_stats is None:
+    print('cant get the db stats. aborting')
+    sys.exit(1)
+# the pools are sized per process now - an exhausted pool may be much smaller than MIN_CHECKEDOUT_CONN
+conn_count = db_stats['checkedout']
+if conn_count < min(MIN_CHECKEDOUT_CONN, db_stats.get('capacity', MIN_CHECKEDOUT_CONN)):
+    print('current conn count: %s (of %s). no need to reboot. aborting' % (conn_count, db_stats.get('capacity')))
     sys.exit(1)
 
 instances = get_target_group_instances(tippic_prod_tg_arn)
@@ -0,0 +1,112 @@
+"""a long-running process that streams payments from horizon into the ledger_payment table.
+
+the stream resumes from the cursor stored in the ledger_cursor table, which is advanced in the same statement
+that stores each batch - so a restart neither skips nor duplicates payments.
+
+usage: python3 -m tippicserver.ledger_ingester
+"""
+import json
+import logging as log
+import time
+
+import arrow
+import requests
+
+from tippicserver import app, config
+from tippicserver.models import get_ledger_cursor, store_ledger_payments
+from tippicserver.utils import increment_metric, gauge_metric
+
+LEDGER_INGESTER_BATCH_SIZE = 200
+LEDGER_INGESTER_FLUSH_SECS = 1
+LEDGER_INGESTER_READ_TIMEOUT_SECS = 60  # horizon sends a new ledger every few secs - reconnect if it goes quiet
+LEDGER_INGESTER_MAX_BACKOFF_SECS = 30
+TOID_OPERATION_MASK = 0xFFF  # an op's id is its tx's id (ledger, tx order) with the op's index in the low 12 bits
+
+
+def horizon_payments_stream(cursor):
+    """yields the raw lines of horizon's payments event stream, starting after the given cursor"""
+    res = requests.get('%s/payments' % config.STELLAR_HORIZON_URL.rstrip('/'),
+                       params={'cursor': cursor, 'order': 'asc'},
+                       headers={'Accept': 'text/event-stream'},
+                       stream=True, timeout=(5, LEDGER_INGESTER_READ_TIMEOUT_SECS))
+    res.raise_for_status()
+    try:
+        for line in res.iter_lines(decode_unicode=True):
+            yield line
+    finally:
+        res.close()
+
+
+def iter_stream_records(lines):
+    """yields the json records in the given event-stream lines. skips the keep-alive and control messages"""
+    for line in lines:
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if not data.startswith('{'):
+            continue  # "hello", "byebye"
+        try:
+            yield json.loads(data)
+        except ValueError as e:
+            log.error('ledger ingester: cant parse record %s. e: %s' % (data, e))
+
+
+def ledger_payment_from_record(record):
+    """returns the LedgerPayment columns for the given horizon payment record, or None for other operations"""
+    if record.get('type') != 'payment' or record.get('asset_type') != 'native':
+        return None
+    return {'tx_hash': record['transaction_hash'],
+            'op_index': int(record['id']) & TOID_OPERATION_MASK,
+            'paging_token': record['paging_token'],
+            'from_address': record['from'],
+            'to_address': record['to'],
+            'amount': record['amount'],
+            'created_at': record.get('created_at')}
+
+
+def ingest(lines, app_addresses, batch_size=LEDGER_INGESTER_BATCH_SIZE, flush_secs=LEDGER_INGESTER_FLUSH_SECS):
+    """stores the payments in the given event-stream lines, in batches. returns the last stored cursor"""
+    payments = []
+    cursor = None
+    last_flush = time.time()
+
+    def flush():
+        stored = store_ledger_payments(payments, cursor, app_addresses)
+        increment_metric('ledger-payments-stored', stored)
+        del payments[:]
+
+    for record in iter_stream_records(lines):
+        cursor = record.get('paging_token', cursor)
+        payment = ledger_payment_from_record(record)
+        if payment:
+            payments.append(payment)
+        if len(payments) >= batch_size or time.time() - last_flush >= flush_secs:
+            flush()
+            last_flush = time.time()
+            if record.get('created_at'):
+                gauge_metric('ledger-ingester-lag-secs', int(time.time() - arrow.get(record['created_at']).timestamp))
+
+    if cursor is not None:
+        flush()
+    return cursor
+
+
+def run_ingester():
+    """streams forever, reconnecting with backoff"""
+    app_addresses = [app.kin_account.get_public_address()]
+    backoff = 1
+    while True:
+        cursor = get_ledger_cursor() or 'now'
+        log.info('ledger ingester: streaming payments from cursor %s' % cursor)
+        try:
+            ingest(horizon_payments_stream(cursor), app_addresses)
+            backoff = 1
+        except Exception as e:
+            increment_metric('ledger-ingester-error')
+            log.error('ledger ingester: stream failed at cursor %s. e: %s' % (cursor, e))
+            time.sleep(backoff)
+            backoff = min(backoff * 2, LEDGER_INGESTER_MAX_BACKOFF_SECS)
+
+
+if __name__ == '__main__':
+    run_ingester()
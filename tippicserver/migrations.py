@@ -0,0 +1,223 @@
+"""versioned schema migrations.
+
+the tables are created from the models on fresh databases (db.create_all, or the statements printed by
+utils.print_creation_statement). existing databases are brought up to date by the migrations below, which are
+applied in order and recorded in the schema_migration table. a migration can be re-run after it failed half way,
+and running the migrations against a database created from the current models leaves its schema as it is - but
+not every statement is free: some rewrite rows or rebuild constraints (0010 does both), locking their table.
+
+with DB_SHARDS, the migrations are applied to the default db and to every shard (which hold all the tables), and
+each db records its own. the migrations in CROSS_SHARD_MIGRATIONS backfill from the users' rows, which they can
+only do on an unsharded db - they must be applied before the shards are added.
+
+indexes are created CONCURRENTLY so that the tables stay writable while they are built. CONCURRENTLY can't run
+inside a transaction block, so every statement is executed on its own on an autocommit connection.
+
+usage: python3 -m tippicserver.migrations [status|upgrade]
+"""
+import logging as log
+import sys
+
+from tippicserver import db
+
+MIGRATIONS_TABLE = 'schema_migration'
+CROSS_SHARD_MIGRATIONS = {'0009'}  # sum the txs of all the users
+
+# (version, description, statements). never edit a migration that was already applied - add a new one instead
+MIGRATIONS = [
+    ('0001', 'materialized picture tips sums', [
+        "alter table public.picture add column if not exists tips_sum integer not null default 0;",
+        "create index concurrently if not exists ix_transaction_tx_for_item_id on public.transaction (tx_for_item_id);",
+        "create index concurrently if not exists ix_picture_author_user_id on public.picture ((author ->> 'user_id'));",
+    ]),
+    ('0002', 'running tip totals', [
+        """create table if not exists public.tip_total (
+               scope varchar(20) not null,
+               key varchar(100) not null,
+               total bigint not null default 0,
+               count integer not null default 0,
+               update_at timestamp with time zone default now(),
+               primary key (scope, key));""",
+        # the totals (and the picture tips sums from 0001) are backfilled by /tx/totals/reconcile
+    ]),
+    ('0003', 'indexes for the hot query shapes', [
+        "create index concurrently if not exists ix_transaction_user_id_update_at on public.transaction (user_id, update_at);",
+        "create index concurrently if not exists ix_transaction_to_address_tx_type_update_at on public.transaction (to_address, tx_type, update_at);",
+        "create index concurrently if not exists ix_user_enc_phone_number_deactivated on public.user (enc_phone_number, deactivated);",
+        "create index concurrently if not exists ix_user_username on public.user (username);",
+        "create index concurrently if not exists ix_p2_p_transaction_sender_user_id_update_at on public.p2_p_transaction (sender_user_id, update_at);",
+        "create index concurrently if not exists ix_p2_p_transaction_receiver_user_id_update_at on public.p2_p_transaction (receiver_user_id, update_at);",
+        "create index concurrently if not exists ix_picture_picture_order_index on public.picture (picture_order_index);",
+    ]),
+    ('0004', 'reported txs pending verification', [
+        """create table if not exists public.transaction_report (
+               tx_hash varchar(100) not null primary key,
+               user_id uuid not null references public.user (user_id),
+               to_address varchar(60) not null,
+               amount integer not null,
+               tx_for_item_id varchar(100) not null,
+               tx_type varchar(20) not null,
+               status varchar(10) not null,
+               reason varchar(40),
+               attempts integer not null,
+               next_attempt_at timestamp with time zone default now(),
+               created_at timestamp with time zone default now(),
+               update_at timestamp with time zone default now());""",
+        "create index concurrently if not exists ix_transaction_report_pending on public.transaction_report (next_attempt_at) where status = 'pending';",
+    ]),
+    ('0005', 'ledger payments ingested from horizon', [
+        """create table if not exists public.ledger_payment (
+               tx_hash varchar(100) not null primary key,
+               paging_token varchar(40) not null,
+               from_address varchar(60) not null,
+               to_address varchar(60) not null,
+               amount numeric not null,
+               created_at timestamp with time zone,
+               ingested_at timestamp with time zone default now());""",
+        """create table if not exists public.ledger_cursor (
+               name varchar(40) not null primary key,
+               cursor varchar(40) not null,
+               update_at timestamp with time zone default now());""",
+    ]),
+    ('0006', 'persisted onboarding jobs', [
+        """create table if not exists public.onboarding_job (
+               user_id uuid not null primary key references public.user (user_id),
+               public_address varchar(60) not null,
+               token uuid not null,
+               status varchar(10) not null,
+               account_created boolean not null,
+               attempts integer not null,
+               error varchar(100),
+               created_at timestamp with time zone default now(),
+               update_at timestamp with time zone default now());""",
+    ]),
+    ('0007', 'blind index of the users phone numbers', [
+        "alter table public.user add column if not exists phone_number_index bytea;",
+        "create index concurrently if not exists ix_user_phone_number_index_deactivated on public.user (phone_number_index, deactivated);",
+        # the indexes are backfilled by /users/phone-number-index/backfill. then set PHONE_NUMBER_INDEX_ONLY
+    ]),
+    ('0008', 'global directory of the sharded users', [
+        """create table if not exists public.user_directory (
+               user_id uuid not null primary key,
+               shard varchar(40) not null,
+               public_address varchar(60),
+               enc_phone_number varchar(200),
+               update_at timestamp with time zone default now());""",
+        "create index concurrently if not exists ix_user_directory_public_address on public.user_directory (public_address);",
+        "create index concurrently if not exists ix_user_directory_enc_phone_number on public.user_directory (enc_phone_number);",
+    ]),
+    ('0009', 'backfill the picture tips sums', [
+        # one multi-statement query runs as a single transaction: the lock keeps the tx writers from incrementing
+        # a sum between its computation and its update
+        """lock table public.picture in exclusive mode;
+           update public.picture p set tips_sum = c.total
+           from (select pic.picture_id, coalesce(sum(t.amount), 0) as total from public.picture pic
+                 left join public.transaction t on t.tx_for_item_id = pic.picture_id group by pic.picture_id) c
+           where p.picture_id = c.picture_id and p.tips_sum <> c.total;""",
+        # then set PICTURE_TIPS_SUM_MATERIALIZED
+    ]),
+    ('0010', 'key the ledger payments by op', [
+        "alter table public.ledger_payment add column if not exists op_index integer not null default 0;",
+        # the payments' paging tokens are their op ids, which hold the op index in the low 12 bits
+        "update public.ledger_payment set op_index = cast(paging_token as bigint) & 4095 where op_index = 0;",
+        """alter table public.ledger_payment drop constraint if exists ledger_payment_pkey,
+                                             add constraint ledger_payment_pkey primary key (tx_hash, op_index);""",
+        "alter table public.ledger_payment alter column op_index drop default;",
+    ]),
+    ('0011', 'drop the foreign keys to the sharded users', [
+        # these tables stay on the default db, while the users they reference may live on any shard
+        "alter table public.onboarding_job drop constraint if exists onboarding_job_user_id_fkey;",
+        "alter table public.transaction_report drop constraint if exists transaction_report_user_id_fkey;",
+        "alter table public.reported_pictures drop constraint if exists reported_pictures_user_id_fkey;",
+        """alter table public.p2_p_transaction drop constraint if exists p2_p_transaction_sender_user_id_fkey,
+                                              drop constraint if exists p2_p_transaction_receiver_user_id_fkey,
+                                              drop constraint if exists p2_p_transaction_sender_address_fkey,
+                                              drop constraint if exists p2_p_transaction_receiver_address_fkey;""",
+    ]),
+]
+
+
+def _index_name(statement):
+    """returns the name of the index created by the given statement, or None"""
+    words = statement.split()
+    if words[:2] != ['create', 'index'] or 'exists' not in words:
+        return None
+    return words[words.index('exists') + 1]
+
+
+def _drop_invalid_index(conn, name):
+    """a failed concurrent build leaves an invalid index behind, which 'if not exists' would then skip. drop it"""
+    invalid = conn.execute("""select 1 from pg_index i join pg_class c on c.oid = i.indexrelid
+                              where c.relname = %s and not i.indisvalid;""", (name,)).scalar()
+    if invalid:
+        log.warning('migrations: dropping the invalid index %s left by a failed build' % name)
+        conn.execute('drop index concurrently if exists %s;' % name)
+
+
+def get_applied_versions(conn):
+    conn.execute("""create table if not exists public.%s (
+                        version varchar(20) primary key,
+                        description varchar(200),
+                        applied_at timestamp with time zone default now());""" % MIGRATIONS_TABLE)
+    return set(row['version'] for row in conn.execute('select version from public.%s;' % MIGRATIONS_TABLE))
+
+
+def get_migrations_status(engine=None):
+    """returns a list of (version, description, applied) for all the migrations, on the given engine (by default,
+    the default db's)
+    """
+    conn = (engine or db.engine).connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        applied = get_applied_versions(conn)
+    finally:
+        conn.close()
+    return [(version, description, version in applied) for version, description, _ in MIGRATIONS]
+
+
+def run_migrations():
+    """applies all the pending migrations, in order, to the default db and to every shard. returns True on success.
+
+    stops at the first failure - the failed migration is not recorded and is retried (from its first
+    statement) on the next run.
+    """
+    from tippicserver.models.user import user_engines
+
+    if db.router:
+        pending = set(version for version, _, applied in get_migrations_status() if not applied)
+        if pending & CROSS_SHARD_MIGRATIONS:
+            log.error('migrations: %s must be applied before sharding' % ', '.join(sorted(pending & CROSS_SHARD_MIGRATIONS)))
+            return False
+    return all(run_migrations_on(shard, engine) for shard, engine in user_engines())
+
+
+def run_migrations_on(shard, engine):
+    conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        applied = get_applied_versions(conn)
+        for version, description, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            log.info('migrations: applying %s (%s) on shard %s' % (version, description, shard))
+            for statement in statements:
+                index_name = _index_name(statement)
+                if index_name:
+                    _drop_invalid_index(conn, index_name)
+                conn.execute(statement)
+            conn.execute('insert into public.%s (version, description) values (%%s, %%s);' % MIGRATIONS_TABLE,
+                         (version, description))
+        return True
+    except Exception as e:
+        log.error('migrations: failed to apply the migrations on shard %s. e: %s' % (shard, e))
+        return False
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    if command == 'upgrade':
+        sys.exit(0 if run_migrations() else 1)
+    from tippicserver.models.user import user_engines
+    for shard, engine in user_engines():
+        for version, description, applied in get_migrations_status(engine):
+            print('%s %s %s %s' % (shard, version, 'applied' if applied else 'pending', description))
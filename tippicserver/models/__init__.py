@@ -1,5 +1,9 @@
 from .transaction import *
+from .ledger_payment import *
+from .transaction_report import *
 from .user import *
+from .user_context import *
+from .app_launch import *
 from .p2p_transaction import *
 from .push_auth_token import *
 from .acl import *
@@ -8,3 +12,6 @@ from .email_template import *
 from .blacklisted_phone_numbers import *
 from .system_config import *
 from .picture import *
+from .tip_totals import *
+from .onboarding import *
+from .broadcast import *
@@ -1,12 +1,18 @@
-
 import datetime
+import ipaddress
 import logging as log
+import os
+import threading
+import time
+
+from tippicserver import db, app
 
-from tippicserver import db
+ACL_CACHE_TTL_SECS = 60
+ACL_INVALIDATION_CHANNEL = 'acl-invalidated'
 
 
 class ACL(db.Model):
-    """ACL for the server"""
+    """ACL for the server. ip_addr is either a single address or a network, in cidr notation"""
     ip_addr = db.Column(db.String(40), primary_key=True)
     name = db.Column(db.String(40), primary_key=False)
 
@@ -14,9 +20,90 @@ class ACL(db.Model):
         return '<ip: %s, name: %s>' % (self.ip_addr, self.name)
 
 
+class ACLMatcher(object):
+    """the acl entries, compiled for matching: for every prefix length in the acl, a set of the
+    (shifted) network addresses. a lookup costs a set lookup per distinct prefix length.
+    """
+
+    def __init__(self, entries):
+        self.networks = {4: {}, 6: {}}  # version -> {prefixlen: set of network addresses, shifted}
+        for entry in entries:
+            try:
+                network = ipaddress.ip_network(entry.strip(), strict=False)
+            except ValueError:
+                log.error('ignoring invalid acl entry %s' % entry)
+                continue
+            shift = network.max_prefixlen - network.prefixlen
+            self.networks[network.version].setdefault(network.prefixlen, set()).add(int(network.network_address) >> shift)
+
+    def match(self, ip_addr):
+        try:
+            address = ipaddress.ip_address(ip_addr.strip())
+        except (ValueError, AttributeError):
+            return False
+        value = int(address)
+        for prefixlen, networks in self.networks[address.version].items():
+            if value >> (address.max_prefixlen - prefixlen) in networks:
+                return True
+        return False
+
+
+acl_cache = {'matcher': None, 'loaded_at': 0, 'invalidations': 0, 'pid': None}
+acl_cache_lock = threading.Lock()
+
+
+def expire_acl_cache():
+    acl_cache['invalidations'] += 1
+    acl_cache['loaded_at'] = 0
+
+
+def listen_for_acl_invalidations():
+    """drops the cached acl whenever it's changed, for as long as the process lives"""
+    while True:
+        try:
+            pubsub = app.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(ACL_INVALIDATION_CHANNEL)
+            expire_acl_cache()  # might have missed a message while (re)connecting
+            for _ in pubsub.listen():
+                expire_acl_cache()
+        except Exception as e:
+            log.error('acl invalidation listener failed. e: %s' % e)
+            time.sleep(1)
+
+
+def get_acl_matcher():
+    """returns the cached acl matcher, reloading it from the db if it's older than the ttl or was invalidated"""
+    if acl_cache['pid'] != os.getpid():
+        # the listener thread doesn't survive a fork
+        with acl_cache_lock:
+            if acl_cache['pid'] != os.getpid():
+                acl_cache['pid'] = os.getpid()
+                expire_acl_cache()
+                threading.Thread(target=listen_for_acl_invalidations, daemon=True).start()
+
+    if time.time() - acl_cache['loaded_at'] > ACL_CACHE_TTL_SECS:
+        with acl_cache_lock:
+            if time.time() - acl_cache['loaded_at'] > ACL_CACHE_TTL_SECS:
+                loaded_at, invalidations = time.time(), acl_cache['invalidations']
+                try:
+                    entries = [item.ip_addr for item in ACL.query.all()]
+                except Exception as e:
+                    if acl_cache['matcher'] is None:
+                        raise
+                    log.error('cant reload the acl - using the cached one. e: %s' % e)
+                else:
+                    acl_cache['matcher'] = ACLMatcher(entries)
+                    if invalidations == acl_cache['invalidations']:  # otherwise, reload on the next lookup
+                        acl_cache['loaded_at'] = loaded_at
+    return acl_cache['matcher']
+
+
+def invalidate_acl():
+    """makes every process reload the acl on its next lookup. call after changing the acl table"""
+    expire_acl_cache()
+    app.redis.publish(ACL_INVALIDATION_CHANNEL, 1)
+
+
 def is_in_acl(ip_addr):
     """returns true if the given ip is in the acl"""
-    item = ACL.query.filter_by(ip_addr=ip_addr).first()
-    if not item:
-        return False
-    return True
+    return get_acl_matcher().match(ip_addr)
@@ -0,0 +1,137 @@
+"""write-behind app-launch updates.
+
+every app launch used to commit the user's ip address (and country) and app version to user_app_data - two
+synchronous commits, mostly writing the same values again. launches are now pushed to a redis list, and the
+app launch writer (see tippicserver/app_launch_writer.py) drains it in batches: the latest launch per user is
+applied with a single UPDATE ... FROM (VALUES ...), which skips the rows where nothing changed.
+"""
+import ipaddress
+import json
+import logging as log
+import time
+
+from sqlalchemy import text
+
+from tippicserver import app, config
+from tippicserver.utils import increment_metric
+from .user_context import invalidate_user_context
+
+APP_LAUNCHES_QUEUE_KEY = 'app-launches'
+COUNTRY_BACKFILL_BATCH_SIZE = 1000
+
+
+def normalize_ip_address(ip_address):
+    """returns the given ip address if it's valid, or None"""
+    try:
+        return str(ipaddress.ip_address(ip_address.strip()))
+    except (ValueError, AttributeError):
+        return None
+
+
+def record_app_launch(user_id, ip_address, app_ver):
+    """queues the launch's ip address and app version to be written to the user's app data"""
+    launch = {'user_id': str(user_id), 'ip_address': normalize_ip_address(ip_address), 'app_ver': app_ver,
+              'launched_at': time.time()}
+    if config.APP_LAUNCH_UPDATES_INLINE:
+        apply_app_launches([launch])
+        invalidate_user_context(user_id)
+        return
+    app.redis.rpush(APP_LAUNCHES_QUEUE_KEY, json.dumps(launch))
+
+
+def pop_app_launches(count):
+    """atomically pops up to count launches from the queue"""
+    pipe = app.redis.pipeline(transaction=True)
+    pipe.lrange(APP_LAUNCHES_QUEUE_KEY, 0, count - 1)
+    pipe.ltrim(APP_LAUNCHES_QUEUE_KEY, count, -1)
+    launches, _ = pipe.execute()
+    return [json.loads(launch.decode()) for launch in launches]
+
+
+def apply_app_launches(launches):
+    """writes the latest of the given launches per user to user_app_data. returns the number of updated rows"""
+    from .user import user_engine
+
+    latest = {}
+    for launch in launches:
+        if launch['user_id'] not in latest or launch['launched_at'] >= latest[launch['user_id']]['launched_at']:
+            latest[launch['user_id']] = launch
+    if not latest:
+        return 0
+
+    countries = app.geoip.lookup_many([launch['ip_address'] for launch in latest.values() if launch['ip_address']])
+    # one update per db that holds the users' rows
+    by_engine = {}
+    for launch in latest.values():
+        by_engine.setdefault(user_engine(launch['user_id']), []).append(launch)
+    updated = 0
+    for engine, engine_launches in by_engine.items():
+        updated += update_app_data(engine, engine_launches, countries)
+    increment_metric('app-launches-applied', len(latest))
+    increment_metric('app-launches-changed', updated)
+    return updated
+
+
+def update_app_data(engine, launches, countries):
+    """applies the given launches (one per user) to the user_app_data rows in the given db"""
+    params = {}
+    values = []
+    for index, launch in enumerate(launches):
+        ip_address = launch['ip_address']
+        values.append('(cast(:user_id_%(i)s as uuid), :app_ver_%(i)s, cast(:ip_address_%(i)s as inet), '
+                      ':country_iso_code_%(i)s, to_timestamp(:launched_at_%(i)s))' % {'i': index})
+        params.update({'user_id_%s' % index: launch['user_id'], 'app_ver_%s' % index: launch['app_ver'],
+                       'ip_address_%s' % index: ip_address, 'country_iso_code_%s' % index: countries.get(ip_address),
+                       'launched_at_%s' % index: launch['launched_at']})
+
+    # a launch without an ip (or with one that didn't resolve) keeps the stored one (or country)
+    statement = '''update public.user_app_data u set
+                       app_ver = coalesce(v.app_ver, u.app_ver),
+                       ip_address = coalesce(v.ip_address, u.ip_address),
+                       country_iso_code = case when v.ip_address is distinct from u.ip_address
+                                          then coalesce(v.country_iso_code, u.country_iso_code)
+                                          else u.country_iso_code end,
+                       update_at = v.launched_at
+                   from (values %s) as v (user_id, app_ver, ip_address, country_iso_code, launched_at)
+                   where u.user_id = v.user_id
+                   and (u.app_ver is distinct from coalesce(v.app_ver, u.app_ver)
+                        or u.ip_address is distinct from coalesce(v.ip_address, u.ip_address));''' % ', '.join(values)
+    try:
+        return engine.execute(text(statement), params).rowcount
+    except Exception as e:
+        log.error('apply_app_launches: cant apply %s launches. e: %s' % (len(launches), e))
+        raise
+
+
+def backfill_country_iso_codes(batch_size=COUNTRY_BACKFILL_BATCH_SIZE):
+    """sets the country of the user_app_data rows that have an ip but no country, on every shard. returns the
+    number of rows set
+    """
+    from .user import user_engines
+
+    total = 0
+    for shard, engine in user_engines():
+        last_user_id = None
+        while True:
+            rows = engine.execute(text('''select user_id, host(ip_address) from public.user_app_data
+                                          where ip_address is not null and country_iso_code is null
+                                          and (cast(:last_user_id as uuid) is null or user_id > cast(:last_user_id as uuid))
+                                          order by user_id limit :limit;'''),
+                                  {'last_user_id': last_user_id, 'limit': batch_size}).fetchall()
+            if not rows:
+                break
+            last_user_id = str(rows[-1][0])
+
+            countries = app.geoip.lookup_many([ip_address for _, ip_address in rows])
+            found = [(str(user_id), countries[ip_address]) for user_id, ip_address in rows if countries[ip_address]]
+            if found:
+                params = {}
+                for index, (user_id, country_iso_code) in enumerate(found):
+                    params.update({'user_id_%s' % index: user_id, 'country_iso_code_%s' % index: country_iso_code})
+                values = ', '.join('(cast(:user_id_%(i)s as uuid), :country_iso_code_%(i)s)' % {'i': index} for index in range(len(found)))
+                total += engine.execute(text('''update public.user_app_data u set country_iso_code = v.country_iso_code
+                                               from (values %s) as v (user_id, country_iso_code)
+                                               where u.user_id = v.user_id and u.country_iso_code is null;''' % values),
+                                        params).rowcount
+            log.info('backfill_country_iso_codes: set %s countries so far (shard %s)' % (total, shard))
+    return total
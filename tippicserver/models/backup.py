@@ -1,5 +1,6 @@
 
 from tippicserver import db
+from tippicserver.replica import read_only
 from tippicserver.utils import InvalidUsage
 import logging as log
 import arrow
@@ -18,6 +19,7 @@ class BackupQuestion(db.Model):
                ' updated_at: %s>' % (self.sid, self.question_text, self.updated_at)
 
 
+@read_only
 def generate_backup_questions_list():
     """returns a list of all the questions with their sid"""
     response = []
@@ -1,5 +1,59 @@
+"""the phone numbers blacklist.
+
+the table is mirrored into a redis set, and each process holds a bloom filter of the set - so checking a
+number that isn't blacklisted (nearly all of them) costs a few hashes, and a bloom filter hit costs one redis
+lookup. the filter is rebuilt when the set's epoch changes, which other processes notice within
+BLACKLIST_FILTER_TTL_SECS. the set is rebuilt from the table by a job on the fast queue, at least every
+BLACKLIST_REBUILD_SECS (meanwhile the current filter is served), or by rebuild_blacklist (/blacklist/rebuild).
+until the set is first built, or if redis is unavailable, the checks fall back to the table.
+"""
+import hashlib
 import logging as log
+import math
+import threading
+import time
+
+import redis_lock
+
 from tippicserver import db, app
+from .user_context import get_user_context, invalidate_user_context
+
+BLACKLIST_KEY = 'blacklisted-enc-phone-numbers:%s'  # the database's fingerprint - a test db is a new blacklist
+BLACKLIST_EPOCH_KEY = 'blacklisted-enc-phone-numbers-epoch:%s'  # exists once the set was built from the table
+BLACKLIST_FRESH_KEY = 'blacklisted-enc-phone-numbers-fresh:%s'  # expires when the set is due for a rebuild
+BLACKLIST_REBUILD_SCHEDULED_KEY = 'blacklisted-enc-phone-numbers-rebuild-scheduled:%s'
+BLACKLIST_LOCK_NAME = 'blacklisted-enc-phone-numbers:%s'
+BLACKLIST_FILTER_TTL_SECS = 5
+BLACKLIST_REBUILD_SECS = 60 * 60  # the set is rebuilt from the table at least this often, in case an add was lost
+BLACKLIST_REBUILD_JOB_TIMEOUT_SECS = 120
+BLACKLIST_FILTER_ERROR_RATE = 0.001
+
+
+class BloomFilter(object):
+    """a bloom filter of strings: 'in' may return false positives, but never false negatives"""
+
+    def __init__(self, items, error_rate=BLACKLIST_FILTER_ERROR_RATE):
+        capacity = max(len(items), 100)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        for item in items:
+            for position in self._positions(item):
+                self.bits[position // 8] |= 1 << (position % 8)
+
+    def _positions(self, item):
+        # double hashing over a single digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def __contains__(self, item):
+        return all(self.bits[position // 8] & (1 << (position % 8)) for position in self._positions(item))
+
+
+blacklist_filter = {'bloom': None, 'epoch': None, 'fingerprint': None, 'checked_at': 0}
+blacklist_filter_lock = threading.Lock()
+db_fingerprint = {'uri': None, 'fingerprint': None}
 
 
 class BlacklistedEncPhoneNumber(db.Model):
@@ -50,11 +104,106 @@ def blacklist_enc_phone_number(enc_phone_number):
         log.error('failed to store blacklisted_enc_phone_number with enc_phone_number: %s. e: %s' % (enc_phone_number, e))
         return False
     else:
+        try:
+            add_to_blacklist_set(enc_phone_number)
+        except Exception as e:
+            # picked up by the next periodic rebuild
+            log.error('failed to add enc_phone_number %s to the blacklist set. e: %s' % (enc_phone_number, e))
+        # any loaded context may now hold a stale blacklist status
+        invalidate_user_context()
         return True
 
 
+def get_db_fingerprint():
+    """a short id of the database the blacklist mirrors. computed once per process (once per test db in the tests)"""
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if db_fingerprint['uri'] != uri:
+        db_fingerprint['fingerprint'] = hashlib.md5(str(uri).encode('utf-8')).hexdigest()[:8]
+        db_fingerprint['uri'] = uri
+    return db_fingerprint['fingerprint']
+
+
+def rebuild_blacklist():
+    """(re)builds the blacklist set from the table. returns the number of blacklisted numbers"""
+    fingerprint = get_db_fingerprint()
+    with redis_lock.Lock(app.redis, BLACKLIST_LOCK_NAME % fingerprint, expire=60):
+        numbers = [number for number, in db.session.query(BlacklistedEncPhoneNumber.enc_phone_number).all()]
+        tmp_key = (BLACKLIST_KEY % fingerprint) + ':rebuild'
+        pipe = app.redis.pipeline(transaction=True)
+        pipe.delete(tmp_key)
+        for i in range(0, len(numbers), 1000):
+            pipe.sadd(tmp_key, *numbers[i:i + 1000])
+        if numbers:
+            pipe.rename(tmp_key, BLACKLIST_KEY % fingerprint)
+        else:
+            pipe.delete(BLACKLIST_KEY % fingerprint)
+        pipe.incr(BLACKLIST_EPOCH_KEY % fingerprint)
+        pipe.persist(BLACKLIST_EPOCH_KEY % fingerprint)  # the epoch of older versions expired
+        pipe.setex(BLACKLIST_FRESH_KEY % fingerprint, BLACKLIST_REBUILD_SECS, 1)
+        pipe.delete(BLACKLIST_REBUILD_SCHEDULED_KEY % fingerprint)
+        pipe.execute()
+    blacklist_filter['checked_at'] = 0
+    log.info('rebuilt the blacklist set with %s numbers' % len(numbers))
+    return len(numbers)
+
+
+def schedule_blacklist_rebuild(fingerprint):
+    """makes sure a job that rebuilds the blacklist set is queued"""
+    if app.redis.set(BLACKLIST_REBUILD_SCHEDULED_KEY % fingerprint, 1, nx=True, ex=BLACKLIST_REBUILD_JOB_TIMEOUT_SECS):
+        app.rq_fast.enqueue_call(func=rebuild_blacklist, timeout=BLACKLIST_REBUILD_JOB_TIMEOUT_SECS)
+
+
+def add_to_blacklist_set(enc_phone_number):
+    fingerprint = get_db_fingerprint()
+    # serialized with the rebuilds, which may have read the table before this number was added
+    with redis_lock.Lock(app.redis, BLACKLIST_LOCK_NAME % fingerprint, expire=60):
+        if app.redis.get(BLACKLIST_EPOCH_KEY % fingerprint) is None:
+            return  # not built yet - the rebuild will read it from the table
+        pipe = app.redis.pipeline(transaction=True)
+        pipe.sadd(BLACKLIST_KEY % fingerprint, enc_phone_number)
+        pipe.incr(BLACKLIST_EPOCH_KEY % fingerprint)
+        pipe.execute()
+    blacklist_filter['checked_at'] = 0
+
+
+def get_blacklist_filter():
+    """returns the bloom filter of the blacklist set, rebuilding it if the set changed. returns None if the set
+    wasn't built yet (a rebuild is scheduled)
+    """
+    if time.time() - blacklist_filter['checked_at'] < BLACKLIST_FILTER_TTL_SECS \
+            and blacklist_filter['fingerprint'] == get_db_fingerprint():
+        return blacklist_filter['bloom']
+
+    with blacklist_filter_lock:
+        fingerprint = get_db_fingerprint()
+        epoch, fresh = app.redis.mget(BLACKLIST_EPOCH_KEY % fingerprint, BLACKLIST_FRESH_KEY % fingerprint)
+        if fresh is None:
+            # keep serving the current filter (or the table) until the job rebuilt the set
+            schedule_blacklist_rebuild(fingerprint)
+        if epoch is None:
+            return None
+        if epoch != blacklist_filter['epoch'] or fingerprint != blacklist_filter['fingerprint']:
+            numbers = [number.decode('utf-8') for number in app.redis.smembers(BLACKLIST_KEY % fingerprint)]
+            blacklist_filter['bloom'] = BloomFilter(numbers)
+            blacklist_filter['epoch'] = epoch
+            blacklist_filter['fingerprint'] = fingerprint
+        blacklist_filter['checked_at'] = time.time()
+        return blacklist_filter['bloom']
+
+
 def is_enc_phone_number_blacklisted(enc_phone_number):
-    """return the user backup hints object for the given enc_phone_number or throws exception"""
+    """returns True if the given enc_phone_number is blacklisted"""
+    if not enc_phone_number:
+        return False
+    try:
+        bloom = get_blacklist_filter()
+        if bloom is not None:
+            if enc_phone_number not in bloom:
+                return False
+            return bool(app.redis.sismember(BLACKLIST_KEY % get_db_fingerprint(), enc_phone_number))
+    except Exception as e:
+        log.error('cant check the blacklist set - falling back to the table. e: %s' % e)
+
     blacklisted_enc_phone_number = BlacklistedEncPhoneNumber.query.filter_by(enc_phone_number=enc_phone_number).first()
     if not blacklisted_enc_phone_number:
         return False
@@ -63,7 +212,9 @@ def is_enc_phone_number_blacklisted(enc_phone_number):
 
 def is_userid_blacklisted(user_id):
     """determines whether the given user_id is blacklisted"""
-    count = db.engine.execute("""select count(*) from public.user, public.blacklisted_enc_phone_number where public.user.enc_phone_number=public.blacklisted_enc_phone_number.enc_phone_number and public.user.user_id='%s';""" % user_id).scalar()
-    if count == 0:
-        return False
-    return True
+    context = get_user_context(user_id)
+    if context and context.user is not None:
+        return context.blacklisted
+
+    from .user import get_enc_phone_number_by_user_id
+    return is_enc_phone_number_blacklisted(get_enc_phone_number_by_user_id(user_id))
@@ -0,0 +1,220 @@
+"""push broadcasts: one payload, sent to every active user with a push token.
+
+a broadcast is a redis hash (its definition and progress), worked by the push_broadcast job on the slow queue.
+the job walks the user table in user_id order, a page at a time, streaming each page over a server-side cursor
+(behind pgbouncer, each page is fetched whole).
+tokens are grouped by os type and push env, and published to eshu in provider-sized batches over the amqp
+channel pool. the last user_id of every completed page is checkpointed, so a broadcast that died (or timed out)
+resumes where it left off - at worst a page of users gets the push twice.
+"""
+import json
+import logging as log
+import time
+import uuid
+
+import redis_lock
+from sqlalchemy import text
+
+from tippicserver import db, app, config
+from tippicserver.db_pool import server_side_cursors
+from tippicserver.utils import InvalidUsage, increment_metric, gauge_metric, OS_ANDROID, OS_IOS
+from .user import package_id_to_push_env
+
+PUSH_BROADCAST_KEY = 'push-broadcast:%s'
+PUSH_BROADCAST_LOCK_NAME = 'push-broadcast-lock:%s'
+PUSH_BROADCAST_PAGE_SIZE = 10000  # users per transaction/checkpoint
+PUSH_BROADCAST_FETCH_SIZE = 1000  # rows per round trip from the server-side cursor
+PUSH_BROADCAST_BATCH_SIZES = {OS_ANDROID: 1000, OS_IOS: 500}  # gcm takes up to 1000 tokens per multicast
+PUSH_BROADCAST_JOB_TIMEOUT_SECS = 60 * 60 * 4
+PUSH_BROADCAST_EXPIRE_SECS = 60 * 60 * 24 * 30
+PUSH_ROUTING_KEY = 'eshu-key'
+
+BROADCAST_QUEUED = 'queued'
+BROADCAST_RUNNING = 'running'
+BROADCAST_DONE = 'done'
+BROADCAST_FAILED = 'failed'
+BROADCAST_CANCELLED = 'cancelled'
+
+# sets the status of the broadcast at KEYS[1] to ARGV[2], only if it is ARGV[1] - a cancel is never overwritten
+SET_BROADCAST_STATUS_SCRIPT = """
+if redis.call('hget', KEYS[1], 'status') == ARGV[1] then
+    redis.call('hset', KEYS[1], 'status', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+def create_push_broadcast(payload, os_types=None, dry_run=False):
+    """stores a new broadcast and queues it. returns its id"""
+    os_types = os_types or [OS_ANDROID, OS_IOS]
+    if not payload or any(os_type not in (OS_ANDROID, OS_IOS) for os_type in os_types):
+        raise InvalidUsage('bad-request')
+
+    broadcast_id = str(uuid.uuid4())
+    key = PUSH_BROADCAST_KEY % broadcast_id
+    pipe = app.redis.pipeline()
+    pipe.hmset(key, {'payload': json.dumps(payload), 'os_types': json.dumps(os_types), 'dry_run': int(bool(dry_run)),
+                     'status': BROADCAST_QUEUED, 'cursor': '', 'users': 0, 'sent': 0, 'failed': 0,
+                     'created_at': time.time()})
+    pipe.expire(key, PUSH_BROADCAST_EXPIRE_SECS)
+    pipe.execute()
+    enqueue_push_broadcast(broadcast_id)
+    return broadcast_id
+
+
+def enqueue_push_broadcast(broadcast_id):
+    app.rq_slow.enqueue_call(func=push_broadcast, args=(broadcast_id,), timeout=PUSH_BROADCAST_JOB_TIMEOUT_SECS)
+
+
+def get_push_broadcast(broadcast_id):
+    """returns the given broadcast's definition and progress, or None"""
+    broadcast = app.redis.hgetall(PUSH_BROADCAST_KEY % broadcast_id)
+    if not broadcast:
+        return None
+    broadcast = {k.decode(): v.decode() for k, v in broadcast.items()}
+    broadcast['payload'] = json.loads(broadcast['payload'])
+    broadcast['os_types'] = json.loads(broadcast['os_types'])
+    broadcast['dry_run'] = broadcast['dry_run'] == '1'
+    broadcast['cursor'] = broadcast['cursor'] or None
+    for field in ('users', 'sent', 'failed'):
+        broadcast[field] = int(broadcast[field])
+    for field in ('created_at', 'started_at', 'updated_at', 'rate'):
+        if field in broadcast:
+            broadcast[field] = float(broadcast[field])
+    broadcast['broadcast_id'] = broadcast_id
+    return broadcast
+
+
+def resume_push_broadcast(broadcast_id):
+    """requeues a broadcast that failed or was cancelled. it continues from its last checkpoint"""
+    broadcast = get_push_broadcast(broadcast_id)
+    if not broadcast:
+        raise InvalidUsage('no such broadcast')
+    if broadcast['status'] == BROADCAST_DONE:
+        return False
+    app.redis.hset(PUSH_BROADCAST_KEY % broadcast_id, 'status', BROADCAST_QUEUED)
+    enqueue_push_broadcast(broadcast_id)
+    return True
+
+
+def cancel_push_broadcast(broadcast_id):
+    """stops the given broadcast after the page it's sending"""
+    if not app.redis.exists(PUSH_BROADCAST_KEY % broadcast_id):
+        raise InvalidUsage('no such broadcast')
+    app.redis.hset(PUSH_BROADCAST_KEY % broadcast_id, 'status', BROADCAST_CANCELLED)
+
+
+def set_broadcast_status(broadcast_id, from_status, to_status):
+    """moves the broadcast from from_status to to_status. returns False if it isn't in from_status anymore"""
+    return bool(app.redis.eval(SET_BROADCAST_STATUS_SCRIPT, 1, PUSH_BROADCAST_KEY % broadcast_id, from_status, to_status))
+
+
+def send_push_batch(os_type, push_env, tokens, payload, dry_run):
+    """publishes the payload to the given tokens. returns the number of published messages"""
+    publisher = app.amqp_publishers[push_env]
+    if os_type == OS_ANDROID:
+        return publisher.send_gcm(PUSH_ROUTING_KEY, payload, tokens, dry_run, config.PUSH_TTL_SECS)
+    if dry_run:
+        return len(tokens)  # apns has no dry run
+    return publisher.send_apns(PUSH_ROUTING_KEY, payload, tokens)
+
+
+PUSH_TARGETS_QUERY = '''select user_id, os_type, push_token, package_id from public.user
+                         where deactivated = false and push_token is not null and push_token != ''
+                         and os_type in :os_types
+                         and (cast(:cursor as uuid) is null or user_id > cast(:cursor as uuid))
+                         order by user_id limit :limit;'''
+
+
+def stream_push_targets(os_types, cursor, limit):
+    """yields (user_id, os_type, push_token, package_id) of the next page of targets after the given user_id"""
+    params = {'os_types': tuple(os_types), 'cursor': cursor, 'limit': limit}
+    if db.router:
+        # the users are sharded: the page is the first users after the cursor of all the shards' pages
+        rows = db.router.scatter_gather(text(PUSH_TARGETS_QUERY), params)
+        for row in sorted(rows, key=lambda row: row['user_id'])[:limit]:
+            yield row
+        return
+
+    # a server-side cursor needs a transaction, which the autocommit engine doesn't open - so open one per page
+    with db.engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='READ COMMITTED', stream_results=server_side_cursors())
+        with conn.begin():
+            result = conn.execute(text(PUSH_TARGETS_QUERY), params)
+            while True:
+                rows = result.fetchmany(PUSH_BROADCAST_FETCH_SIZE)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+
+
+def push_broadcast(broadcast_id):
+    """sends the given broadcast from its last checkpoint to the end of the user table"""
+    key = PUSH_BROADCAST_KEY % broadcast_id
+    with redis_lock.Lock(app.redis, PUSH_BROADCAST_LOCK_NAME % broadcast_id, expire=60, auto_renewal=True):
+        broadcast = get_push_broadcast(broadcast_id)
+        if not broadcast or broadcast['status'] not in (BROADCAST_QUEUED, BROADCAST_RUNNING):
+            log.info('push_broadcast: nothing to do for broadcast %s' % broadcast_id)
+            return
+
+        started_at = time.time()
+        sent_this_run = 0
+        if not set_broadcast_status(broadcast_id, broadcast['status'], BROADCAST_RUNNING):
+            log.info('push_broadcast: broadcast %s was cancelled before it started' % broadcast_id)
+            return
+        app.redis.hset(key, 'started_at', broadcast.get('started_at', started_at))
+        cursor = broadcast['cursor']
+        try:
+            while True:
+                if app.redis.hget(key, 'status') == BROADCAST_CANCELLED.encode():
+                    log.info('push_broadcast: broadcast %s cancelled at user_id %s' % (broadcast_id, cursor))
+                    return
+
+                users = 0
+                groups = {}
+                for user_id, os_type, push_token, package_id in stream_push_targets(broadcast['os_types'], cursor, PUSH_BROADCAST_PAGE_SIZE):
+                    users += 1
+                    cursor = str(user_id)
+                    # android doesnt send a package id and only supports 'beta'
+                    push_env = package_id_to_push_env(package_id) if os_type == OS_IOS else 'beta'
+                    groups.setdefault((os_type, push_env), []).append(push_token)
+                if not users:
+                    break
+
+                sent = failed = 0
+                for (os_type, push_env), tokens in groups.items():
+                    batch_size = PUSH_BROADCAST_BATCH_SIZES[os_type]
+                    for i in range(0, len(tokens), batch_size):
+                        batch = tokens[i:i + batch_size]
+                        published = send_push_batch(os_type, push_env, batch, broadcast['payload'], broadcast['dry_run']) or 0
+                        sent += published
+                        failed += len(batch) - published
+
+                # checkpoint the page
+                sent_this_run += sent
+                rate = sent_this_run / max(time.time() - started_at, 0.001)
+                pipe = app.redis.pipeline()
+                pipe.hset(key, 'cursor', cursor)
+                pipe.hincrby(key, 'users', users)
+                pipe.hincrby(key, 'sent', sent)
+                pipe.hincrby(key, 'failed', failed)
+                pipe.hmset(key, {'updated_at': time.time(), 'rate': rate})
+                pipe.execute()
+                increment_metric('push-broadcast-sent', sent)
+                increment_metric('push-broadcast-failed', failed)
+                gauge_metric('push-broadcast-rate', rate)
+
+                if users < PUSH_BROADCAST_PAGE_SIZE:
+                    break
+        except Exception as e:
+            log.error('push_broadcast: broadcast %s failed after user_id %s. e: %s' % (broadcast_id, cursor, e))
+            set_broadcast_status(broadcast_id, BROADCAST_RUNNING, BROADCAST_FAILED)
+            raise
+
+        if not set_broadcast_status(broadcast_id, BROADCAST_RUNNING, BROADCAST_DONE):
+            # cancelled while sending the last page - it's resumed from the checkpoint
+            log.info('push_broadcast: broadcast %s cancelled at user_id %s' % (broadcast_id, cursor))
+            return
+        log.info('push_broadcast: broadcast %s done' % broadcast_id)
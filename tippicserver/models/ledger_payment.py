@@ -0,0 +1,93 @@
+"""a local copy of the payments that touch our users (and our own account), written by the ledger ingester.
+
+lets the tx verification resolve with an indexed lookup instead of a horizon round-trip.
+"""
+import logging as log
+
+from sqlalchemy import text
+
+from tippicserver import db
+
+LEDGER_CURSOR_NAME = 'payments'
+
+
+class LedgerPayment(db.Model):
+    """a single payment op, as streamed from horizon. a tx may hold several of them"""
+    tx_hash = db.Column(db.String(100), nullable=False, primary_key=True)
+    op_index = db.Column(db.Integer(), nullable=False, primary_key=True)  # the op's (1-based) index in its tx
+    paging_token = db.Column(db.String(40), nullable=False)
+    from_address = db.Column(db.String(60), nullable=False)
+    to_address = db.Column(db.String(60), nullable=False)
+    amount = db.Column(db.Numeric(), nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=True)  # the ledger's close time
+    ingested_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+
+    def __repr__(self):
+        return '<tx_hash: %s, op_index: %s, from_address: %s, to_address: %s, amount: %s, created_at: %s>' % \
+               (self.tx_hash, self.op_index, self.from_address, self.to_address, self.amount, self.created_at)
+
+
+class LedgerCursor(db.Model):
+    """the horizon paging token the ingester resumes from"""
+    name = db.Column(db.String(40), nullable=False, primary_key=True)
+    cursor = db.Column(db.String(40), nullable=False)
+    update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
+
+
+def get_ledger_payments(tx_hashes):
+    """returns a dict of tx_hash -> the tx's LedgerPayments (by op_index) for the given tx_hashes that were ingested"""
+    payments = {}
+    if not tx_hashes:
+        return payments
+    for payment in LedgerPayment.query.filter(LedgerPayment.tx_hash.in_(list(tx_hashes))) \
+            .order_by(LedgerPayment.tx_hash, LedgerPayment.op_index).all():
+        payments.setdefault(payment.tx_hash, []).append(payment)
+    return payments
+
+
+def get_ledger_payment(tx_hash):
+    return get_ledger_payments([tx_hash]).get(tx_hash)
+
+
+def get_ledger_cursor(name=LEDGER_CURSOR_NAME):
+    return db.engine.execute(text('select cursor from public.ledger_cursor where name = :name;'), {'name': name}).scalar()
+
+
+def store_ledger_payments(payments, cursor, app_addresses, name=LEDGER_CURSOR_NAME):
+    """stores the payments that touch our users or app_addresses, and advances the cursor - in a single statement.
+
+    payments is a list of dicts with the LedgerPayment columns. returns the number of payments stored.
+    """
+    params = {'name': name, 'cursor': cursor, 'app_addresses': list(app_addresses)}
+    if not payments:
+        db.engine.execute(text('''insert into public.ledger_cursor (name, cursor) values (:name, :cursor)
+                                  on conflict (name) do update set cursor = excluded.cursor, update_at = now();'''), params)
+        return 0
+
+    values = []
+    for index, payment in enumerate(payments):
+        values.append('(:tx_hash_%(i)s, cast(:op_index_%(i)s as integer), :paging_token_%(i)s, :from_address_%(i)s, '
+                      ':to_address_%(i)s, cast(:amount_%(i)s as numeric), cast(:created_at_%(i)s as timestamp with time zone))'
+                      % {'i': index})
+        for column in ('tx_hash', 'op_index', 'paging_token', 'from_address', 'to_address', 'amount', 'created_at'):
+            params['%s_%s' % (column, index)] = payment[column]
+
+    # the filter is an indexed lookup on user.public_address per payment. the sharded users' addresses are looked up
+    # in the user directory, which is on this (the default) db
+    users_table = 'public.user_directory' if db.router else 'public.user'
+    statement = '''with payments (tx_hash, op_index, paging_token, from_address, to_address, amount, created_at) as (values %s),
+                   stored as (insert into public.ledger_payment (tx_hash, op_index, paging_token, from_address, to_address, amount, created_at)
+                              select p.* from payments p
+                              where p.from_address = any(:app_addresses) or p.to_address = any(:app_addresses)
+                              or exists (select 1 from %s u where u.public_address in (p.from_address, p.to_address))
+                              on conflict (tx_hash, op_index) do nothing
+                              returning tx_hash),
+                   advanced as (insert into public.ledger_cursor (name, cursor) values (:name, :cursor)
+                                on conflict (name) do update set cursor = excluded.cursor, update_at = now()
+                                returning cursor)
+                   select (select count(*) from stored), (select cursor from advanced);''' % (', '.join(values), users_table)
+    try:
+        return db.engine.execute(text(statement).execution_options(autocommit=True), params).scalar()
+    except Exception as e:
+        log.error('store_ledger_payments: cant store %s payments up to cursor %s. e: %s' % (len(payments), cursor, e))
+        raise
@@ -0,0 +1,225 @@
+"""onboarding jobs: creating the user's account and sending the onboarding gift, off the request thread.
+
+/user/onboard records a job per user_id and enqueues it on the fast queue. the job's progress is persisted
+in the onboarding_job table, so a job that is retried - after a worker crash, or by the client calling
+/user/onboard again - resumes where it stopped: the account isn't re-created and the gift is sent at most
+once (the payout is idempotent by user_id, and a stored gift marks the user as onboarded).
+
+the job doesn't wait for the gift: it queues the payout and stays running. the payout engine then calls
+complete_onboarding_gift, which marks the user as onboarded and the job as done (or failed).
+"""
+import logging as log
+import uuid
+
+import redis_lock
+from sqlalchemy import text
+from sqlalchemy_utils import UUIDType
+
+from tippicserver import db, app, config
+from tippicserver.utils import InvalidUsage, GIFT, increment_metric
+
+ONBOARDING_QUEUED = 'queued'
+ONBOARDING_RUNNING = 'running'
+ONBOARDING_DONE = 'done'
+ONBOARDING_FAILED = 'failed'
+ONBOARDING_STALE_SECS = 5 * 60  # a running job that didn't progress for this long is assumed dead
+ONBOARDING_JOB_TIMEOUT_SECS = 120
+
+
+class OnboardingJob(db.Model):
+    """the state of the user's onboarding"""
+    # not a foreign key: the user may live on another shard
+    user_id = db.Column('user_id', UUIDType(binary=False), primary_key=True, nullable=False)
+    public_address = db.Column(db.String(60), nullable=False)
+    token = db.Column(UUIDType(binary=False), nullable=False)  # returned to the client for polling
+    status = db.Column(db.String(10), nullable=False, default=ONBOARDING_QUEUED)
+    account_created = db.Column(db.Boolean, nullable=False, default=False)
+    attempts = db.Column(db.Integer(), nullable=False, default=0)
+    error = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+    update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
+
+    def __repr__(self):
+        return '<user_id: %s, public_address: %s, status: %s, account_created: %s, attempts: %s, error: %s>' % \
+               (self.user_id, self.public_address, self.status, self.account_created, self.attempts, self.error)
+
+
+def get_onboarding_job(user_id):
+    """returns the user's onboarding job as a row (not an orm object, so it's never stale), or None"""
+    return db.engine.execute(text('''select *, extract(epoch from now() - update_at) as idle_secs
+                                     from public.onboarding_job where user_id = :user_id;'''),
+                             {'user_id': str(user_id)}).first()
+
+
+def start_onboarding(user_id, public_address):
+    """records an onboarding job for the user and enqueues it. idempotent: returns the existing job's
+    (token, status) if one is already in progress or done, and restarts failed or stale ones
+    """
+    job = get_onboarding_job(user_id)
+    if job is not None and job['public_address'] != public_address:
+        raise InvalidUsage('already onboarding user_id %s with a different address' % user_id)
+
+    if job is None:
+        try:
+            db.engine.execute(text('''insert into public.onboarding_job (user_id, public_address, token, status, account_created, attempts)
+                                      values (:user_id, :public_address, :token, :queued, false, 0)
+                                      on conflict (user_id) do nothing;'''),
+                              {'user_id': str(user_id), 'public_address': public_address, 'token': str(uuid.uuid4()),
+                               'queued': ONBOARDING_QUEUED})
+        except Exception as e:
+            log.error('start_onboarding: cant record the job for user_id %s. e: %s' % (user_id, e))
+            raise
+        job = get_onboarding_job(user_id)
+        enqueue_onboarding_job(user_id)
+    elif job['status'] == ONBOARDING_FAILED or \
+            (job['status'] in (ONBOARDING_QUEUED, ONBOARDING_RUNNING) and job['idle_secs'] > ONBOARDING_STALE_SECS):
+        restart_onboarding_job(user_id)
+        job = get_onboarding_job(user_id)
+
+    return str(job['token']), job['status']
+
+
+def restart_onboarding_job(user_id):
+    log.info('restarting the onboarding job of user_id %s' % user_id)
+    db.engine.execute(text('''update public.onboarding_job set status = :queued, error = null, update_at = now()
+                              where user_id = :user_id;'''), {'queued': ONBOARDING_QUEUED, 'user_id': str(user_id)})
+    enqueue_onboarding_job(user_id)
+
+
+def enqueue_onboarding_job(user_id):
+    if config.ONBOARDING_INLINE:
+        onboarding_job(str(user_id))
+    else:
+        app.rq_fast.enqueue_call(func=onboarding_job, args=(str(user_id),), timeout=ONBOARDING_JOB_TIMEOUT_SECS)
+
+
+def get_onboarding_status(user_id, token=None):
+    """returns the status of the user's onboarding, restarting it if it went stale. None if there's no such job"""
+    job = get_onboarding_job(user_id)
+    if job is None or (token is not None and str(job['token']) != token):
+        return None
+    if job['status'] in (ONBOARDING_QUEUED, ONBOARDING_RUNNING) and job['idle_secs'] > ONBOARDING_STALE_SECS:
+        restart_onboarding_job(user_id)
+        return ONBOARDING_QUEUED
+    return job['status']
+
+
+def set_onboarding_job(user_id, status=None, account_created=None, error=None):
+    db.engine.execute(text('''update public.onboarding_job set status = coalesce(:status, status),
+                              account_created = coalesce(:account_created, account_created),
+                              error = :error, update_at = now() where user_id = :user_id;'''),
+                      {'status': status, 'account_created': account_created, 'error': error, 'user_id': str(user_id)})
+
+
+def claim_onboarding_job(user_id):
+    """marks the job as running, unless it's done or running elsewhere. returns the job row or None"""
+    return db.engine.execute(text('''update public.onboarding_job set status = :running, attempts = attempts + 1, update_at = now()
+                                     where user_id = :user_id and (status = :queued or (status = :running and update_at < now() - make_interval(secs => :stale)))
+                                     returning *;'''),
+                             {'running': ONBOARDING_RUNNING, 'queued': ONBOARDING_QUEUED, 'user_id': str(user_id),
+                              'stale': ONBOARDING_STALE_SECS}).first()
+
+
+def has_onboarding_gift(user_id):
+    """returns True if the user's onboarding gift was already stored"""
+    from .tip_totals import get_total, SCOPE_USER_TX_TYPE, user_tx_type_key
+    return get_total(SCOPE_USER_TX_TYPE, user_tx_type_key(user_id, GIFT)) > 0
+
+
+def award_user(user_id, public_address):
+    """awards the user the onboarding gift (once per phone number). returns True if the user is onboarded,
+    None if the gift was queued - complete_onboarding_gift is called once it's sent - and False on failure
+    """
+    from tippicserver.payouts import enqueue_payout, get_payout_result, PAYOUT_SENT
+    from tippicserver.stellar import get_initial_reward
+    from .user import get_associated_user_ids, is_onboarded, set_onboarded
+
+    reward = get_initial_reward()
+
+    for other_id in get_associated_user_ids(user_id):
+        if is_onboarded(other_id):
+            set_onboarded(user_id, True, public_address)
+            print('user %s with same phone number has been previously awarded %d Kin. Will not award again' % (other_id, reward))
+            return True
+
+    if has_onboarding_gift(user_id):
+        # a previous attempt sent the gift but didn't get to mark the user
+        set_onboarded(user_id, True, public_address)
+        return True
+
+    try:
+        # sent by the payout engine, batched with the other gifts. the engine stores the tx.
+        # the payout id keeps a retried onboarding from sending another gift
+        payout_id = 'onboarding-gift:%s' % user_id
+        if not enqueue_payout(payout_id, user_id, public_address, reward, GIFT, "onboarding-gift",
+                              on_complete='tippicserver.models.onboarding.complete_onboarding_gift'):
+            result = get_payout_result(payout_id)
+            if result and result['status'] == PAYOUT_SENT:
+                set_onboarded(user_id, True, public_address)
+                return True
+            # still in flight - its on_complete completes the job
+        return None
+    except Exception as e2:
+        print('exception %s trying to send kin to user ' % e2)
+        return False
+
+
+def complete_onboarding_gift(payout_id, user_id, public_address, status):
+    """the on_complete of the onboarding gift's payout: completes the user's onboarding job"""
+    from tippicserver.payouts import PAYOUT_SENT
+    from .user import set_onboarded
+
+    if status == PAYOUT_SENT:
+        set_onboarded(user_id, True, public_address)
+        set_onboarding_job(user_id, status=ONBOARDING_DONE)
+        increment_metric('user_onboarded')
+        print('sent the onboarding gift of user %s (payout %s)' % (user_id, payout_id))
+    else:
+        set_onboarding_job(user_id, status=ONBOARDING_FAILED, error='award-failed')
+        increment_metric('onboarding-failed')
+        print('unable to send the onboarding gift of user %s (payout %s)' % (user_id, payout_id))
+
+
+def onboarding_job(user_id):
+    """creates the user's account (if needed) and awards the user. meant to run on the fast queue"""
+    from tippicserver.stellar import active_account_exists, create_account
+
+    job = claim_onboarding_job(user_id)
+    if job is None:
+        print('onboarding_job: job for user_id %s is done or already running' % user_id)
+        return
+
+    public_address = job['public_address']
+    # don't race a concurrent (legacy) onboarding of the same address
+    lock = redis_lock.Lock(app.redis, 'address:%s' % public_address)
+    if not lock.acquire(blocking=False):
+        set_onboarding_job(user_id, status=ONBOARDING_QUEUED)
+        print('onboarding_job: address %s is locked - will be retried' % public_address)
+        return
+
+    try:
+        if not job['account_created']:
+            if not active_account_exists(public_address):
+                print('creating account with address %s and amount %s' % (public_address, config.STELLAR_INITIAL_ACCOUNT_BALANCE))
+                if not create_account(public_address, config.STELLAR_INITIAL_ACCOUNT_BALANCE):
+                    set_onboarding_job(user_id, status=ONBOARDING_FAILED, error='create-account-failed')
+                    increment_metric('onboarding-failed')
+                    return
+            set_onboarding_job(user_id, account_created=True)
+
+        awarded = award_user(user_id, public_address)
+        if awarded is None:
+            # the gift is on its way - complete_onboarding_gift completes the job
+            return
+        if not awarded:
+            set_onboarding_job(user_id, status=ONBOARDING_FAILED, error='award-failed')
+            increment_metric('onboarding-failed')
+            return
+
+        set_onboarding_job(user_id, status=ONBOARDING_DONE)
+        increment_metric('user_onboarded')
+    except Exception as e:
+        log.error('onboarding_job: failed to onboard user_id %s. e: %s' % (user_id, e))
+        set_onboarding_job(user_id, status=ONBOARDING_FAILED, error=str(e)[:100])
+    finally:
+        lock.release()
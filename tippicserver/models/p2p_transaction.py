@@ -6,20 +6,27 @@ from sqlalchemy import desc
 import arrow
 
 from tippicserver import db
+from tippicserver.replica import pin_to_primary
+from tippicserver.utils import db_transaction
+from .tip_totals import increment_totals, p2p_tx_totals_items
 
 
 class P2PTransaction(db.Model):
     """
     p2p transactions: between users
     """
-    sender_user_id = db.Column('sender_user_id', UUIDType(binary=False), db.ForeignKey("user.user_id"), unique=False, nullable=False)
-    receiver_user_id = db.Column('receiver_user_id', UUIDType(binary=False), db.ForeignKey("user.user_id"), unique=False, nullable=False)
+    # not foreign keys: the users may live on other shards
+    sender_user_id = db.Column('sender_user_id', UUIDType(binary=False), unique=False, nullable=False)
+    receiver_user_id = db.Column('receiver_user_id', UUIDType(binary=False), unique=False, nullable=False)
     tx_hash = db.Column(db.String(100), nullable=False, primary_key=True)
     amount = db.Column(db.Integer(), nullable=False, primary_key=False)
-    sender_address = db.Column(db.String(60), db.ForeignKey("user.public_address"), nullable=False, unique=False)
-    receiver_address = db.Column(db.String(60), db.ForeignKey("user.public_address"), nullable=False, unique=False)
+    sender_address = db.Column(db.String(60), nullable=False, unique=False)
+    receiver_address = db.Column(db.String(60), nullable=False, unique=False)
     update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
 
+    __table_args__ = (db.Index('ix_p2_p_transaction_sender_user_id_update_at', 'sender_user_id', 'update_at'),
+                      db.Index('ix_p2_p_transaction_receiver_user_id_update_at', 'receiver_user_id', 'update_at'),)
+
     def __repr__(self):
         return '<p2ptx_hash: %s, sender_user_id: %s, receiver_user_id: %s, ' \
                'amount: %s, sender_address: %s, receiver_address: %s, update_at: %s>' % (self.tx_hash, self.sender_user_id, self.receiver_user_id,
@@ -28,28 +35,34 @@ class P2PTransaction(db.Model):
 
 def list_p2p_transactions_for_user_id(user_id, max_txs=None):
     """returns all p2p txs by this user - or the last x tx if max_txs was passed"""
-    sender_txs = P2PTransaction.query.filter(P2PTransaction.sender_user_id == user_id).order_by(desc(P2PTransaction.update_at)).all()
-    receiver_txs = P2PTransaction.query.filter(P2PTransaction.receiver_user_id == user_id).order_by(desc(P2PTransaction.update_at)).all()
+    sender_txs = P2PTransaction.query.filter(P2PTransaction.sender_user_id == user_id).order_by(desc(P2PTransaction.update_at))
+    receiver_txs = P2PTransaction.query.filter(P2PTransaction.receiver_user_id == user_id).order_by(desc(P2PTransaction.update_at))
+    if max_txs:
+        sender_txs = sender_txs.limit(max_txs)
+        receiver_txs = receiver_txs.limit(max_txs)
+    sender_txs = sender_txs.all()
+    receiver_txs = receiver_txs.all()
     # join and trim the amount of txs
-    txs = receiver_txs + sender_txs
-    txs = txs[:max_txs] if max_txs and max_txs > len(txs) else txs
+    txs = sorted(receiver_txs + sender_txs, key=lambda tx: tx.update_at, reverse=True)
+    txs = txs[:max_txs] if max_txs else txs
     return txs
 
 
 def create_p2p_tx(tx_hash, sender_user_id, receiver_user_id, sender_address, receiver_address, amount):
     """create a p2p transaction object and store in the db."""
+    amount = int(amount)
     try:
-        tx = P2PTransaction()
-        tx.tx_hash = tx_hash
-        tx.sender_user_id = sender_user_id
-        tx.receiver_user_id = receiver_user_id
-        tx.amount = int(amount)
-        tx.sender_address = sender_address
-        tx.receiver_address = receiver_address
-        db.session.add(tx)
-        db.session.commit()
+        # the tx and the totals are written in one explicit transaction - the prod engine autocommits every
+        # statement otherwise. a duplicate tx fails the insert, before the totals are touched
+        with db_transaction() as conn:
+            conn.execute(P2PTransaction.__table__.insert().values(
+                tx_hash=tx_hash, sender_user_id=sender_user_id, receiver_user_id=receiver_user_id, amount=amount,
+                sender_address=sender_address, receiver_address=receiver_address))
+            increment_totals(conn, p2p_tx_totals_items(sender_user_id, receiver_user_id), amount)
     except Exception as e:
         log.error('cant add p2ptx to db with id %s. e:%s' % (tx_hash, e))
+    else:
+        pin_to_primary(db.session())
 
 
 def format_p2p_tx_dict(tx_hash, amount, format_for_receiver):
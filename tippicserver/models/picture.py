@@ -1,15 +1,31 @@
+import copy
 import json
+import logging as log
+import time
 
-from tippicserver import db
+from tippicserver import db, app, config
+from tippicserver.replica import read_only
 from tippicserver.models import SystemConfig, User, UUIDType, get_user_app_data, Transaction
 from tippicserver.utils import InvalidUsage
 from tippicserver.models.user import get_address_by_userid, set_username, get_user
 
+# the current picture only changes when the picture index is advanced (or pictures are added/disabled),
+# so it is served from a pre-serialized record: first from the worker's memory, then from redis.
+# the redis record is keyed by a version that every invalidation bumps, so a load that started before an
+# invalidation can't cache the previous picture under the new version.
+CURRENT_PICTURE_VERSION_KEY = 'current-picture-version'
+CURRENT_PICTURE_CACHE_KEY = 'current-picture:%s'
+CURRENT_PICTURE_REDIS_TTL_SECS = 60
+CURRENT_PICTURE_LOCAL_TTL_SECS = 5  # other workers converge within this window after an invalidation
+
+_current_picture_local_cache = {}
+_current_picture_local_version = [0]  # bumped by this worker's invalidations
+
 
 class ReportedPictures(db.Model):
     picture_id = db.Column(db.String(40), nullable=False, primary_key=True)
-    reporter_id = db.Column('user_id', UUIDType(binary=False), db.ForeignKey("user.user_id"), primary_key=True,
-                            nullable=False)
+    # not a foreign key: the reporter may live on another shard
+    reporter_id = db.Column('user_id', UUIDType(binary=False), primary_key=True, nullable=False)
     update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
 
 
@@ -37,12 +53,15 @@ class Picture(db.Model):
     the represents a single picture
     """
     picture_id = db.Column(db.String(40), nullable=False, primary_key=True)
-    picture_order_index = db.Column(db.Integer(), nullable=False, primary_key=False)
+    picture_order_index = db.Column(db.Integer(), nullable=False, primary_key=False, index=True)
     title = db.Column(db.String(80), nullable=False, primary_key=False)
     image_url = db.Column(db.String(200), nullable=False, primary_key=False)
     author = db.Column(db.JSON)
     update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
     is_active = db.Column(db.Boolean, unique=False, default=True)
+    tips_sum = db.Column(db.Integer(), nullable=False, default=0, server_default='0')  # maintained by create_tx
+
+    __table_args__ = (db.Index('ix_picture_author_user_id', db.text("(author ->> 'user_id')")),)
 
     def __repr__(self):
         return '<picture_id: %s, ' \
@@ -61,7 +80,7 @@ def picture_to_json(picture):
     picture_json['picture_id'] = picture.picture_id
     picture_json['title'] = picture.title
     picture_json['image_url'] = picture.image_url
-    picture_json['author'] = picture.author
+    picture_json['author'] = dict(picture.author)
 
     # add picture author name
     user = User.query.filter_by(user_id=picture.author['user_id']).first()
@@ -74,27 +93,55 @@ def picture_to_json(picture):
 def get_pictures_summery(user_id):
     """ return a list of shown pictures and tips sum for each"""
 
-    # get current shown picture order index
-    # loop from 0 to index
-    # for each get - if picture author is this user - get the id
-    # for each id, sum tips from transactions table
-    system_config = SystemConfig.query.first()
-    if system_config is not None:
-        current_picture_index = system_config.current_picture_index
-        pictures = Picture.query.filter(Picture.picture_order_index <= current_picture_index).all()
-        user_pictures = [picture_to_json(item) for item in pictures if item.author['user_id'] == user_id]
-        for picture in user_pictures:
-            total = db.engine.execute(
-                "select sum(amount) as total from Transaction where tx_for_item_id = '%s'" % picture['picture_id'])
-            picture['tips_sum'] = total.first()['total'] or 0
-        return user_pictures
-    return []
-
-
-def get_picture_for_user(user_id):
-    """ get next picture for this user"""
+    # a single query: the user's pictures up to the current picture index, with the author name
+    # and the tips sum for each - either summed from the transactions or read from the materialized counter
+    if config.PICTURE_TIPS_SUM_MATERIALIZED:
+        tips_sum_select = 'p.tips_sum'
+        tips_sum_join = ''
+    else:
+        tips_sum_select = 'coalesce(tips.total, 0)'
+        tips_sum_join = 'left join lateral (select sum(t.amount) as total from public.transaction t ' \
+                        'where t.tx_for_item_id = p.picture_id) tips on true'
+
+    # the pictures are all the user's - when the users are sharded, the user's name is read from its shard
+    if db.router:
+        username_select = 'null'
+        user_join = ''
+    else:
+        username_select = 'u.username'
+        user_join = "left join public.user u on u.user_id = cast(p.author ->> 'user_id' as uuid)"
+
+    prep_stat = """select p.picture_id, p.title, p.image_url, p.author, %s as username, %s as tips_sum
+                   from public.picture p
+                   %s
+                   %s
+                   where p.author ->> 'user_id' = %%s
+                   and p.picture_order_index <= (select current_picture_index from public.system_config limit 1)
+                   order by p.picture_order_index;""" % (username_select, tips_sum_select, user_join, tips_sum_join)
+
+    rows = db.engine.execute(prep_stat, (str(user_id),)).fetchall()
+    sharded_username = None
+    if db.router and rows:
+        user = User.query.filter_by(user_id=user_id).first()
+        sharded_username = user.username if user else None
+
+    user_pictures = []
+    for row in rows:
+        author = dict(row['author'])
+        username = row['username'] if row['username'] is not None else sharded_username
+        if username is not None:
+            author['name'] = username
+        user_pictures.append({'picture_id': row['picture_id'],
+                              'title': row['title'],
+                              'image_url': row['image_url'],
+                              'author': author,
+                              'tips_sum': row['tips_sum'] or 0})
+    return user_pictures
+
+
+def load_current_picture():
+    """reads the current picture from the db and serializes it. initializes the picture index on first use"""
     system_config = SystemConfig.query.first()
-    user_app_data = get_user_app_data(user_id)
 
     if system_config is None:
         # deliver the first image in the order
@@ -102,10 +149,6 @@ def get_picture_for_user(user_id):
         # we might not have images in the db at all
         if new_picture is None:
             return {}
-        # if user is blocked, return error message
-        if user_app_data and user_app_data.blocked_users \
-                and new_picture.author['user_id'] in user_app_data.blocked_users:
-            return {"blocked": True}
 
         try:
             # store the delivered image information
@@ -115,22 +158,80 @@ def get_picture_for_user(user_id):
             db.session.commit()
         except Exception as e:
             print(e)
-            print('cant get_picture_for_user with user_id %s' % user_id)
+            print('cant initialize the current picture index')
             return {}
-        return picture_to_json(new_picture)
     else:
-        # TODO: cache this
         # deliver the current picture
         new_picture = Picture.query.filter_by(picture_order_index=system_config.current_picture_index).first()
 
-        if not new_picture:
-            return {}
+    return picture_to_json(new_picture)
+
+
+def get_current_picture():
+    """returns the serialized current picture - from the worker's memory, redis or the db (in that order).
+    always reads the db's primary: the picture is cached for all the users, and may be initialized here
+    """
+    now = time.time()
+    local_version = _current_picture_local_version[0]
+    cached = _current_picture_local_cache.get(local_version)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    picture, version = None, None
+    try:
+        version = int(app.redis.get(CURRENT_PICTURE_VERSION_KEY) or 0)
+        data = app.redis.get(CURRENT_PICTURE_CACHE_KEY % version)
+        if data:
+            picture = json.loads(data.decode())
+    except Exception as e:
+        log.error('get_current_picture: cant read the current picture from redis. e: %s' % e)
+
+    if picture is None:
+        picture = load_current_picture()
+        if not picture:
+            # no pictures yet, or the load failed - not worth caching
+            return picture
+        if version is not None:
+            try:
+                app.redis.setex(CURRENT_PICTURE_CACHE_KEY % version, CURRENT_PICTURE_REDIS_TTL_SECS, json.dumps(picture))
+            except Exception as e:
+                log.error('get_current_picture: cant write the current picture to redis. e: %s' % e)
+
+    if _current_picture_local_version[0] == local_version:
+        _current_picture_local_cache[local_version] = (now + CURRENT_PICTURE_LOCAL_TTL_SECS, picture)
+    return picture
+
+
+def invalidate_current_picture_cache():
+    """drops the cached current picture. call whenever the current picture may have changed"""
+    _current_picture_local_version[0] += 1
+    _current_picture_local_cache.clear()
+    try:
+        app.redis.incr(CURRENT_PICTURE_VERSION_KEY)
+    except Exception as e:
+        log.error('invalidate_current_picture_cache: cant bump the current picture version in redis. e: %s' % e)
+
+
+@read_only
+def get_user_app_data_for_picture(user_id):
+    """the user's app data, which may be read from the replica - unlike the current picture"""
+    return get_user_app_data(user_id)
+
+
+def get_picture_for_user(user_id):
+    """ get next picture for this user"""
+    user_app_data = get_user_app_data_for_picture(user_id)
+    picture = get_current_picture()
+    if not picture:
+        return {}
 
-        if user_app_data and user_app_data.blocked_users \
-                and new_picture.author['user_id'] in user_app_data.blocked_users:
-            return {"blocked": True}
+    # if user is blocked, return error message
+    if user_app_data and user_app_data.blocked_users \
+            and picture['author']['user_id'] in user_app_data.blocked_users:
+        return {"blocked": True}
 
-        return picture_to_json(new_picture)
+    # callers get their own copy - the cached record is shared
+    return copy.deepcopy(picture)
 
 
 def set_picture_active(picture_id, is_active):
@@ -147,6 +248,7 @@ def set_picture_active(picture_id, is_active):
         print('cant set_picture_active with picture_id %s' % picture_id)
         return False
 
+    invalidate_current_picture_cache()
     return True
 
 
@@ -195,4 +297,5 @@ def add_picture(picture_json, set_active=True):
     else:
         if set_active:
             set_picture_active(picture.picture_id, True)
+        invalidate_current_picture_cache()
         return True
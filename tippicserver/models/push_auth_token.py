@@ -134,6 +134,11 @@ def should_send_auth_token(user_id):
 
 def is_user_authenticated(user_id):
     """returns True if the user is currently authenticated"""
+    from .user_context import get_user_context
+    context = get_user_context(user_id)
+    if context and context.push_auth_token is not None:
+        return context.push_auth_token.authenticated
+
     token_obj = get_token_obj_by_user_id(user_id)
     return token_obj.authenticated
 
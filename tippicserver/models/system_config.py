@@ -1,8 +1,14 @@
-from tippicserver import db
+from tippicserver import db, config
+import functools
 import logging as log
+import time
 from tippicserver.utils import InvalidUsage, OS_ANDROID, OS_IOS
 from distutils.version import LooseVersion
 
+VERSION_POLICY_LOCAL_TTL_SECS = 60  # other workers pick up set_*_below writes within this time
+CLIENT_CONFIG_PAYLOADS_MAX = 1000  # app_ver comes from the client - dont let it grow the cache unbounded
+_version_policy_local_cache = {}
+
 
 class SystemConfig(db.Model):
     """SytemConfig is a table with various configuration options that are coded into the db"""
@@ -24,9 +30,11 @@ def skip_picture_wait(skip_by):
     except Exception as e:
         print(e)
         raise InvalidUsage('cant set task result ts')
+    else:
+        from .picture import invalidate_current_picture_cache
+        invalidate_current_picture_cache()
 
 
-#TODO cache this to sace sql access
 def get_system_config():
     try:
         return db.session.query(SystemConfig).one()
@@ -35,6 +43,110 @@ def get_system_config():
         return None
 
 
+@functools.lru_cache(maxsize=1024)
+def parse_version(version):
+    """returns the given version string as a tuple that compares like LooseVersion. there are only a few
+    distinct versions in the field, so each is parsed once
+    """
+    return tuple(LooseVersion(version).version)
+
+
+class VersionPolicy(object):
+    """the client-version thresholds per os, from the system config and config.BLOCK_ONBOARDING_*, pre-parsed"""
+
+    def __init__(self, sysconfig):
+        def threshold(version):
+            # a missing threshold never applies
+            return parse_version(version) if version else None
+
+        if sysconfig:
+            self.force_update_below = {OS_ANDROID: threshold(sysconfig.block_clients_below_version_android),
+                                       OS_IOS: threshold(sysconfig.block_clients_below_version_ios)}
+            self.update_available_below = {OS_ANDROID: threshold(sysconfig.update_available_below_version_android),
+                                           OS_IOS: threshold(sysconfig.update_available_below_version_ios)}
+        else:
+            self.force_update_below = {OS_ANDROID: threshold('0'), OS_IOS: threshold('0')}
+            self.update_available_below = {OS_ANDROID: threshold('0'), OS_IOS: threshold('0')}
+        self.block_onboarding_up_to = {OS_ANDROID: threshold(config.BLOCK_ONBOARDING_ANDROID_VERSION),
+                                       OS_IOS: threshold(config.BLOCK_ONBOARDING_IOS_VERSION)}
+        # (on_register, os_type, app_ver) -> serialized config response. lives and dies with the policy
+        self.client_config_payloads = {}
+
+    @staticmethod
+    def _below(thresholds, os_type, app_ver, inclusive=False):
+        threshold = thresholds.get(os_type)
+        if threshold is None or app_ver is None:
+            return False
+        version = parse_version(app_ver)
+        return version <= threshold if inclusive else version < threshold
+
+    def should_force_update(self, os_type, app_ver):
+        return self._below(self.force_update_below, os_type, app_ver)
+
+    def is_update_available(self, os_type, app_ver):
+        return self._below(self.update_available_below, os_type, app_ver)
+
+    def should_block_onboarding(self, os_type, app_ver):
+        """older clients can't onboard, verify their phone or backup"""
+        return self._below(self.block_onboarding_up_to, os_type, app_ver, inclusive=True)
+
+
+def get_version_policy():
+    """returns the VersionPolicy from the worker's memory, or builds it from the db"""
+    now = time.time()
+    cached = _version_policy_local_cache.get('policy')
+    if cached and cached[0] > now:
+        return cached[1]
+
+    policy = VersionPolicy(get_system_config())
+    _version_policy_local_cache['policy'] = (now + VERSION_POLICY_LOCAL_TTL_SECS, policy)
+    return policy
+
+
+def build_client_config(policy, os_type, app_ver, on_register=False):
+    """returns the config for clients with the given os_type and app_ver, based on the global config"""
+    from tippicserver.utils import get_global_config
+    global_config = get_global_config()
+
+    # turn off phone verification (and the backup nag) for older clients:
+    if policy.should_block_onboarding(os_type, app_ver):
+        global_config['phone_verification_enabled'] = False
+        global_config['backup_nag'] = False
+
+    if not on_register:
+        global_config['backup_nag'] = False
+        if policy.should_force_update(os_type, app_ver):
+            global_config['force_update'] = True
+        if policy.is_update_available(os_type, app_ver):
+            global_config['is_update_available'] = True
+
+    return global_config
+
+
+def get_client_config_payload(os_type, app_ver, on_register=False):
+    """returns the serialized {status: ok, config: ...} response for clients with the given os_type and app_ver.
+
+    there are only a handful of distinct (os_type, app_ver) pairs in the field, so each payload is built and
+    serialized once per VersionPolicy - a new policy (any config input changed) starts with an empty cache
+    """
+    from flask import json
+    policy = get_version_policy()
+    key = (on_register, os_type, app_ver)
+    payload = policy.client_config_payloads.get(key)
+    if payload is None:
+        client_config = build_client_config(policy, os_type, app_ver, on_register)
+        log.info('client config for os_type %s, app_ver %s, on_register %s: %s' % (os_type, app_ver, on_register, client_config))
+        payload = (json.dumps({'status': 'ok', 'config': client_config}, separators=(',', ':')) + '\n').encode('utf-8')
+        if len(policy.client_config_payloads) < CLIENT_CONFIG_PAYLOADS_MAX:
+            policy.client_config_payloads[key] = payload
+    return payload
+
+
+def invalidate_version_policy():
+    """drops this worker's cached VersionPolicy. call whenever the version thresholds change"""
+    _version_policy_local_cache.clear()
+
+
 def get_block_clients_below_version(os_type):
     sysconfig = get_system_config()
     if not sysconfig:
@@ -62,19 +174,11 @@ def update_available_below_version(os_type):
 
 
 def should_force_update(os, app_ver):
-    if os == OS_ANDROID and LooseVersion(app_ver) < LooseVersion(get_block_clients_below_version(OS_ANDROID)):
-            return True
-    elif os == OS_IOS and LooseVersion(app_ver) < LooseVersion(get_block_clients_below_version(OS_IOS)):
-            return True
-    return False
+    return get_version_policy().should_force_update(os, app_ver)
 
 
 def is_update_available(os, app_ver):
-    if os == OS_ANDROID and LooseVersion(app_ver) < LooseVersion(update_available_below_version(OS_ANDROID)):
-            return True
-    elif os == OS_IOS and LooseVersion(app_ver) < LooseVersion(update_available_below_version(OS_IOS)):
-            return True
-    return False
+    return get_version_policy().is_update_available(os, app_ver)
 
 
 def set_force_update_below(os_type, app_ver):
@@ -91,6 +195,7 @@ def set_force_update_below(os_type, app_ver):
         sysconfig.block_clients_below_version_ios = app_ver
     db.session.add(sysconfig)
     db.session.commit()
+    invalidate_version_policy()
     log.info('set force-update-below for os_type %s to %s' % (os_type, app_ver))
 
 
@@ -108,6 +213,7 @@ def set_update_available_below(os_type, app_ver):
         sysconfig.update_available_below_version_ios = app_ver
     db.session.add(sysconfig)
     db.session.commit()
+    invalidate_version_policy()
     log.info('set update-available-below for os_type %s to %s' % (os_type, app_ver))
 
 
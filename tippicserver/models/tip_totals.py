@@ -0,0 +1,158 @@
+"""running kin totals, kept up to date by the tx writers so that reading a total is a primary-key lookup"""
+import logging as log
+
+from sqlalchemy import text, tuple_
+
+from tippicserver import db
+from tippicserver.utils import GIFT, PICTURE, gauge_metric
+
+SCOPE_TX_TYPE = 'tx_type'  # key: tx_type. global totals per tx type
+SCOPE_USER_TX_TYPE = 'user_tx_type'  # key: user_id:tx_type. the user's txs per tx type
+SCOPE_ADDRESS_TIPS_RECEIVED = 'address_tips'  # key: to_address. tips received by an address
+SCOPE_P2P_SENT = 'p2p_sent'  # key: sender user_id
+SCOPE_P2P_RECEIVED = 'p2p_received'  # key: receiver user_id
+
+
+class TipTotal(db.Model):
+    """a single running total: the sum and count of the txs in the given scope and key"""
+    scope = db.Column(db.String(20), primary_key=True, nullable=False)
+    key = db.Column(db.String(100), primary_key=True, nullable=False)
+    total = db.Column(db.BigInteger(), nullable=False, default=0)
+    count = db.Column(db.Integer(), nullable=False, default=0)
+    update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
+
+    def __repr__(self):
+        return '<scope: %s, key: %s, total: %s, count: %s, update_at: %s>' % \
+               (self.scope, self.key, self.total, self.count, self.update_at)
+
+
+def user_tx_type_key(user_id, tx_type):
+    return '%s:%s' % (str(user_id).lower(), tx_type)
+
+
+def tx_totals_items(user_id, to_address, tx_type):
+    """returns the (scope, key) pairs a tx contributes to"""
+    items = [(SCOPE_TX_TYPE, tx_type), (SCOPE_USER_TX_TYPE, user_tx_type_key(user_id, tx_type))]
+    if tx_type == PICTURE:
+        items.append((SCOPE_ADDRESS_TIPS_RECEIVED, to_address))
+    return items
+
+
+def p2p_tx_totals_items(sender_user_id, receiver_user_id):
+    """returns the (scope, key) pairs a p2p tx contributes to"""
+    return [(SCOPE_P2P_SENT, str(sender_user_id).lower()), (SCOPE_P2P_RECEIVED, str(receiver_user_id).lower())]
+
+
+def increment_totals(conn, items, amount):
+    """adds the given amount to all the given (scope, key) totals with a single upsert statement.
+
+    executed on the given connection - the caller commits it along with the tx itself.
+    """
+    if not items:
+        return
+    values = []
+    params = {'amount': int(amount)}
+    for index, (scope, key) in enumerate(items):
+        values.append('(:scope_%s, :key_%s, :amount, 1)' % (index, index))
+        params['scope_%s' % index] = scope
+        params['key_%s' % index] = key
+
+    conn.execute(text('''insert into public.tip_total (scope, key, total, count) values %s
+                         on conflict (scope, key) do update set total = tip_total.total + excluded.total,
+                         count = tip_total.count + 1, update_at = now();''' % ', '.join(values)), params)
+
+
+def get_totals(items):
+    """returns a dict of (scope, key) -> total for the given pairs. missing totals are 0"""
+    totals = {item: 0 for item in items}
+    if not items:
+        return totals
+    for row in TipTotal.query.filter(tuple_(TipTotal.scope, TipTotal.key).in_(items)).all():
+        totals[(row.scope, row.key)] = row.total
+    return totals
+
+
+def get_total(scope, key):
+    return get_totals([(scope, key)])[(scope, key)]
+
+
+def get_user_totals(user_id, public_address):
+    """returns the user's in-app kin totals: gifts, tips given/received and p2p sent/received"""
+    user_key = str(user_id).lower()
+    items = {'gifts': (SCOPE_USER_TX_TYPE, user_tx_type_key(user_key, GIFT)),
+             'tips_given': (SCOPE_USER_TX_TYPE, user_tx_type_key(user_key, PICTURE)),
+             'tips_received': (SCOPE_ADDRESS_TIPS_RECEIVED, public_address),
+             'p2p_sent': (SCOPE_P2P_SENT, user_key),
+             'p2p_received': (SCOPE_P2P_RECEIVED, user_key)}
+    totals = get_totals(list(items.values()))
+    return {name: totals[item] for name, item in items.items()}
+
+
+# all the totals, recomputed from the source tables: (scope, key, total, count)
+COMPUTED_TOTALS_QUERY = """
+    select '%(tx_type)s' as scope, tx_type as key, sum(amount) as total, count(*) as count
+        from public.transaction group by tx_type
+    union all
+    select '%(user_tx_type)s', user_id::text || ':' || tx_type, sum(amount), count(*)
+        from public.transaction group by user_id, tx_type
+    union all
+    select '%(address_tips)s', to_address, sum(amount), count(*)
+        from public.transaction where tx_type = '%(picture)s' group by to_address
+    union all
+    select '%(p2p_sent)s', sender_user_id::text, sum(amount), count(*)
+        from public.p2_p_transaction group by sender_user_id
+    union all
+    select '%(p2p_received)s', receiver_user_id::text, sum(amount), count(*)
+        from public.p2_p_transaction group by receiver_user_id
+""" % {'tx_type': SCOPE_TX_TYPE, 'user_tx_type': SCOPE_USER_TX_TYPE, 'address_tips': SCOPE_ADDRESS_TIPS_RECEIVED,
+       'picture': PICTURE, 'p2p_sent': SCOPE_P2P_SENT, 'p2p_received': SCOPE_P2P_RECEIVED}
+
+COMPUTED_PICTURE_TIPS_QUERY = """
+    select p.picture_id, p.tips_sum, coalesce(tips.total, 0) as total from public.picture p
+    left join lateral (select sum(t.amount) as total from public.transaction t where t.tx_for_item_id = p.picture_id) tips on true
+"""
+
+
+def reconcile_tip_totals():
+    """recomputes the totals (and the per-picture tips sums) from the source tables, reports and fixes any drift.
+
+    meant to run on the slow rq queue. also used to backfill the totals after deploying them.
+    the totals are recomputed in a single transaction, so it can't run once the transactions are sharded.
+    """
+    if db.router:
+        log.error('reconcile_tip_totals: the transactions are sharded - cant recompute the totals')
+        return False
+    try:
+        drifted = db.engine.execute("""select c.scope, c.key, c.total, c.count, t.scope as stored_scope, t.key as stored_key,
+                                       t.total as stored_total, t.count as stored_count
+                                       from (%s) c full outer join public.tip_total t on c.scope = t.scope and c.key = t.key
+                                       where coalesce(c.total, 0) <> coalesce(t.total, 0) or coalesce(c.count, 0) <> coalesce(t.count, 0);"""
+                                    % COMPUTED_TOTALS_QUERY).fetchall()
+        picture_drift = db.engine.execute('select count(*) from (%s) c where c.tips_sum <> c.total;'
+                                          % COMPUTED_PICTURE_TIPS_QUERY).scalar()
+    except Exception as e:
+        log.error('reconcile_tip_totals: failed to compute the drift. e: %s' % e)
+        return False
+
+    for row in drifted:
+        log.warning('reconcile_tip_totals: drift in (%s, %s): stored %s/%s, computed %s/%s' % (
+            row['scope'] or row['stored_scope'], row['key'] or row['stored_key'],
+            row['stored_total'], row['stored_count'], row['total'], row['count']))
+
+    # rewrite everything in a single multi-statement query, so it runs as one transaction even in autocommit mode.
+    # concurrent tx writers block on the lock until the rewrite is done
+    rewrite = """lock table public.tip_total in exclusive mode;
+                 delete from public.tip_total;
+                 insert into public.tip_total (scope, key, total, count) select c.scope, c.key, c.total, c.count from (%s) c;
+                 update public.picture p set tips_sum = c.total from (%s) c where p.picture_id = c.picture_id and c.tips_sum <> c.total;
+              """ % (COMPUTED_TOTALS_QUERY, COMPUTED_PICTURE_TIPS_QUERY)
+    try:
+        db.engine.execute(text(rewrite).execution_options(autocommit=True))
+    except Exception as e:
+        log.error('reconcile_tip_totals: failed to store the recomputed totals. e: %s' % e)
+        return False
+
+    log.info('reconcile_tip_totals: %s totals drifted, %s picture tips sums drifted' % (len(drifted), picture_drift))
+    gauge_metric('tip-totals-drift', len(drifted))
+    gauge_metric('picture-tips-sum-drift', picture_drift)
+    return True
@@ -1,10 +1,14 @@
 """The model for the Kin App Server."""
 import logging as log
+from datetime import datetime, timedelta, timezone
 
-from sqlalchemy import desc
+from sqlalchemy import desc, text
 from sqlalchemy_utils import UUIDType
 
 from tippicserver import db, stellar, config
+from tippicserver.replica import read_only, pin_to_primary
+from tippicserver.utils import InvalidUsage, db_transaction
+from .tip_totals import increment_totals, tx_totals_items
 
 
 class Transaction(db.Model):
@@ -16,10 +20,13 @@ class Transaction(db.Model):
                         nullable=False)
     to_address = db.Column(db.String(60), primary_key=False, unique=False, nullable=False)
     amount = db.Column(db.Integer(), nullable=False, primary_key=False)
-    tx_for_item_id = db.Column(db.String(100), nullable=False, primary_key=False)
+    tx_for_item_id = db.Column(db.String(100), nullable=False, primary_key=False, index=True)
     tx_type = db.Column(db.String(20), primary_key=False, unique=False, nullable=False)
     update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
 
+    __table_args__ = (db.Index('ix_transaction_user_id_update_at', 'user_id', 'update_at'),
+                      db.Index('ix_transaction_to_address_tx_type_update_at', 'to_address', 'tx_type', 'update_at'),)
+
     def __repr__(self):
         return '<tx_hash: %s, type: %s, user_id: %s, amount: %s, to_address: %s, tx_for_item_id: %s,  update_at: %s>' % \
                (self.tx_hash, self.tx_type, self.user_id, self.amount, self.to_address, self.tx_for_item_id,
@@ -27,47 +34,105 @@ class Transaction(db.Model):
 
 
 def get_tx_totals():
+    """returns the kin sent to the public (the onboarding gifts) and the kin sent back to the server.
+
+    read from the running totals - no table scans.
+    """
+    from tippicserver.utils import GIFT
+    from .tip_totals import get_total, SCOPE_TX_TYPE
     totals = {'to_public': 0, 'from_public': 0}
-    prep_stat = 'select sum(amount) from transaction where incoming_tx=false;'
-    totals['to_public'] = db.engine.execute(prep_stat).scalar()
-    prep_stat = 'select sum(amount) from transaction where incoming_tx=true;'
-    totals['from_public'] = db.engine.execute(prep_stat).scalar()
+    totals['to_public'] = get_total(SCOPE_TX_TYPE, GIFT)
+    # users don't pay the server in tippic - all other txs are between users/apps
+    totals['from_public'] = 0
 
     return totals
 
 
-def report_transaction(tx_json):
-    """ store a given transaction in the database """
+# the user's feed: the user's own txs and the tips the user received, newest first.
+# each branch is limited on its own (using the user_id/to_address indexes) before the merge
+TX_FEED_OWN_QUERY = """
+    select tx_hash, amount, to_address, tx_for_item_id, tx_type, update_at, false as incoming_tip
+    from public.transaction
+    where user_id = :user_id %(cursor_condition)s
+    order by update_at desc, tx_hash desc limit :limit
+"""
+TX_FEED_TIPS_QUERY = """
+    select tx_hash, amount, to_address, tx_for_item_id, tx_type, update_at, true as incoming_tip
+    from public.transaction
+    where to_address = :to_address and tx_type = :picture and user_id <> :user_id %(cursor_condition)s
+    order by update_at desc, tx_hash desc limit :limit
+"""
+TX_FEED_QUERY = """
+    select * from ((%s) union all (%s)) feed
+    order by update_at desc, tx_hash desc limit :limit;
+""" % (TX_FEED_OWN_QUERY, TX_FEED_TIPS_QUERY)
+TX_FEED_CURSOR_CONDITION = 'and (update_at, tx_hash) < (:before_update_at, :before_tx_hash)'
+TX_CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_tx_cursor(update_at, tx_hash):
+    """returns an opaque (url-safe) keyset cursor pointing at the given tx"""
+    delta = update_at - TX_CURSOR_EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return '%d-%s' % (micros, tx_hash)
+
+
+def decode_tx_cursor(cursor):
+    """returns the (update_at, tx_hash) encoded in the given cursor or raises InvalidUsage"""
+    try:
+        micros, tx_hash = cursor.split('-', 1)
+        return TX_CURSOR_EPOCH + timedelta(microseconds=int(micros)), tx_hash
+    except Exception:
+        raise InvalidUsage('invalid cursor: %s' % cursor)
 
-    # check if tx_hash already in db
-    tx = Transaction.query.filter(Transaction.tx_hash == tx_json['tx_hash']).first()
-    if tx:
-        return False
 
-    # if not test - make sure transaction is valid
-    try:
-        valid, data = stellar.extract_tx_payment_data(tx_json['tx_hash'])
-        if not config.DEBUG and not valid:
-            return False
-    except Exception as e:
-        print("Exception occurred for tx_hash = %s:\n%s" % (tx_json['tx_hash'], e))
-        return False
-    # store transaction
-    return create_tx(tx_json['tx_hash'], tx_json['user_id'], tx_json['to_address'], tx_json['amount'],
-                     tx_json['type'], tx_json['id'])
+def list_user_transactions_feed(user_id, public_address, max_txs, before=None):
+    """returns the user's txs merged with the tips the user received, newest first.
 
+    before is an optional cursor (see encode_tx_cursor): only txs older than it are returned.
+    """
+    from tippicserver.utils import PICTURE
+
+    params = {'user_id': str(user_id), 'to_address': public_address, 'picture': PICTURE, 'limit': max_txs}
+    cursor_condition = ''
+    if before:
+        params['before_update_at'], params['before_tx_hash'] = decode_tx_cursor(before)
+        cursor_condition = TX_FEED_CURSOR_CONDITION
+
+    if not db.router:
+        return db.engine.execute(text(TX_FEED_QUERY % {'cursor_condition': cursor_condition}), params).fetchall()
+
+    # sharded: the user's own txs are on its shard, the tips it received on any shard - merge them here
+    from .user import user_engine
+    own = user_engine(user_id).execute(text(TX_FEED_OWN_QUERY % {'cursor_condition': cursor_condition}), params).fetchall()
+    tips = db.router.scatter_gather(text(TX_FEED_TIPS_QUERY % {'cursor_condition': cursor_condition}), params)
+    return sorted(own + tips, key=lambda tx: (tx.update_at, tx.tx_hash), reverse=True)[:max_txs]
 
-def get_transactions_json(user_id, public_address, discovery_apps):
+
+def get_transactions_json(user_id, public_address, discovery_apps, before=None):
+    """returns the user's txs as sent to the client and the cursor for the next page (or None).
+
+    discovery_apps is a (cached) DiscoveryApps object.
+    """
     from tippicserver.utils import MAX_TXS_PER_USER,APP_TO_APP, PICTURE, GIFT, GIVE_TIP, GET_TIP
     import arrow
-    from tippicserver.models.user import get_user
-    
+
     detailed_txs = []
-    user = get_user(user_id)
-    for tx in list_user_transactions(user_id, MAX_TXS_PER_USER):    
-        if tx.tx_type == APP_TO_APP:
-            app_data = next(item for item in discovery_apps if (item['memo'] in tx.tx_for_item_id))
-            direction = 1 if tx.to_address == user.public_address else -1
+    txs = list_user_transactions_feed(user_id, public_address, MAX_TXS_PER_USER, before)
+    for tx in txs:
+        if tx.incoming_tip:
+            detailed_txs.append({
+                "title": "Got a tip",
+                "amount": tx.amount,
+                "date": arrow.get(tx.update_at).timestamp,
+                "type": GET_TIP
+            })
+        elif tx.tx_type == APP_TO_APP:
+            app_data = discovery_apps.find(tx.tx_for_item_id) if discovery_apps else None
+            if app_data is None:
+                log.error('cant find discovery app for tx %s with item id %s' % (tx.tx_hash, tx.tx_for_item_id))
+                continue
+            direction = 1 if tx.to_address == public_address else -1
             detailed_txs.append({
                 "title": "Transferred Kin to",
                 "amount": tx.amount * direction,
@@ -93,50 +158,67 @@ def get_transactions_json(user_id, public_address, discovery_apps):
                 "type": GIVE_TIP
             })
 
-    for tx in list_user_incoming_tips(user_id, public_address):
-        detailed_txs.append({
-                "title": "Got a tip",
-                "amount": tx.amount,
-                "date": arrow.get(tx.update_at).timestamp,
-                "type": GET_TIP
-            })
+    # a full page means there may be more
+    next_cursor = encode_tx_cursor(txs[-1].update_at, txs[-1].tx_hash) if len(txs) == MAX_TXS_PER_USER else None
+    return detailed_txs, next_cursor
 
-    return detailed_txs
 
+@read_only
 def list_user_transactions(user_id, max_txs=None):
     """returns all txs by this user - or the last x tx if max_txs was passed"""
-    txs = Transaction.query.filter(Transaction.user_id == user_id).order_by(desc(Transaction.update_at)).all()
-    # trim the amount of txs
-    txs = txs[:max_txs] if max_txs and max_txs > len(txs) else txs
-    return txs
+    query = Transaction.query.filter(Transaction.user_id == user_id).order_by(desc(Transaction.update_at))
+    if max_txs:
+        query = query.limit(max_txs)
+    return query.all()
+
 
 def list_user_incoming_tips(user_id, to_address, max_txs=None):
     from tippicserver.utils import PICTURE
 
-    txs = Transaction.query.filter(Transaction.user_id != user_id).filter(Transaction.to_address == to_address).filter(Transaction.tx_type == PICTURE).order_by(desc(Transaction.update_at)).all()
-    # trim the amount of txs
-    txs = txs[:max_txs] if max_txs and max_txs > len(txs) else txs
-    return txs
+    query = Transaction.query.filter(Transaction.user_id != user_id).filter(Transaction.to_address == to_address).filter(Transaction.tx_type == PICTURE).order_by(desc(Transaction.update_at))
+    if max_txs:
+        query = query.limit(max_txs)
+    return query.all()
+
+
+def _increment_tx_counters(conn, user_id, to_address, amount, tx_type, tx_for_item_id):
+    """adds the tx to the materialized per-picture tips sum (a no-op for non-picture items) and the running totals"""
+    conn.execute(text('update public.picture set tips_sum = tips_sum + :amount where picture_id = :item_id'),
+                 {'amount': amount, 'item_id': tx_for_item_id})
+    increment_totals(conn, tx_totals_items(user_id, to_address, tx_type), amount)
+
 
 def create_tx(tx_hash, user_id, to_address, amount, tx_type, tx_for_item_id):
+    from .user import user_engine
+    amount = int(amount)
+    tx_engine = user_engine(user_id)
     try:
-        tx = Transaction()
-        tx.tx_hash = tx_hash
-        tx.user_id = user_id
-        tx.amount = int(amount)
-        tx.to_address = to_address
-        tx.tx_type = tx_type
-        tx.tx_for_item_id = tx_for_item_id
-        db.session.add(tx)
-        db.session.commit()
+        # the tx and its counters are written in one explicit transaction - the prod engine autocommits every
+        # statement otherwise. a duplicate tx fails the insert, before any counter is touched
+        with db_transaction(tx_engine) as conn:
+            conn.execute(Transaction.__table__.insert().values(
+                tx_hash=tx_hash, user_id=user_id, amount=amount, to_address=to_address, tx_type=tx_type,
+                tx_for_item_id=tx_for_item_id))
+            if tx_engine is db.engine:
+                _increment_tx_counters(conn, user_id, to_address, amount, tx_type, tx_for_item_id)
     except Exception as e:
         print(e)
         log.error('cant add tx to db with id %s' % tx_hash)
-    else:
-        log.info('created tx with tx_hash: %s' % tx.tx_hash)
-        return True
+        return False
 
-    return False
+    if tx_engine is not db.engine:
+        # the tx is on the user's shard and the counters on the default one, so they're committed separately.
+        # if that fails, they're short until the next /tx/totals/reconcile
+        try:
+            with db_transaction() as conn:
+                _increment_tx_counters(conn, user_id, to_address, amount, tx_type, tx_for_item_id)
+        except Exception as e:
+            log.error('cant update the counters of tx %s. e: %s' % (tx_hash, e))
+
+    # the rest of the request reads this tx from the primary
+    pin_to_primary(db.session())
+    log.info('created tx with tx_hash: %s' % tx_hash)
+    return True
 
 
 def get_user_tx_report(user_id):
@@ -0,0 +1,271 @@
+"""txs reported by the clients, verified against horizon off the request path.
+
+a reported tx is accepted immediately as 'pending' - or verified on the spot if the ledger ingester already
+stored its payment. the verification job (on the dedicated rq_verify queue) claims the due reports in batches,
+looks them up locally and then on horizon (concurrently), and either stores them as transactions ('verified')
+or drops them ('rejected'). txs that aren't on the ledger yet are retried with exponential backoff until
+TX_VERIFICATION_MAX_AGE_SECS. clients that want the final status can long-poll.
+"""
+import logging as log
+import math
+from decimal import Decimal, InvalidOperation
+import re
+import time
+
+from sqlalchemy import text
+from sqlalchemy_utils import UUIDType
+
+from tippicserver import db, app, config, stellar
+from tippicserver.utils import increment_metric
+from .transaction import Transaction, create_tx
+from .ledger_payment import get_ledger_payment, get_ledger_payments
+
+TX_REPORT_PENDING = 'pending'
+TX_REPORT_VERIFIED = 'verified'
+TX_REPORT_REJECTED = 'rejected'
+
+TX_VERIFICATION_BASE_DELAY_SECS = 0.5
+TX_VERIFICATION_MAX_DELAY_SECS = 10
+TX_VERIFICATION_LEASE_SECS = 60  # a claimed report is retried after this long if the job dies mid-batch
+TX_VERIFICATION_JOB_MAX_SECS = 300  # the job exits (and re-enqueues itself) after this long
+TX_VERIFICATION_SCHEDULED_KEY = 'tx-verification-scheduled'
+TX_REPORT_RESULT_KEY = 'tx-report-result:%s'
+TX_REPORT_RESULT_TTL_SECS = 60
+
+TX_HASH_RE = re.compile('^[0-9a-f]{64}$')
+
+
+class TransactionReport(db.Model):
+    """a tx reported by a client, and the state of its verification"""
+    tx_hash = db.Column(db.String(100), nullable=False, primary_key=True)
+    # not a foreign key: the user may live on another shard
+    user_id = db.Column('user_id', UUIDType(binary=False), nullable=False)
+    to_address = db.Column(db.String(60), nullable=False)
+    amount = db.Column(db.Integer(), nullable=False)
+    tx_for_item_id = db.Column(db.String(100), nullable=False)
+    tx_type = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default=TX_REPORT_PENDING)
+    reason = db.Column(db.String(40), nullable=True)  # why the tx was rejected
+    attempts = db.Column(db.Integer(), nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+    update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
+
+    __table_args__ = (db.Index('ix_transaction_report_pending', 'next_attempt_at',
+                               postgresql_where=db.text("status = 'pending'")),)
+
+    def __repr__(self):
+        return '<tx_hash: %s, status: %s, reason: %s, attempts: %s, user_id: %s, amount: %s, to_address: %s, ' \
+               'tx_for_item_id: %s, type: %s>' % (self.tx_hash, self.status, self.reason, self.attempts, self.user_id,
+                                                  self.amount, self.to_address, self.tx_for_item_id, self.tx_type)
+
+
+def report_transaction(tx_json):
+    """accepts the given tx for verification. returns the report's status, or None if it can't be accepted"""
+    try:
+        tx_hash = tx_json['tx_hash']
+        report = TransactionReport(tx_hash=tx_hash, user_id=tx_json['user_id'], to_address=tx_json['to_address'],
+                                   amount=int(tx_json['amount']), tx_type=tx_json['type'], tx_for_item_id=tx_json['id'])
+    except (KeyError, TypeError, ValueError) as e:
+        print('report_transaction: invalid payload %s. e: %s' % (tx_json, e))
+        return None
+
+    if not TX_HASH_RE.match(tx_hash or ''):
+        print('report_transaction: invalid tx_hash %s' % tx_hash)
+        return None
+
+    # check if tx_hash already in db
+    if Transaction.query.filter(Transaction.tx_hash == tx_hash).first():
+        return None
+
+    try:
+        db.session.add(report)
+        db.session.commit()
+    except Exception as e:
+        # already reported
+        db.session.rollback()
+        print('report_transaction: cant add report for tx_hash %s. e: %s' % (tx_hash, e))
+        return None
+
+    # already ingested from the ledger: no need to wait for the verification job. with TX_VERIFICATION_INLINE
+    # (tests), the report is verified in the request, once and for all
+    payments = get_ledger_payment(tx_hash)
+    if payments is not None or config.TX_VERIFICATION_INLINE:
+        report_json = {'tx_hash': tx_hash, 'user_id': report.user_id, 'to_address': report.to_address,
+                       'amount': report.amount, 'tx_type': report.tx_type, 'tx_for_item_id': report.tx_for_item_id,
+                       'attempts': 0, 'age_secs': 0}
+        result = local_lookup_result(report_json, payments) if payments is not None \
+            else lookup_reported_payments([report_json])[tx_hash]
+        verify_transaction_report(report_json, result, final=config.TX_VERIFICATION_INLINE)
+        return get_transaction_report_status(tx_hash)
+
+    increment_metric('tx-report-pending')
+    schedule_transaction_verification()
+    return TX_REPORT_PENDING
+
+
+def get_transaction_report_status(tx_hash, user_id=None):
+    """returns the status of the given reported tx, or None if there is no such report"""
+    # column queries, so the status isn't served from the session's identity map
+    query = db.session.query(TransactionReport.status).filter(TransactionReport.tx_hash == tx_hash)
+    if user_id is not None:
+        query = query.filter(TransactionReport.user_id == user_id)
+    report = query.first()
+    if report is not None:
+        return report.status
+    # txs stored before the reports were introduced
+    query = db.session.query(Transaction.tx_hash).filter(Transaction.tx_hash == tx_hash)
+    if user_id is not None:
+        query = query.filter(Transaction.user_id == user_id)
+    return TX_REPORT_VERIFIED if query.first() else None
+
+
+def wait_for_transaction_report(tx_hash, timeout_secs):
+    """blocks until the given reported tx is verified or rejected, or the timeout passes. returns its status"""
+    try:
+        # redis' timeout is in whole seconds, and 0 means forever
+        app.redis.blpop(TX_REPORT_RESULT_KEY % tx_hash, timeout=max(1, int(math.ceil(timeout_secs))))
+    except Exception as e:
+        log.error('wait_for_transaction_report: cant wait on tx_hash %s. e: %s' % (tx_hash, e))
+    return get_transaction_report_status(tx_hash)
+
+
+def schedule_transaction_verification():
+    """makes sure a verification job is queued. at most one job waits in the queue at any time"""
+    try:
+        if app.redis.set(TX_VERIFICATION_SCHEDULED_KEY, 1, nx=True, ex=TX_VERIFICATION_JOB_MAX_SECS * 2):
+            app.rq_verify.enqueue(verify_transaction_reports)
+    except Exception as e:
+        log.error('schedule_transaction_verification: cant enqueue the verification job. e: %s' % e)
+
+
+def backoff_secs(attempts):
+    return min(TX_VERIFICATION_BASE_DELAY_SECS * 2 ** max(attempts - 1, 0), TX_VERIFICATION_MAX_DELAY_SECS)
+
+
+def claim_due_transaction_reports(limit):
+    """atomically claims up to limit due pending reports, leasing them so no other job picks them up"""
+    return db.engine.execute(text('''
+        update public.transaction_report set attempts = attempts + 1,
+               next_attempt_at = now() + make_interval(secs => :lease)
+        where tx_hash in (select tx_hash from public.transaction_report
+                          where status = :pending and next_attempt_at <= now()
+                          order by next_attempt_at limit :limit for update skip locked)
+        returning tx_hash, user_id, to_address, amount, tx_for_item_id, tx_type, attempts,
+                  extract(epoch from now() - created_at) as age_secs;'''),
+        {'lease': TX_VERIFICATION_LEASE_SECS, 'pending': TX_REPORT_PENDING, 'limit': limit}).fetchall()
+
+
+def secs_to_next_due_report():
+    """returns the secs until the next pending report is due (<= 0 if one is due now), or None if none are pending"""
+    return db.engine.execute(text('''select extract(epoch from min(next_attempt_at) - now()) from public.transaction_report
+                                     where status = :pending;'''), {'pending': TX_REPORT_PENDING}).scalar()
+
+
+def finalize_transaction_report(tx_hash, status, reason=None):
+    db.engine.execute(text('update public.transaction_report set status = :status, reason = :reason, update_at = now() where tx_hash = :tx_hash;'),
+                      {'status': status, 'reason': reason, 'tx_hash': tx_hash})
+    increment_metric('tx-report-%s' % status)
+    try:
+        # wake up the long-polling requests
+        key = TX_REPORT_RESULT_KEY % tx_hash
+        app.redis.rpush(key, status)
+        app.redis.expire(key, TX_REPORT_RESULT_TTL_SECS)
+    except Exception as e:
+        log.error('finalize_transaction_report: cant publish the result for tx_hash %s. e: %s' % (tx_hash, e))
+
+
+def retry_transaction_report(tx_hash, attempts):
+    db.engine.execute(text('''update public.transaction_report set next_attempt_at = now() + make_interval(secs => :delay)
+                              where tx_hash = :tx_hash;'''), {'delay': backoff_secs(attempts), 'tx_hash': tx_hash})
+
+
+def verify_transaction_report(report, result, final=False):
+    """applies the lookup result (local or from horizon) to the given claimed report.
+
+    a final lookup isn't retried: a report that isn't on the ledger is given up on right away.
+    """
+    lookup, data = result
+    final = final or report['age_secs'] > config.TX_VERIFICATION_MAX_AGE_SECS
+    if lookup == stellar.TX_LOOKUP_VALID and not payment_matches(report, data):
+        log.warning('verify_transaction_report: tx_hash %s pays %s to %s, reported as %s to %s' % (
+            report['tx_hash'], data.get('amount'), data.get('to_address'), report['amount'], report['to_address']))
+        finalize_transaction_report(report['tx_hash'], TX_REPORT_REJECTED, 'mismatch')
+    elif lookup == stellar.TX_LOOKUP_VALID or (config.DEBUG and lookup != stellar.TX_LOOKUP_INVALID and final):
+        # on test envs, txs that never show up are stored anyway
+        if create_tx(report['tx_hash'], report['user_id'], report['to_address'], report['amount'],
+                     report['tx_type'], report['tx_for_item_id']) \
+                or Transaction.query.filter(Transaction.tx_hash == report['tx_hash']).first():
+            finalize_transaction_report(report['tx_hash'], TX_REPORT_VERIFIED)
+        else:
+            finalize_transaction_report(report['tx_hash'], TX_REPORT_REJECTED, 'store-failed')
+    elif lookup == stellar.TX_LOOKUP_INVALID:
+        finalize_transaction_report(report['tx_hash'], TX_REPORT_REJECTED, 'not-a-payment')
+    elif final:
+        log.info('verify_transaction_report: giving up on tx_hash %s after %s attempts' % (report['tx_hash'], report['attempts']))
+        finalize_transaction_report(report['tx_hash'], TX_REPORT_REJECTED, 'not-found')
+    else:
+        # not on the ledger yet (or horizon failed) - try again later
+        retry_transaction_report(report['tx_hash'], report['attempts'])
+
+
+def lookup_reported_payments(reports):
+    """returns a dict of tx_hash -> (result, data) for the given claimed reports.
+
+    the payments already ingested into ledger_payment resolve locally. the rest are looked up on horizon - unless
+    the ledger ingester is running and the report is recent enough that the ingester may still catch up
+    """
+    local = get_ledger_payments([report['tx_hash'] for report in reports])
+    results = {report['tx_hash']: local_lookup_result(report, local[report['tx_hash']])
+               for report in reports if report['tx_hash'] in local}
+    remote = [report['tx_hash'] for report in reports if report['tx_hash'] not in local and not
+              (config.LEDGER_INGESTER_ENABLED and report['age_secs'] < config.LEDGER_INGESTER_GRACE_SECS)]
+    results.update(stellar.lookup_tx_payment_data_many(remote))
+    for report in reports:
+        results.setdefault(report['tx_hash'], (stellar.TX_LOOKUP_MISSING, {}))
+    increment_metric('tx-report-local-lookup', len(local))
+    increment_metric('tx-report-horizon-lookup', len(remote))
+    return results
+
+
+def payment_matches(report, data):
+    """whether the looked up payment pays the reported amount to the reported address"""
+    try:
+        return data.get('to_address') == report['to_address'] and Decimal(str(data.get('amount'))) == Decimal(report['amount'])
+    except InvalidOperation:
+        return False
+
+
+def local_lookup_result(report, payments):
+    """the lookup result of the given ingested payment ops of the report's tx: the op the report refers to, if any"""
+    datas = [{'amount': payment.amount, 'to_address': payment.to_address} for payment in payments]
+    return stellar.TX_LOOKUP_VALID, next((data for data in datas if payment_matches(report, data)), datas[0])
+
+
+def verify_transaction_reports():
+    """the verification job: verifies the pending reports as they become due, until there are none left.
+
+    meant to run on the rq_verify queue.
+    """
+    # from here on, new reports need a new job
+    app.redis.delete(TX_VERIFICATION_SCHEDULED_KEY)
+    deadline = time.time() + TX_VERIFICATION_JOB_MAX_SECS
+    while time.time() < deadline:
+        reports = claim_due_transaction_reports(config.TX_VERIFICATION_BATCH_SIZE)
+        if reports:
+            results = lookup_reported_payments(reports)
+            for report in reports:
+                try:
+                    verify_transaction_report(report, results[report['tx_hash']])
+                except Exception as e:
+                    # the lease expires and the report is retried
+                    log.error('verify_transaction_reports: failed to verify tx_hash %s. e: %s' % (report['tx_hash'], e))
+            continue
+
+        secs_to_next = secs_to_next_due_report()
+        if secs_to_next is None:
+            return
+        time.sleep(min(max(float(secs_to_next), 0.1), TX_VERIFICATION_MAX_DELAY_SECS))
+
+    # out of time, but there's more to do
+    schedule_transaction_verification()
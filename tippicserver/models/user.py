@@ -4,19 +4,26 @@ from distutils.version import LooseVersion
 from uuid import uuid4
 
 import arrow
+from sqlalchemy import event, text
 from sqlalchemy.dialects.postgresql import INET
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy_utils import UUIDType
 
 from tippicserver import db, config, app
-from tippicserver.utils import InvalidUsage, parse_phone_number, increment_metric, get_global_config, OS_ANDROID, \
-    OS_IOS, commit_json_changed_to_orm
+from tippicserver.encrypt import BLIND_INDEX_SIZE
+from tippicserver.replica import read_only
+from tippicserver.sharding import DEFAULT_SHARD, RoutingSession
+from tippicserver.utils import InvalidUsage, parse_phone_number, parse_phone_numbers, increment_metric, get_global_config, OS_ANDROID, \
+    OS_IOS, commit_json_changed_to_orm, get_country_code_by_ip
 from .backup import get_user_backup_hints_by_enc_phone
 from .push_auth_token import get_token_obj_by_user_id
+from .user_context import get_user_context, invalidate_user_context
 
 DEFAULT_TIME_ZONE = -4
 TIPPIC_IOS_PACKAGE_ID_PROD = 'org.kinecosystem.tippic'  # AKA bundle id
 DEVICE_MODEL_MAX_SIZE = 40
+PHONE_NUMBER_INDEX_BACKFILL_BATCH_SIZE = 1000
+USER_DIRECTORY_BACKFILL_BATCH_SIZE = 1000
 
 class User(db.Model):
     """
@@ -34,10 +41,15 @@ class User(db.Model):
     onboarded = db.Column(db.Boolean, unique=False, default=False)
     public_address = db.Column(db.String(60), primary_key=False, unique=True, nullable=True)
     enc_phone_number = db.Column(db.String(200), primary_key=False, nullable=True)
+    phone_number_index = db.Column(db.LargeBinary(BLIND_INDEX_SIZE), primary_key=False, nullable=True)  # blind index of the phone number
     deactivated = db.Column(db.Boolean, unique=False, default=False)
     auth_token = db.Column(UUIDType(binary=False), primary_key=False, nullable=True)
     package_id = db.Column(db.String(60), primary_key=False, nullable=True)
 
+    # public_address is already indexed by its unique constraint
+    __table_args__ = (db.Index('ix_user_enc_phone_number_deactivated', 'enc_phone_number', 'deactivated'),
+                      db.Index('ix_user_phone_number_index_deactivated', 'phone_number_index', 'deactivated'),
+                      db.Index('ix_user_username', 'username'),)
 
 
     def __repr__(self):
@@ -48,6 +60,52 @@ class User(db.Model):
                   self.deactivated)
 
 
+class UserDirectory(db.Model):
+    """
+    the global lookup table of the sharded users: where each user lives, and its cross-user lookup keys
+    """
+    user_id = db.Column(UUIDType(binary=False), primary_key=True, nullable=False)
+    shard = db.Column(db.String(40), primary_key=False, nullable=False)
+    public_address = db.Column(db.String(60), primary_key=False, nullable=True, index=True)
+    enc_phone_number = db.Column(db.String(200), primary_key=False, nullable=True, index=True)
+    update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def update_user_directory(session, flush_context):
+    """upserts the directory entries of the users written in this flush. the upsert runs in the session's
+    transaction on the default shard, which commits along with (but not atomically with) the users' shards -
+    backfill_user_directory repairs the entries of a commit that failed half way
+    """
+    users = [obj for obj in list(session.new) + list(session.dirty) if isinstance(obj, User)]
+    if not users:
+        return
+    session.connection(shard_id=DEFAULT_SHARD).execute(text(
+        """insert into public.user_directory (user_id, shard, public_address, enc_phone_number, update_at)
+           values (:user_id, :shard, :public_address, :enc_phone_number, now())
+           on conflict (user_id) do update set shard = excluded.shard, public_address = excluded.public_address,
+           enc_phone_number = excluded.enc_phone_number, update_at = now()"""),
+        [{'user_id': str(user.user_id), 'shard': session.router.shard_for(user.user_id),
+          'public_address': user.public_address, 'enc_phone_number': user.enc_phone_number} for user in users])
+
+
+def user_engine(user_id):
+    """returns the engine of the db that holds the given user's rows"""
+    return db.router.get_engine(db.router.shard_for(user_id)) if db.router else db.engine
+
+
+def user_engines():
+    """returns the (shard, engine) of every db that holds user rows"""
+    return sorted(db.router.engines().items()) if db.router else [(DEFAULT_SHARD, db.engine)]
+
+
+def user_scatter_gather(statement, params=None):
+    """runs the given statement on every db that holds user rows. returns all the rows"""
+    if db.router:
+        return db.router.scatter_gather(statement, params)
+    return db.engine.execute(statement, params or {}).fetchall()
+
+
 def unblock_user(user_id, user_id_to_unblock):
     """ add user_id_to_block to user's blocked list """
     try:
@@ -104,8 +162,10 @@ def set_username(user_id, username):
             return False
 
 
+@read_only
 def get_user(user_id):
-    user = User.query.filter_by(user_id=user_id).first()
+    context = get_user_context(user_id)
+    user = context.user if context else User.query.filter_by(user_id=user_id).first()
     if not user:
         raise InvalidUsage('no such user_id')
     return user
@@ -130,15 +190,17 @@ def user_deactivated(user_id):
         return user.deactivated
 
 
+@read_only
 def user_exists(user_id):
-    user = User.query.filter_by(user_id=user_id).first()
+    context = get_user_context(user_id)
+    user = context.user if context else User.query.filter_by(user_id=user_id).first()
     return True if user else False
 
 
 def is_onboarded(user_id):
     """returns whether the user has an account or None if there's no such user."""
     try:
-        return User.query.filter_by(user_id=user_id).first().onboarded
+        return get_user(user_id).onboarded
     except Exception as e:
         print(e)
         return None
@@ -192,6 +254,8 @@ def create_user(user_id, os_type, device_model, push_token, time_zone, device_id
 
         # get/create an auth token for this user
         get_token_obj_by_user_id(user_id)
+        # the context (if loaded) still thinks this user doesn't exist
+        invalidate_user_context(user_id)
     else:
         increment_metric('reregister')
 
@@ -237,8 +301,8 @@ def get_user_blocked_users(user_id):
     if not user_app_data.blocked_users:
         return []
 
-    user_ids = "\',\'".join(user_app_data.blocked_users)
-    rows = db.engine.execute("select user_id,username from public.user where user_id in ('%s')" % user_ids).fetchall()
+    rows = user_scatter_gather(text("select user_id,username from public.user where user_id = any(cast(:user_ids as uuid[]))"),
+                               {'user_ids': list(user_app_data.blocked_users)})
     results = [dict(item) for item in rows]
     return results
 
@@ -246,7 +310,7 @@ def get_user_blocked_users(user_id):
 def update_user_app_version(user_id, app_ver):
     """update the user app version"""
     try:
-        userAppData = UserAppData.query.filter_by(user_id=user_id).first()
+        userAppData = get_user_app_data(user_id)
         userAppData.app_ver = app_ver
         db.session.add(userAppData)
         db.session.commit()
@@ -256,8 +320,11 @@ def update_user_app_version(user_id, app_ver):
 
 
 def get_user_inapp_balance(user_id):
-    spend = db.engine.execute("select sum(amount) as total from public.transaction where user_id ='%s' and incoming_tx = true;" % user_id).first()['total'] or 0
-    income = db.engine.execute("select sum(amount) as total from public.transaction where user_id ='%s' and incoming_tx = false;" % user_id).first()['total'] or 0
+    """returns the kin the user got in-app (gifts, tips, p2p) minus the kin the user gave (tips, p2p)"""
+    from .tip_totals import get_user_totals
+    totals = get_user_totals(user_id, get_address_by_userid(user_id))
+    income = totals['gifts'] + totals['tips_received'] + totals['p2p_received']
+    spend = totals['tips_given'] + totals['p2p_sent']
     return income - spend
 
 
@@ -284,7 +351,7 @@ def set_should_solve_captcha(user_id, value=0):
 def autoswitch_captcha(user_id):
     """promotes user's captcha state from 0 to 1, iff it was 0"""
     statement = '''update public.user_app_data set should_solve_captcha_ternary = 1 where public.user_app_data.user_id = '%s' and public.user_app_data.should_solve_captcha_ternary = 0;'''
-    db.engine.execute(statement % user_id)
+    user_engine(user_id).execute(statement % user_id)
 
 
 
@@ -371,15 +438,16 @@ def automatically_raise_captcha_flag(user_id):
 
 def update_ip_address(user_id, ip_address):
     try:
-        userAppData = UserAppData.query.filter_by(user_id=user_id).first()
+        userAppData = get_user_app_data(user_id)
         if userAppData.ip_address == ip_address:
             # nothing to update
             return
 
         userAppData.ip_address = ip_address
-        try:
-            userAppData.country_iso_code = app.geoip_reader.get(ip_address)['country']['iso_code']
-        except Exception as e:
+        country_iso_code = get_country_code_by_ip(ip_address)
+        if country_iso_code:
+            userAppData.country_iso_code = country_iso_code
+        else:
             log.error('could not calc country iso code for %s' % ip_address)
         db.session.add(userAppData)
         db.session.commit()
@@ -391,7 +459,7 @@ def update_ip_address(user_id, ip_address):
 
 
 def get_user_country_code(user_id):
-    return UserAppData.query.filter_by(user_id=user_id).one().country_iso_code  # can be null
+    return get_user_app_data(user_id).country_iso_code  # can be null
 
 
 def list_all_users_app_data():
@@ -404,7 +472,8 @@ def list_all_users_app_data():
 
 
 def get_user_app_data(user_id):
-    user_app_data = UserAppData.query.filter_by(user_id=user_id).first()
+    context = get_user_context(user_id)
+    user_app_data = context.user_app_data if context else UserAppData.query.filter_by(user_id=user_id).first()
     if not user_app_data:
         raise InvalidUsage('no such user_id')
     return user_app_data
@@ -412,12 +481,13 @@ def get_user_app_data(user_id):
 
 def get_user_tz(user_id):
     """return the user timezone"""
-    return User.query.filter_by(user_id=user_id).one().time_zone
+    return get_user(user_id).time_zone
 
 
+@read_only
 def get_user_os_type(user_id):
     """return the user os_type"""
-    return User.query.filter_by(user_id=user_id).one().os_type
+    return get_user(user_id).os_type
 
 
 def package_id_to_push_env(package_id):
@@ -477,7 +547,11 @@ def get_user_push_data(user_id):
 def get_userid_by_address(address):
     """return the userid associated with the given address or return None"""
     try:
-        user = User.query.filter_by(public_address=address).first()
+        if db.router:
+            # the users are sharded - look the address up in the global directory
+            user = UserDirectory.query.filter_by(public_address=address).first()
+        else:
+            user = User.query.filter_by(public_address=address).first()
         if user is None:
             return None
         else:
@@ -490,7 +564,8 @@ def get_userid_by_address(address):
 def get_address_by_userid(user_id):
     """return the address associated with the given user_id or return None"""
     try:
-        user = User.query.filter_by(user_id=user_id).first()
+        context = get_user_context(user_id)
+        user = context.user if context else User.query.filter_by(user_id=user_id).first()
         if user is None:
             return None
         else:
@@ -514,18 +589,31 @@ def set_user_phone_number(user_id, number):
                 raise InvalidUsage('trying to overwrite an existing phone number with a different one')
         else:
             user.enc_phone_number = encrypted_number
+            user.phone_number_index = app.encryption.blind_index(number)
             db.session.add(user)
             db.session.commit()
+            # the blacklist status in the context was computed for the previous (empty) number
+            invalidate_user_context(user_id)
 
     except Exception as e:
         log.error('cant add phone number %s to user_id: %s. Exception: %s' % (number, user_id, e))
         raise
 
 
+def phone_number_filter(phone_number):
+    """returns a filter of the users with the given (un-enc) phone number.
+
+    users are matched by the blind index of the number, and (until all the users have one) by the encrypted number
+    """
+    index_filter = User.phone_number_index == app.encryption.blind_index(phone_number)
+    if config.PHONE_NUMBER_INDEX_ONLY:
+        return index_filter
+    return db.or_(index_filter, db.and_(User.phone_number_index == None, User.enc_phone_number == app.encryption.encrypt(phone_number)))
+
+
 def get_active_user_id_by_phone(phone_number):
     try:
-        encrypted_phone_number = app.encryption.encrypt(phone_number)
-        user = User.query.filter_by(enc_phone_number=encrypted_phone_number).filter_by(deactivated=False).first()
+        user = User.query.filter(phone_number_filter(phone_number)).filter_by(deactivated=False).first()
         if user is None:
             return None
         else:
@@ -567,7 +655,8 @@ def get_unenc_phone_number_by_user_id(user_id):
 
 def get_enc_phone_number_by_user_id(user_id):
     try:
-        user = User.query.filter_by(user_id=user_id).first()
+        context = get_user_context(user_id)
+        user = context.user if context else User.query.filter_by(user_id=user_id).first()
         if user is None:
             return None
         else:
@@ -584,8 +673,7 @@ def is_user_phone_verified(user_id):
 
 def get_all_user_id_by_phone(phone_number):
     try:
-        encrypted_number = app.encryption.encrypt(phone_number)
-        users = User.query.filter_by(enc_phone_number=encrypted_number).all()
+        users = User.query.filter(phone_number_filter(phone_number)).all()
         return [user.user_id for user in users]
     except Exception as e:
         log.error('cant get user(s) address by phone. Exception: %s' % e)
@@ -594,6 +682,11 @@ def get_all_user_id_by_phone(phone_number):
 
 def match_phone_number_to_address(phone_number, sender_user_id):
     """get the address associated with this phone number"""
+    return match_phone_numbers_to_addresses([phone_number], sender_user_id).get(phone_number)
+
+
+def match_phone_numbers_to_addresses(phone_numbers, sender_user_id):
+    """returns a dict of phone number -> address for the given (raw) phone numbers that match an active user"""
     # get the sender's un-enc phone number by the userid:
     sender_enc_phone_number = get_enc_phone_number_by_user_id(sender_user_id)
     if not sender_enc_phone_number:
@@ -601,24 +694,33 @@ def match_phone_number_to_address(phone_number, sender_user_id):
         log.error('should never happen: cant get user\'s phone number. user_id: %s' % sender_user_id)
 
     sender_unenc_phone_number = app.encryption.decrypt(sender_enc_phone_number)
-    enc_phone_num_1 = app.encryption.encrypt(parse_phone_number(phone_number, sender_unenc_phone_number))
-    parsed_address = get_address_by_enc_phone_number(enc_phone_num_1)
+    parsed_numbers = parse_phone_numbers(phone_numbers, sender_unenc_phone_number)
 
-    if parsed_address is None:
-        # special handling for Israeli numbers: perhaps the number was stored in the db with a leading zero.
-        # in the db: +9720527702891
-        # from the client: 0527702891
-        enc_phone_num_2 = app.encryption.encrypt('+972' + phone_number)
-        parsed_address = get_address_by_enc_phone_number(enc_phone_num_2)
-        if parsed_address:
-            log.info('match_phone_number_to_address: applied special israeli-number logic to parse number: %s' % enc_phone_num_2)
+    # each number is looked up as parsed and, as special handling for Israeli numbers, with +972 prepended:
+    # perhaps the number was stored in the db with a leading zero.
+    # in the db: +9720527702891
+    # from the client: 0527702891
+    candidates = {phone_number: (parsed_number, '+972' + phone_number) for phone_number, parsed_number in parsed_numbers.items()}
+    addresses = get_addresses_by_phone_numbers({number for pair in candidates.values() for number in pair})
 
-    return parsed_address
+    matches = {}
+    for phone_number, (parsed_number, israeli_number) in candidates.items():
+        address = addresses.get(parsed_number) or addresses.get(israeli_number)
+        if address:
+            matches[phone_number] = address
+    log.info('match_phone_numbers_to_addresses: matched %s of %s numbers' % (len(matches), len(candidates)))
+    return matches
 
 
 def get_address_by_enc_phone_number(enc_phone_number):
     try:
-        user = User.query.filter(User.enc_phone_number==enc_phone_number).filter_by(deactivated=False).first()
+        if db.router:
+            # the users are sharded - find the candidates in the global directory, and check them on their shards
+            user_ids = [entry.user_id for entry in UserDirectory.query.filter_by(enc_phone_number=enc_phone_number).all()]
+            user = next((user for user in (User.query.filter_by(user_id=user_id, deactivated=False).first()
+                                           for user_id in user_ids) if user is not None), None)
+        else:
+            user = User.query.filter(User.enc_phone_number==enc_phone_number).filter_by(deactivated=False).first()
         if user is None:
             log.error('cant find user for encrypted phone number: %s' % enc_phone_number)
             return None
@@ -629,6 +731,103 @@ def get_address_by_enc_phone_number(enc_phone_number):
         raise
 
 
+def get_addresses_by_phone_numbers(phone_numbers):
+    """returns a dict of (un-enc) phone number -> address of the active users with the given numbers, in one query
+    (per shard)
+    """
+    if not phone_numbers:
+        return {}
+    by_index = {app.encryption.blind_index(number): number for number in phone_numbers}
+    by_enc = {} if config.PHONE_NUMBER_INDEX_ONLY else {app.encryption.encrypt(number): number for number in phone_numbers}
+    try:
+        rows = user_scatter_gather(text("""select phone_number_index, enc_phone_number, public_address from public.user
+                                           where deactivated = false
+                                           and (phone_number_index = any(:indexes)
+                                                or (phone_number_index is null and enc_phone_number = any(:enc_phone_numbers)));"""),
+                                   {'indexes': list(by_index), 'enc_phone_numbers': list(by_enc)})
+    except Exception as e:
+        log.error('cant get user addresses by phones. Exception: %s' % e)
+        raise
+
+    addresses = {}
+    for phone_number_index, enc_phone_number, public_address in rows:
+        number = by_index.get(bytes(phone_number_index)) if phone_number_index is not None else by_enc.get(enc_phone_number)
+        if number and public_address:
+            addresses[number] = public_address
+    return addresses
+
+
+def backfill_phone_number_indexes(batch_size=PHONE_NUMBER_INDEX_BACKFILL_BATCH_SIZE):
+    """sets the blind index of the users that have a phone number but no index, on every shard. returns the
+    number of users set
+    """
+    total = 0
+    for shard, engine in user_engines():
+        last_user_id = None
+        while True:
+            rows = engine.execute(text("""select user_id, enc_phone_number from public.user
+                                          where enc_phone_number is not null and phone_number_index is null
+                                          and (cast(:last_user_id as uuid) is null or user_id > cast(:last_user_id as uuid))
+                                          order by user_id limit :limit;"""),
+                                  {'last_user_id': last_user_id, 'limit': batch_size}).fetchall()
+            if not rows:
+                break
+            last_user_id = str(rows[-1][0])
+
+            found = []
+            for user_id, enc_phone_number in rows:
+                try:
+                    found.append((str(user_id), app.encryption.blind_index(app.encryption.decrypt(enc_phone_number))))
+                except Exception as e:
+                    log.error('backfill_phone_number_indexes: cant decrypt the number of user_id %s. e: %s' % (user_id, e))
+            if found:
+                params = {}
+                for index, (user_id, phone_number_index) in enumerate(found):
+                    params.update({'user_id_%s' % index: user_id, 'phone_number_index_%s' % index: phone_number_index})
+                values = ', '.join('(cast(:user_id_%(i)s as uuid), :phone_number_index_%(i)s)' % {'i': index} for index in range(len(found)))
+                total += engine.execute(text("""update public.user u set phone_number_index = v.phone_number_index
+                                                from (values %s) as v (user_id, phone_number_index)
+                                                where u.user_id = v.user_id and u.phone_number_index is null;""" % values),
+                                        params).rowcount
+            log.info('backfill_phone_number_indexes: set %s indexes so far (shard %s)' % (total, shard))
+    return total
+
+
+def backfill_user_directory(batch_size=USER_DIRECTORY_BACKFILL_BATCH_SIZE):
+    """upserts the directory entries of all the users, from every shard - for the users that existed before
+    sharding was enabled, and to repair entries that missed a commit. returns the number of entries written
+    """
+    total = 0
+    for shard, engine in user_engines():
+        last_user_id = None
+        while True:
+            rows = engine.execute(text("""select user_id, public_address, enc_phone_number from public.user
+                                          where (cast(:last_user_id as uuid) is null or user_id > cast(:last_user_id as uuid))
+                                          order by user_id limit :limit;"""),
+                                  {'last_user_id': last_user_id, 'limit': batch_size}).fetchall()
+            if not rows:
+                break
+            last_user_id = str(rows[-1][0])
+
+            params = {'shard': shard}
+            for index, (user_id, public_address, enc_phone_number) in enumerate(rows):
+                params.update({'user_id_%s' % index: str(user_id), 'public_address_%s' % index: public_address,
+                               'enc_phone_number_%s' % index: enc_phone_number})
+            values = ', '.join('(cast(:user_id_%(i)s as uuid), :public_address_%(i)s, :enc_phone_number_%(i)s)' % {'i': index}
+                               for index in range(len(rows)))
+            total += db.engine.execute(text("""insert into public.user_directory (user_id, shard, public_address, enc_phone_number, update_at)
+                                               select v.user_id, :shard, v.public_address, v.enc_phone_number, now()
+                                               from (values %s) as v (user_id, public_address, enc_phone_number)
+                                               on conflict (user_id) do update set shard = excluded.shard,
+                                               public_address = excluded.public_address, enc_phone_number = excluded.enc_phone_number,
+                                               update_at = now()
+                                               where (user_directory.shard, user_directory.public_address, user_directory.enc_phone_number)
+                                               is distinct from (excluded.shard, excluded.public_address, excluded.enc_phone_number);""" % values),
+                                       params).rowcount
+            log.info('backfill_user_directory: wrote %s entries so far (shard %s)' % (total, shard))
+    return total
+
+
 def deactivate_by_enc_phone_number(enc_phone_number, new_user_id, activate_user=False):
     """deactivate any active user with the given phone number except the one with user_id
 
@@ -639,7 +838,8 @@ def deactivate_by_enc_phone_number(enc_phone_number, new_user_id, activate_user=
 
     if activate_user: # used in backup-restore
         log.info('activating user %s prior to deactivating all other user_ids' % new_user_id)
-        db.engine.execute("update public.user set deactivated=false where user_id='%s'" % new_user_id)
+        user_engine(new_user_id).execute("update public.user set deactivated=false where user_id='%s'" % new_user_id)
+        invalidate_user_context(new_user_id)
     try:
         # find candidates to de-activate (except user_id)
         users = User.query.filter(User.enc_phone_number == enc_phone_number).filter(User.user_id != new_user_id).filter(User.deactivated == False).all()
@@ -654,7 +854,8 @@ def deactivate_by_enc_phone_number(enc_phone_number, new_user_id, activate_user=
 
             for user_id_to_deactivate in user_ids_to_deactivate:
                 # deactivate and copy task_history and next_task_ts
-                db.engine.execute("update public.user set deactivated=true where enc_phone_number='%s' and user_id='%s'" % (enc_phone_number, user_id_to_deactivate))
+                user_engine(user_id_to_deactivate).execute("update public.user set deactivated=true where enc_phone_number='%s' and user_id='%s'" % (enc_phone_number, user_id_to_deactivate))
+                invalidate_user_context(user_id_to_deactivate)
 
     except Exception as e:
         log.error('cant deactivate_by_phone_number. Exception: %s' % e)
@@ -678,8 +879,8 @@ def nuke_user_data(phone_number):
     log.info('nuking all users with the phone number: %s' % phone_number)
     user_ids = get_all_user_id_by_phone(phone_number)
     for user_id in user_ids:
-        db.engine.execute("update public.user set onboarded = false where user_id = '%s'" % user_id)
-        db.engine.execute("delete from public.transaction where user_id='%s'" % user_id)
+        user_engine(user_id).execute("update public.user set onboarded = false where user_id = '%s'" % user_id)
+        user_engine(user_id).execute("delete from public.transaction where user_id='%s'" % user_id)
 
     # also erase the backup hints for the phone
     # db.engine.execute("delete from phone_backup_hints where enc_phone_number='%s'" % app.encryption.encrypt(phone_number))
@@ -689,37 +890,20 @@ def nuke_user_data(phone_number):
 
 def get_user_config(user_id):
     """return the user-specific config based on the global config"""
-    global_config = get_global_config()
+    from .system_config import get_version_policy, build_client_config
     user_app_data = get_user_app_data(user_id)
-    os_type = get_user_os_type(user_id)
+    return build_client_config(get_version_policy(), get_user_os_type(user_id), user_app_data.app_ver)
 
-    # turn off phone verification for older clients:
-    disable_phone_verification = False
-    disable_backup_nag = True
-    if os_type == OS_ANDROID and LooseVersion(user_app_data.app_ver) <= LooseVersion(config.BLOCK_ONBOARDING_ANDROID_VERSION):
-        disable_phone_verification = True
-    elif os_type == OS_IOS and LooseVersion(user_app_data.app_ver) <= LooseVersion(config.BLOCK_ONBOARDING_IOS_VERSION):
-        disable_phone_verification = True
 
-    from .system_config import should_force_update, is_update_available
-    if should_force_update(os_type, user_app_data.app_ver):
-        global_config['force_update'] = True
+def get_user_config_payload(user_id, app_ver=None):
+    """return the serialized app-launch response (with the user-specific config) for the given user_id.
 
-    if is_update_available(os_type, user_app_data.app_ver):
-        global_config['is_update_available'] = True
-
-    if disable_phone_verification:
-        log.info('disabling phone verification for userid %s' % user_id)
-        global_config['phone_verification_enabled'] = False
-
-    if disable_backup_nag:
-        log.info('disabling backup nag for userid %s' % user_id)
-        global_config['backup_nag'] = False
-
-
-    log.info('user config for %s: %s' % (user_id, global_config))
-
-    return global_config
+    app_ver is the version the client just reported - it may not have been written yet
+    """
+    from .system_config import get_client_config_payload
+    if app_ver is None:
+        app_ver = get_user_app_data(user_id).app_ver
+    return get_client_config_payload(get_user_os_type(user_id), app_ver)
 
 
 def get_user_report(user_id):
@@ -772,8 +956,8 @@ def get_user_report(user_id):
 
 def get_unauthed_users():
     l = []
-    results = db.engine.execute("select * from public.user, push_auth_token where public.user.user_id=push_auth_token.user_id and push_auth_token.authenticated=false and push_auth_token.send_date is not null and public.user.deactivated=false and public.user.enc_phone_number is not null;")
-    res = results.fetchall()
+    # a user's push_auth_token is on the user's shard
+    res = user_scatter_gather(text("select * from public.user, push_auth_token where public.user.user_id=push_auth_token.user_id and push_auth_token.authenticated=false and push_auth_token.send_date is not null and public.user.deactivated=false and public.user.enc_phone_number is not null;"))
     for item in res:
         l.append(str(item.user_id))
 
@@ -859,7 +1043,7 @@ def migrate_restored_user_data(temp_user_id, restored_user_id):
 
 def should_block_user_by_client_version(user_id):
     """determines whether this user_id should be blocked based on the client version"""
-    from distutils.version import LooseVersion
+    from .system_config import get_version_policy
     try:
         os_type = get_user_os_type(user_id)
         client_version = get_user_app_data(user_id).app_ver
@@ -868,11 +1052,11 @@ def should_block_user_by_client_version(user_id):
         return False
     else:
         if os_type == OS_ANDROID:
-            if LooseVersion(client_version) <= LooseVersion(config.BLOCK_ONBOARDING_ANDROID_VERSION):
+            if get_version_policy().should_block_onboarding(OS_ANDROID, client_version):
                 log.info('should block android version (%s), config: %s' % (client_version, config.BLOCK_ONBOARDING_ANDROID_VERSION))
                 return True
         else: # OS_IOS
-            if LooseVersion(client_version) <= LooseVersion(config.BLOCK_ONBOARDING_IOS_VERSION):
+            if get_version_policy().should_block_onboarding(OS_IOS, client_version):
                 log.info('should block ios version (%s), config: %s' % (client_version, config.BLOCK_ONBOARDING_IOS_VERSION))
                 return True
     return False
@@ -928,10 +1112,11 @@ def delete_all_user_data(user_id, are_u_sure=False):
     delete_user_transactions = '''delete from transaction where user_id='%s';'''
     delete_p2p_txs_sent = '''delete from p2_p_transaction where sender_user_id='%s';'''
     delete_p2p_txs_received = '''delete from p2_p_transaction where receiver_user_id='%s';'''
-    delete_phone_backup_hints = '''delete from phone_backup_hints where enc_phone_number in (select enc_phone_number from public.user where user_id='%s');'''
+    delete_phone_backup_hints = '''delete from phone_backup_hints where enc_phone_number = :enc_phone_number;'''
     delete_auth_token = '''delete from public.push_auth_token where user_id='%s';'''
     delete_app_data = '''delete from public.user_app_data where user_id='%s';'''
     delete_user = '''delete from public.user where user_id='%s';'''
+    delete_directory_entry = '''delete from public.user_directory where user_id='%s';'''
 
     # get all the user_ids associated with this user's phone number:
     enc_phone = get_enc_phone_number_by_user_id(user_id)
@@ -946,26 +1131,26 @@ def delete_all_user_data(user_id, are_u_sure=False):
 
     for uid in uids:
         log.info('deleting all data related to user_id %s' % uid)
+        # the user's own tables are on the user's shard
         log.info('deleting txs...')
-        db.engine.execute(delete_user_transactions % uid)
+        user_engine(uid).execute(delete_user_transactions % uid)
         log.info('deleting p2p txs...')
         db.engine.execute(delete_p2p_txs_sent % uid)
         db.engine.execute(delete_p2p_txs_received % uid)
         log.info('deleting backup hints...')
-        db.engine.execute(delete_phone_backup_hints % uid)
+        db.engine.execute(text(delete_phone_backup_hints), {'enc_phone_number': enc_phone})
         log.info('deleting auth tokens...')
-        db.engine.execute(delete_auth_token % uid)
+        user_engine(uid).execute(delete_auth_token % uid)
         log.info('deleting user data...')
-        db.engine.execute(delete_app_data % uid)
-        db.engine.execute(delete_user % uid)
+        user_engine(uid).execute(delete_app_data % uid)
+        user_engine(uid).execute(delete_user % uid)
+        db.engine.execute(delete_directory_entry % uid)
         log.info('done with user_id: %s' % uid)
 
 
 def count_registrations_for_phone_number(phone_number):
     """returns the number of registrations for the given unenc phone number"""
-    enc_phone_number = app.encryption.encrypt(phone_number)
-    count_users_with_enc_phone_number = '''select count(*) from public.user where enc_phone_number='%s';'''
-    count = db.engine.execute(count_users_with_enc_phone_number % enc_phone_number).scalar()
+    count = User.query.filter(phone_number_filter(phone_number)).count()
     return count if count else 0
 
 
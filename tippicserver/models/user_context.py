@@ -0,0 +1,98 @@
+"""request-scoped user context.
+
+a single authenticated request used to hit the db 4-6 times for the same user_id (user, user_app_data,
+push_auth_token and the blacklist join). the UserContext loads all of these rows with one joined query
+(the blacklist status is checked against the cached blacklist, on first use) and keeps them on flask.g for the remainder of the request. the helpers in models/user.py (and friends)
+read from the context when one is available and fall back to their own queries otherwise (rq jobs, scripts).
+"""
+import logging as log
+
+from flask import g, has_request_context
+
+from tippicserver import db
+
+
+class UserContext(object):
+    """holds the rows related to a single user_id for the duration of a request"""
+
+    def __init__(self, user_id, user=None, user_app_data=None, push_auth_token=None, blacklisted=None):
+        self.user_id = user_id
+        self.user = user
+        self.user_app_data = user_app_data
+        self.push_auth_token = push_auth_token
+        self._blacklisted = blacklisted
+
+    @property
+    def blacklisted(self):
+        if self._blacklisted is None:
+            from .blacklisted_phone_numbers import is_enc_phone_number_blacklisted
+            self._blacklisted = self.user is not None and is_enc_phone_number_blacklisted(self.user.enc_phone_number)
+        return self._blacklisted
+
+    def __repr__(self):
+        return '<UserContext user_id: %s, user: %s, user_app_data: %s, push_auth_token: %s, blacklisted: %s>' % \
+               (self.user_id, self.user is not None, self.user_app_data is not None,
+                self.push_auth_token is not None, self._blacklisted)
+
+
+def _context_key(user_id):
+    return str(user_id).lower()
+
+
+def load_user_context(user_id):
+    """loads the user, app data and auth token with a single joined query"""
+    from .user import User, UserAppData
+    from .push_auth_token import PushAuthToken
+
+    try:
+        row = db.session.query(User, UserAppData, PushAuthToken) \
+            .outerjoin(UserAppData, UserAppData.user_id == User.user_id) \
+            .outerjoin(PushAuthToken, PushAuthToken.user_id == User.user_id) \
+            .filter(User.user_id == user_id).first()
+    except Exception as e:
+        log.error('load_user_context: cant load context for user_id %s. e: %s' % (user_id, e))
+        return None
+
+    if row is None:
+        return UserContext(user_id)
+
+    user, user_app_data, push_auth_token = row
+    return UserContext(user_id, user, user_app_data, push_auth_token)
+
+
+def get_user_context(user_id):
+    """returns the UserContext for the given user_id, loading it on first use within the request.
+
+    returns None outside of a request context, or if the context couldn't be loaded
+    """
+    if user_id is None or not has_request_context():
+        return None
+
+    contexts = getattr(g, 'user_contexts', None)
+    if contexts is None:
+        contexts = g.user_contexts = {}
+
+    key = _context_key(user_id)
+    if key not in contexts:
+        context = load_user_context(user_id)
+        if context is None:
+            return None
+        contexts[key] = context
+    return contexts[key]
+
+
+def invalidate_user_context(user_id=None):
+    """drops the cached context for the given user_id (or all of them). call this after writes that
+    bypass the orm objects held by the context (raw sql, row creation, blacklisting)
+    """
+    if not has_request_context():
+        return
+
+    contexts = getattr(g, 'user_contexts', None)
+    if not contexts:
+        return
+
+    if user_id is None:
+        contexts.clear()
+    else:
+        contexts.pop(_context_key(user_id), None)
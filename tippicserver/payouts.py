@@ -0,0 +1,372 @@
+"""the payout engine: outgoing payments are queued and sent in multi-op txs, one per channel in parallel.
+
+every call to stellar.send_kin used to submit a single-op tx. the engine drains the payouts queue with one thread
+per channel seed, packs up to MAX_OPS_PER_TX payments (with the same memo) into each tx and reports the result of
+every payment back to create_tx. if a batch surely failed, its payments are retried one by one so that a single
+bad destination can't fail the others.
+
+popped payouts stay in flight - with a lease - until their result is recorded. the lease is renewed right before
+every send, and the tx a payout is submitted in is recorded before it is submitted - only if the lease is still
+held. a payout whose lease expired (its worker died or stalled, or its tx's outcome was unknown) is settled by
+resolve_stale_payouts: it is sent again only if it was never submitted, or if its tx isn't on the ledger after the
+tx's max_time - after which it can't be applied anymore. a worker that lost a payout's lease doesn't send it.
+only one payouts job runs at a time, on any host.
+
+payouts are idempotent by payout_id: a payout that was already queued (or sent) is not queued again. nothing waits
+for a payout to be sent: a payout may name an on_complete function, which is enqueued on the fast queue with its
+result. the payouts job runs on its own queue and worker, as it may wait for the payouts in flight to settle.
+"""
+import json
+import logging as log
+import threading
+import time
+
+import redis_lock
+from rq.utils import import_attribute
+
+from tippicserver import app, config, db
+from tippicserver.stellar import send_kin_batch, is_tx_on_ledger, MAX_OPS_PER_TX, BATCH_SENT, BATCH_FAILED
+from tippicserver.utils import increment_metric
+
+PAYOUTS_QUEUE_KEY = 'payouts-queue'
+PAYOUTS_INFLIGHT_KEY = 'payouts-inflight'  # sorted set of the popped queue entries, by their lease's expiry
+PAYOUTS_SUBMITTED_KEY = 'payouts-submitted'  # hash of payout_id -> the tx it was submitted in
+PAYOUTS_SCHEDULED_KEY = 'payouts-scheduled'
+PAYOUTS_LOCK_NAME = 'payouts-job'
+PAYOUT_KEY = 'payout:%s'  # set while the payout is queued or sent
+PAYOUT_RESULT_KEY = 'payout-result:%s'
+PAYOUT_TTL_SECS = 24 * 60 * 60
+PAYOUT_LEASE_SECS = 60  # how long a popped payout may go unsubmitted before it's considered abandoned
+PAYOUT_SETTLE_GRACE_SECS = 30  # how long after its tx's max_time a payout with an unknown outcome is looked up
+PAYOUTS_JOB_TIMEOUT_SECS = 600
+PAYOUT_ON_COMPLETE_TIMEOUT_SECS = 120
+
+PAYOUT_SENT = 'sent'
+PAYOUT_FAILED = 'failed'
+
+# moves up to ARGV[1] entries from the head of the queue to the in-flight set, leased until ARGV[2]
+POP_PAYOUTS_SCRIPT = """
+local entries = redis.call('lrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #entries > 0 then
+    redis.call('ltrim', KEYS[1], #entries, -1)
+    for _, entry in ipairs(entries) do
+        redis.call('zadd', KEYS[2], ARGV[2], entry)
+    end
+end
+return entries
+"""
+
+# renews the leases (until ARGV[2]) of the entries ARGV[3..] that are still in flight and leased (past ARGV[1]).
+# returns the renewed entries
+CLAIM_PAYOUTS_SCRIPT = """
+local claimed = {}
+for i = 3, #ARGV do
+    local leased_until = redis.call('zscore', KEYS[1], ARGV[i])
+    if leased_until and tonumber(leased_until) > tonumber(ARGV[1]) then
+        redis.call('zadd', KEYS[1], ARGV[2], ARGV[i])
+        table.insert(claimed, ARGV[i])
+    end
+end
+return claimed
+"""
+
+# records the submissions of the (entry, payout_id, submission) triplets in ARGV[3..] and leases their entries
+# until ARGV[2] - only if all of them are still in flight and leased (past ARGV[1])
+RECORD_SUBMISSION_SCRIPT = """
+for i = 3, #ARGV, 3 do
+    local leased_until = redis.call('zscore', KEYS[1], ARGV[i])
+    if not leased_until or tonumber(leased_until) <= tonumber(ARGV[1]) then
+        return 0
+    end
+end
+for i = 3, #ARGV, 3 do
+    redis.call('hset', KEYS[2], ARGV[i + 1], ARGV[i + 2])
+    redis.call('zadd', KEYS[1], ARGV[2], ARGV[i])
+end
+return 1
+"""
+
+# moves an in-flight entry back to the queue - once, even if several jobs settle it at the same time
+REQUEUE_PAYOUT_SCRIPT = """
+if redis.call('zrem', KEYS[2], ARGV[1]) == 1 then
+    redis.call('rpush', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+def enqueue_payout(payout_id, user_id, public_address, amount, tx_type, tx_for_item_id, memo=None, on_complete=None):
+    """queues a payment for the engine. returns False if a payout with this id was already queued or sent.
+    on_complete is the dotted path of a function that is called with (payout_id, user_id, public_address, status)
+    once the payout is sent or failed
+    """
+    if not app.redis.set(PAYOUT_KEY % payout_id, 1, nx=True, ex=PAYOUT_TTL_SECS):
+        return False
+    app.redis.delete(PAYOUT_RESULT_KEY % payout_id)  # a failed attempt's result
+
+    app.redis.rpush(PAYOUTS_QUEUE_KEY, json.dumps({
+        'payout_id': payout_id, 'user_id': str(user_id), 'public_address': public_address, 'amount': amount,
+        'tx_type': tx_type, 'tx_for_item_id': tx_for_item_id, 'memo': memo, 'on_complete': on_complete}))
+    increment_metric('payout-queued')
+    schedule_payouts()
+    return True
+
+
+def get_payout_result(payout_id):
+    """returns the result dict (status, tx_hash) of the given payout, or None if it wasn't processed yet"""
+    result = app.redis.get(PAYOUT_RESULT_KEY % payout_id)
+    return json.loads(result.decode()) if result else None
+
+
+def schedule_payouts():
+    """makes sure a payouts job is queued on the payouts queue (or, on test envs, drains the queue right away)"""
+    if config.PAYOUTS_INLINE:
+        process_payouts()
+        return
+    try:
+        if app.redis.set(PAYOUTS_SCHEDULED_KEY, 1, nx=True, ex=PAYOUTS_JOB_TIMEOUT_SECS):
+            app.rq_payouts.enqueue_call(func=process_payouts, timeout=PAYOUTS_JOB_TIMEOUT_SECS)
+    except Exception as e:
+        log.error('schedule_payouts: cant enqueue the payouts job. e: %s' % e)
+
+
+def decode_payout(entry):
+    """returns the payout in the given queue entry. the entry identifies it while it's in flight"""
+    payout = json.loads(entry.decode())
+    payout['entry'] = entry
+    return payout
+
+
+def pop_payouts(count):
+    """atomically moves up to count payouts from the queue to the in-flight set"""
+    entries = app.redis.eval(POP_PAYOUTS_SCRIPT, 2, PAYOUTS_QUEUE_KEY, PAYOUTS_INFLIGHT_KEY,
+                             count, time.time() + PAYOUT_LEASE_SECS)
+    return [decode_payout(entry) for entry in entries]
+
+
+def requeue_payout(payout):
+    app.redis.hdel(PAYOUTS_SUBMITTED_KEY, payout['payout_id'])
+    if app.redis.eval(REQUEUE_PAYOUT_SCRIPT, 2, PAYOUTS_QUEUE_KEY, PAYOUTS_INFLIGHT_KEY, payout['entry']):
+        increment_metric('payout-requeued')
+
+
+class PayoutLeaseLost(Exception):
+    """raised to abort the submission of payouts whose lease this worker no longer holds"""
+
+
+def claim_payouts(payouts):
+    """renews the leases of the given payouts right before they are sent. returns the ones this worker still holds -
+    the others' leases expired, and resolve_stale_payouts may have handed them to another job
+    """
+    now = time.time()
+    entries = app.redis.eval(CLAIM_PAYOUTS_SCRIPT, 1, PAYOUTS_INFLIGHT_KEY, now, now + PAYOUT_LEASE_SECS,
+                             *[payout['entry'] for payout in payouts])
+    claimed = set(entries)
+    if len(claimed) < len(payouts):
+        log.warning('claim_payouts: lost the lease of %s payouts' % (len(payouts) - len(claimed)))
+        increment_metric('payout-lease-lost', len(payouts) - len(claimed))
+    return [payout for payout in payouts if payout['entry'] in claimed]
+
+
+def extend_lease(client, entry, until):
+    # only while the payout is in flight (ZADD XX) - a completed payout must not come back
+    client.execute_command('ZADD', PAYOUTS_INFLIGHT_KEY, 'XX', until, entry)
+
+
+def payout_tx_hash(tx_hash, index, batch_size):
+    # the transaction table is keyed by tx_hash - tell the ops of a multi-op tx apart
+    return tx_hash if batch_size == 1 else '%s:%s' % (tx_hash, index)
+
+
+def record_submission(payouts, tx_hash, max_time):
+    """records the tx the given payouts are about to be submitted in, and holds them until it settles. returns
+    False (and records nothing) if the lease of any of them expired
+    """
+    args = [time.time(), max_time + PAYOUT_SETTLE_GRACE_SECS]
+    for index, payout in enumerate(payouts):
+        args += [payout['entry'], payout['payout_id'], json.dumps(
+            {'tx_hash': payout_tx_hash(tx_hash, index, len(payouts)), 'onchain_tx_hash': tx_hash})]
+    return bool(app.redis.eval(RECORD_SUBMISSION_SCRIPT, 2, PAYOUTS_INFLIGHT_KEY, PAYOUTS_SUBMITTED_KEY, *args))
+
+
+def complete_payout(payout, status, tx_hash=None):
+    """records the result of a single payment, acks it and runs its on_complete"""
+    from tippicserver.models import create_tx
+
+    if status == PAYOUT_SENT:
+        create_tx(tx_hash, payout['user_id'], payout['public_address'], payout['amount'],
+                  payout['tx_type'], payout['tx_for_item_id'])
+    else:
+        # allow the payout to be retried
+        app.redis.delete(PAYOUT_KEY % payout['payout_id'])
+    increment_metric('payout-%s' % status)
+
+    pipe = app.redis.pipeline(transaction=True)
+    pipe.setex(PAYOUT_RESULT_KEY % payout['payout_id'], PAYOUT_TTL_SECS, json.dumps({'status': status, 'tx_hash': tx_hash}))
+    pipe.zrem(PAYOUTS_INFLIGHT_KEY, payout['entry'])
+    pipe.hdel(PAYOUTS_SUBMITTED_KEY, payout['payout_id'])
+    pipe.execute()
+
+    if payout.get('on_complete'):
+        run_on_complete(payout, status)
+
+
+def run_on_complete(payout, status):
+    """calls the payout's on_complete on the fast queue (or, on test envs, right away)"""
+    args = (payout['payout_id'], payout['user_id'], payout['public_address'], status)
+    try:
+        if config.PAYOUTS_INLINE:
+            import_attribute(payout['on_complete'])(*args)
+        else:
+            app.rq_fast.enqueue_call(func=payout['on_complete'], args=args, timeout=PAYOUT_ON_COMPLETE_TIMEOUT_SECS)
+    except Exception as e:
+        log.error('run_on_complete: cant run %s of payout %s. e: %s' % (payout['on_complete'], payout['payout_id'], e))
+
+
+def send_payouts(payouts):
+    """sends the given payouts (which share a memo) in a single tx, falling back to one tx per payout. payouts
+    whose lease this worker lost are left to whoever settles them
+    """
+    payouts = claim_payouts(payouts)
+    if not payouts:
+        return
+    lease_lost = []
+
+    def on_signed(tx_hash, max_time):
+        if not record_submission(payouts, tx_hash, max_time):
+            lease_lost.append(tx_hash)
+            raise PayoutLeaseLost()
+
+    status, tx_hash = send_kin_batch([(payout['public_address'], payout['amount']) for payout in payouts],
+                                     payouts[0]['memo'], on_signed=on_signed)
+    if lease_lost:
+        log.warning('send_payouts: lost the lease of a batch of %s payouts before submitting it' % len(payouts))
+        increment_metric('payout-lease-lost', len(payouts))
+        return
+
+    if status == BATCH_SENT:
+        increment_metric('payout-batch-size', len(payouts))
+        for index, payout in enumerate(payouts):
+            complete_payout(payout, PAYOUT_SENT, payout_tx_hash(tx_hash, index, len(payouts)))
+        return
+
+    if status != BATCH_FAILED:
+        # the tx may still be applied - sending the payouts again could pay twice. resolve_stale_payouts settles
+        # them once the tx's max_time passed
+        log.warning('send_payouts: unknown outcome of tx %s with %s payouts' % (tx_hash, len(payouts)))
+        increment_metric('payout-unknown', len(payouts))
+        return
+
+    if len(payouts) == 1:
+        complete_payout(payouts[0], PAYOUT_FAILED)
+        return
+
+    log.warning('send_payouts: a batch of %s payouts failed - sending them one by one' % len(payouts))
+    for payout in payouts:
+        send_payouts([payout])
+
+
+def resolve_stale_payouts(now=None):
+    """settles the in-flight payouts whose lease expired: requeues the ones that were never submitted or whose
+    tx never made it to the ledger, and completes the ones whose tx did. returns the number of payouts settled
+    """
+    settled = 0
+    for entry in app.redis.zrangebyscore(PAYOUTS_INFLIGHT_KEY, '-inf', now or time.time()):
+        payout = decode_payout(entry)
+        submission = app.redis.hget(PAYOUTS_SUBMITTED_KEY, payout['payout_id'])
+        if submission is None:
+            # its worker died before submitting it
+            requeue_payout(payout)
+            settled += 1
+            continue
+
+        submission = json.loads(submission.decode())
+        on_ledger = is_tx_on_ledger(submission['onchain_tx_hash'])
+        if on_ledger is None:
+            # horizon failed us - look again later
+            extend_lease(app.redis, entry, time.time() + PAYOUT_LEASE_SECS)
+            continue
+        if on_ledger:
+            complete_payout(payout, PAYOUT_SENT, submission['tx_hash'])
+        else:
+            # past its max_time, the tx can't be applied anymore
+            requeue_payout(payout)
+        settled += 1
+    if settled:
+        log.info('resolve_stale_payouts: settled %s payouts' % settled)
+    return settled
+
+
+def secs_to_next_stale_payout():
+    """returns the secs until the next in-flight payout's lease expires, or None if none are in flight"""
+    first = app.redis.zrange(PAYOUTS_INFLIGHT_KEY, 0, 0, withscores=True)
+    return first[0][1] - time.time() if first else None
+
+
+def payouts_worker():
+    """sends batches from the queue until it is empty. one worker runs per channel"""
+    while True:
+        payouts = pop_payouts(MAX_OPS_PER_TX)
+        if not payouts:
+            return
+        # a tx has a single memo
+        by_memo = {}
+        for payout in payouts:
+            by_memo.setdefault(payout['memo'], []).append(payout)
+        for batch in by_memo.values():
+            try:
+                send_payouts(batch)
+            except Exception as e:
+                # some may have been submitted - they stay in flight until resolve_stale_payouts settles them
+                log.error('payouts_worker: failed to send a batch of %s payouts. e: %s' % (len(batch), e))
+
+
+def payouts_worker_thread():
+    try:
+        payouts_worker()
+    finally:
+        # each thread has its own db session
+        db.session.remove()
+
+
+def process_payouts():
+    """the payouts job: drains the payouts queue with one worker thread per channel, then waits for the payouts
+    in flight to settle (on test envs, it doesn't wait). returns False if another payouts job is running
+    """
+    # from here on, new payouts need a new job
+    app.redis.delete(PAYOUTS_SCHEDULED_KEY)
+    lock = redis_lock.Lock(app.redis, PAYOUTS_LOCK_NAME, expire=PAYOUTS_JOB_TIMEOUT_SECS)
+    if not lock.acquire(blocking=False):
+        # the running job schedules the next one if payouts are left when it's done
+        log.info('process_payouts: another payouts job is running')
+        return False
+    try:
+        drain_payouts()
+    finally:
+        lock.release()
+
+    if not config.PAYOUTS_INLINE and (app.redis.llen(PAYOUTS_QUEUE_KEY) or secs_to_next_stale_payout() is not None):
+        # queued while the lock was held, or still in flight when the job ran out of time
+        schedule_payouts()
+    return True
+
+
+def drain_payouts():
+    """sends the queued payouts and settles the stale ones until none are in flight, or the job runs out of time"""
+    deadline = time.time() + PAYOUTS_JOB_TIMEOUT_SECS - PAYOUT_LEASE_SECS
+    while True:
+        resolve_stale_payouts()
+        workers = [threading.Thread(target=payouts_worker_thread) for _ in range(app.kin_channels_count)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        secs_to_next = secs_to_next_stale_payout()
+        if secs_to_next is None or config.PAYOUTS_INLINE:
+            return
+        if time.time() + secs_to_next > deadline:
+            # out of time - the next job settles them
+            return
+        time.sleep(max(secs_to_next, 0.1))
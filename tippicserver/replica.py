@@ -0,0 +1,113 @@
+"""routing the read-only model helpers to a read replica.
+
+helpers decorated with @read_only may read from the replica (the 'replica' bind, DB_REPLICA_CONNSTR) when:
+- they run in a GET/HEAD request. writers read through the same helpers, and must see the primary's data
+- nothing was written in this request's session yet (read-your-writes): any flush or commit pins the session
+  to the primary until the request ends
+- the replica's lag is within DB_REPLICA_MAX_LAG_SECS
+everything else, and everything outside of requests (workers, scripts), reads from the primary.
+"""
+import functools
+import logging as log
+import threading
+import time
+
+from flask import has_request_context, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+from tippicserver.utils import increment_metric, gauge_metric
+
+REPLICA_BIND = 'replica'
+PRIMARY = 'primary'
+READ_ONLY_KEY = 'read-only'
+PINNED_TO_PRIMARY_KEY = 'pinned-to-primary'
+REPLICA_METHODS = ('GET', 'HEAD')
+# 0 on a primary, null on a replica that didn't replay anything yet. an idle primary makes the lag grow - which only
+# sends the reads to the primary
+REPLICA_LAG_QUERY = '''select case when pg_is_in_recovery() then extract(epoch from now() - pg_last_xact_replay_timestamp())
+                       else 0 end'''
+
+
+class Replica(object):
+    """the read replica's engine and (cached) lag"""
+
+    def __init__(self, db, max_lag_secs, lag_check_secs):
+        self.db = db
+        self.max_lag_secs = max_lag_secs
+        self.lag_check_secs = lag_check_secs
+        self.forced = None  # REPLICA_BIND or PRIMARY to skip the lag check - for tests and emergencies
+        self._lag = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self):
+        return self.db.get_engine(bind=REPLICA_BIND)
+
+    def lag(self):
+        """returns the replica's lag in seconds, or None if it's unknown. checked at most every lag_check_secs"""
+        if time.time() - self._checked_at < self.lag_check_secs:
+            return self._lag
+        with self._lock:
+            if time.time() - self._checked_at >= self.lag_check_secs:
+                try:
+                    lag = self.engine.execute(REPLICA_LAG_QUERY).scalar()
+                    self._lag = float(lag) if lag is not None else None
+                except Exception as e:
+                    log.error('cant get the replica lag. e: %s' % e)
+                    self._lag = None
+                self._checked_at = time.time()
+                if self._lag is not None:
+                    gauge_metric('db-replica-lag', self._lag)
+        return self._lag
+
+    def available(self):
+        if self.forced is not None:
+            return self.forced == REPLICA_BIND
+        lag = self.lag()
+        return lag is not None and lag <= self.max_lag_secs
+
+
+class ReplicaSession(SignallingSession):
+    """a session that sends the reads of the read_only helpers to the replica, when it's safe to"""
+
+    def __init__(self, db, replica, **options):
+        super(ReplicaSession, self).__init__(db, **options)
+        self.replica = replica
+
+    def use_replica(self):
+        if not self.info.get(READ_ONLY_KEY) or self.info.get(PINNED_TO_PRIMARY_KEY) or self._flushing:
+            return False
+        if not has_request_context() or request.method not in REPLICA_METHODS:
+            return False
+        if not self.replica.available():
+            increment_metric('db-replica-fallback')
+            return False
+        return True
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.use_replica():
+            return self.replica.engine
+        return super(ReplicaSession, self).get_bind(mapper, clause)
+
+
+@event.listens_for(ReplicaSession, 'after_flush')
+@event.listens_for(ReplicaSession, 'after_commit')
+def pin_to_primary(session, *args):
+    """the rest of the request reads its own writes"""
+    session.info[PINNED_TO_PRIMARY_KEY] = True
+
+
+def read_only(func):
+    """marks a model helper as read-only, so its queries may be sent to the replica"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        from tippicserver import db
+        session = db.session()
+        session.info[READ_ONLY_KEY] = session.info.get(READ_ONLY_KEY, 0) + 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            session.info[READ_ONLY_KEY] -= 1
+    return wrapper
@@ -0,0 +1,242 @@
+"""routing the per-user tables to shards, by user_id.
+
+the user, user_app_data, push_auth_token and transaction rows of a user all live on the shard its user_id hashes
+to, on a consistent-hash ring with virtual nodes - adding a shard moves only ~1/n of the users. everything else
+stays on the default shard (the main DB_CONNSTR database), which is also a member of the ring.
+
+sharding is off unless DB_SHARDS is configured. when it's on, db.session is a ShardedSession: orm writes go to
+the shard of the written row, and queries go to the shards of the user_ids they filter on - or to all the shards
+(scatter-gather) when they don't filter on one. raw statements (db.engine.execute, db.session.execute) run on
+the default shard: run a user's statements on models.user_engine(user_id), and the statements over all the users
+with models.user_scatter_gather (or on each of models.user_engines()).
+
+the user_directory table on the default shard maps the users to their shards and cross-user lookup keys (address,
+phone number). it is written on every flush of a user, and backfilled by /users/directory/backfill.
+"""
+import bisect
+import hashlib
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_sqlalchemy import SQLAlchemy, BaseQuery
+from sqlalchemy import create_engine, orm
+from sqlalchemy.ext.horizontal_shard import ShardedSession, ShardedQuery
+from sqlalchemy.orm.query import Query
+from sqlalchemy.sql import visitors, operators
+
+from tippicserver.db_pool import InstrumentedQueuePool
+from tippicserver.replica import ReplicaSession
+
+DEFAULT_SHARD = 'default'
+SHARD_VIRTUAL_NODES = 100
+SHARDED_TABLES = {'user', 'user_app_data', 'push_auth_token', 'transaction'}  # keyed by their user_id column
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+def normalize_user_id(user_id):
+    """returns the canonical string form of the given user_id, so all of its forms hash the same"""
+    try:
+        return str(user_id if isinstance(user_id, uuid.UUID) else uuid.UUID(str(user_id)))
+    except ValueError:
+        return str(user_id)
+
+
+class HashRing(object):
+    """a consistent-hash ring with virtual nodes"""
+
+    def __init__(self, nodes, virtual_nodes=SHARD_VIRTUAL_NODES):
+        self.nodes = sorted(nodes)
+        ring = sorted((_hash('%s#%s' % (node, i)), node) for node in self.nodes for i in range(virtual_nodes))
+        self._positions = [position for position, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def get_node(self, key):
+        index = bisect.bisect(self._positions, _hash(key)) % len(self._positions)
+        return self._nodes[index]
+
+
+def _user_id_comparisons(query):
+    """returns the values the query's criterion compares a user_id column to with '='"""
+    binds = {}
+    columns = set()
+    values = []
+
+    def visit_bindparam(bind):
+        if bind.key in query._params:
+            binds[bind] = query._params[bind.key]
+        elif bind.callable:
+            binds[bind] = bind.callable()
+        else:
+            binds[bind] = bind.value
+
+    def visit_column(column):
+        columns.add(column)
+
+    def visit_binary(binary):
+        if binary.operator != operators.eq:
+            return
+        if binary.left in columns and binary.right in binds:
+            column, value = binary.left, binds[binary.right]
+        elif binary.right in columns and binary.left in binds:
+            column, value = binary.right, binds[binary.left]
+        else:
+            return
+        if column.name == 'user_id' and column.table.name in SHARDED_TABLES:
+            values.append(value)
+
+    if query._criterion is not None:
+        visitors.traverse_depthfirst(query._criterion, {}, {'bindparam': visit_bindparam, 'column': visit_column,
+                                                            'binary': visit_binary})
+    return values
+
+
+class ShardRouter(object):
+    """maps user_ids to shards, and holds the shards' engines"""
+
+    def __init__(self, db, shards, virtual_nodes=SHARD_VIRTUAL_NODES, engine_options=None):
+        self.db = db
+        self.connstrs = dict(shards)
+        self.shard_names = [DEFAULT_SHARD] + sorted(self.connstrs)
+        self.ring = HashRing(self.shard_names, virtual_nodes)
+        self.engine_options = engine_options or {}
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    def get_engine(self, shard):
+        if shard == DEFAULT_SHARD:
+            return self.db.engine
+        if shard not in self._engines:
+            with self._lock:
+                if shard not in self._engines:
+                    self._engines[shard] = create_engine(self.connstrs[shard], **self.engine_options)
+        return self._engines[shard]
+
+    def engines(self):
+        return {shard: self.get_engine(shard) for shard in self.shard_names}
+
+    def shard_for(self, user_id):
+        return self.ring.get_node(normalize_user_id(user_id))
+
+    @staticmethod
+    def _is_sharded(mapper):
+        return mapper is not None and mapper.local_table.name in SHARDED_TABLES
+
+    def shard_chooser(self, mapper, instance, clause=None):
+        """the shard to write the given instance to (or to run a statement on)"""
+        if self._is_sharded(mapper) and instance is not None and instance.user_id is not None:
+            return self.shard_for(instance.user_id)
+        return DEFAULT_SHARD
+
+    def id_chooser(self, query, ident):
+        """the shards a row with the given primary key may be on"""
+        mapper = query._mapper_zero()
+        if not self._is_sharded(mapper):
+            return [DEFAULT_SHARD]
+        if [column.name for column in mapper.primary_key] == ['user_id']:
+            return [self.shard_for(ident[0])]
+        return self.shard_names
+
+    def query_chooser(self, query):
+        """the shards the given query should run on"""
+        if not self._is_sharded(query._mapper_zero()):
+            return [DEFAULT_SHARD]
+        user_ids = _user_id_comparisons(query)
+        if user_ids:
+            return sorted(set(self.shard_for(user_id) for user_id in user_ids))
+        return self.shard_names
+
+    def scatter_gather(self, statement, params=None, shards=None):
+        """runs the given statement on the given shards (default: all) concurrently. returns all the rows"""
+        shards = shards or self.shard_names
+
+        def run(shard):
+            return self.get_engine(shard).execute(statement, params or {}).fetchall()
+
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            return [row for rows in executor.map(run, shards) for row in rows]
+
+    def create_all(self):
+        """creates the tables on all the shards"""
+        for shard in self.shard_names:
+            self.db.Model.metadata.create_all(bind=self.get_engine(shard))
+
+
+class RoutingSession(ShardedSession):
+    """a ShardedSession with the router's choosers and shards"""
+
+    def __init__(self, router, **options):
+        options.pop('db', None)
+        super(RoutingSession, self).__init__(shard_chooser=router.shard_chooser, id_chooser=router.id_chooser,
+                                             query_chooser=router.query_chooser, shards=router.engines(), **options)
+        self.router = router
+
+
+class RoutingQuery(BaseQuery, ShardedQuery):
+    """the models' query class. routes to the shards when the session is sharded, and is a plain query otherwise"""
+
+    def __init__(self, *args, **kwargs):
+        Query.__init__(self, *args, **kwargs)
+        self.id_chooser = getattr(self.session, 'id_chooser', None)
+        self.query_chooser = getattr(self.session, 'query_chooser', None)
+        self._shard_id = None
+
+    def _execute_and_instances(self, context):
+        if self.query_chooser is None:
+            return Query._execute_and_instances(self, context)
+        return ShardedQuery._execute_and_instances(self, context)
+
+    def get(self, ident, **kwargs):
+        if self.id_chooser is None:
+            return Query.get(self, ident, **kwargs)
+        return ShardedQuery.get(self, ident, **kwargs)
+
+    def count(self):
+        # each shard counts its own rows
+        if self.query_chooser is None or self._shard_id is not None:
+            return Query.count(self)
+        return sum(self.set_shard(shard).count() for shard in self.query_chooser(self))
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """flask-sqlalchemy whose session can be switched to a ShardedSession, or to a ReplicaSession"""
+
+    def __init__(self, *args, **kwargs):
+        self.router = None
+        self.replica = None
+        kwargs.setdefault('query_class', RoutingQuery)
+        super(RoutingSQLAlchemy, self).__init__(*args, **kwargs)
+
+    def apply_pool_defaults(self, app, options):
+        super(RoutingSQLAlchemy, self).apply_pool_defaults(app, options)
+        options['poolclass'] = InstrumentedQueuePool
+
+    def create_session(self, options):
+        if self.router is not None:
+            return orm.sessionmaker(class_=RoutingSession, router=self.router, **options)
+        if self.replica is not None:
+            return orm.sessionmaker(class_=ReplicaSession, db=self, replica=self.replica, **options)
+        return super(RoutingSQLAlchemy, self).create_session(options)
+
+    def enable_sharding(self, router):
+        self.session.remove()
+        self.router = router
+        self.session = self.create_scoped_session()
+
+    def disable_sharding(self):
+        self.session.remove()
+        self.router = None
+        self.session = self.create_scoped_session()
+
+    def enable_replica(self, replica):
+        self.session.remove()
+        self.replica = replica
+        self.session = self.create_scoped_session()
+
+    def disable_replica(self):
+        self.session.remove()
+        self.replica = None
+        self.session = self.create_scoped_session()
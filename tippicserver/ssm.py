@@ -2,6 +2,9 @@ import json
 import os
 import ast
 import logging as log
+import random
+import threading
+import time
 
 import boto3
 
@@ -23,8 +26,10 @@ def get_encrpytion_creds():
     env = os.environ.get('ENV', 'test')
     env_key = get_env_key(env)
 
-    encryption_key = get_ssm_parameter('/config/' + env_key + '/encryption/key', config.KMS_KEY_AWS_REGION)
-    iv = bytes.fromhex(get_ssm_parameter('/config/' + env_key + '/encryption/iv', config.KMS_KEY_AWS_REGION)) # the iv is encoded into hex()
+    key_name, iv_name = '/config/' + env_key + '/encryption/key', '/config/' + env_key + '/encryption/iv'
+    values = get_ssm_parameters([key_name, iv_name], config.KMS_KEY_AWS_REGION)
+    encryption_key = values[key_name]
+    iv = bytes.fromhex(values[iv_name]) # the iv is encoded into hex()
     if not encryption_key:
         log.error('cant get encryption_creds')
         raise InternalError('cant get encryption_creds')
@@ -48,8 +53,10 @@ def get_stellar_credentials():
         account_sid = '0'  # for tests, always use 0
 
     env_key = get_env_key(env)
-    base_seed = get_ssm_parameter('/config/' + env_key + '/stellar/account_sid_%s/base-seed' % account_sid, config.KMS_KEY_AWS_REGION)
-    channel_seeds = get_ssm_parameter('/config/' + env_key + '/stellar/account_sid_%s/channel-seeds' % account_sid, config.KMS_KEY_AWS_REGION)
+    base_seed_name = '/config/' + env_key + '/stellar/account_sid_%s/base-seed' % account_sid
+    channel_seeds_name = '/config/' + env_key + '/stellar/account_sid_%s/channel-seeds' % account_sid
+    values = get_ssm_parameters([base_seed_name, channel_seeds_name], config.KMS_KEY_AWS_REGION)
+    base_seed, channel_seeds = values[base_seed_name], values[channel_seeds_name]
 
     if base_seed is None:
         log.error('cant get base_seed, aborting')
@@ -92,17 +99,130 @@ def convert_string_to_string_array(input):
     return json.loads('[' + str(input) + ']')
 
 
+class SSMParameterCache(object):
+    """an in-memory cache of decrypted ssm parameters, one per process and region.
+
+    values are fetched with get_parameters, 10 names per call, over a single client. a value that's older
+    than its (jittered) ttl is still served while a background thread refreshes it - callers only wait on aws
+    for values they never fetched, or that went unrefreshed for another ttl.
+    """
+    MAX_NAMES_PER_CALL = 10  # an aws limit
+    TTL_JITTER = 0.1  # spread the refreshes of values fetched together
+
+    def __init__(self, region, ttl_secs=None, client=None):
+        self.region = region
+        self.ttl_secs = ttl_secs if ttl_secs is not None else config.SSM_CACHE_TTL_SECS
+        self._client = client
+        self._values = {}  # name -> (value, refresh_at)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = boto3.client('ssm', region_name=self.region)
+        return self._client
+
+    def _refresh_at(self):
+        return time.time() + self.ttl_secs * (1 - random.uniform(0, self.TTL_JITTER))
+
+    def fetch(self, names):
+        """fetches the given names from ssm and caches them. returns a dict of name -> value (None if missing)"""
+        values = {}
+        for i in range(0, len(names), self.MAX_NAMES_PER_CALL):
+            batch = names[i:i + self.MAX_NAMES_PER_CALL]
+            print('getting params from ssm: %s' % batch)
+            res = self.client.get_parameters(Names=batch, WithDecryption=True)
+            values.update({name: None for name in batch})  # the ones in InvalidParameters dont exist
+            values.update({param['Name']: param['Value'] for param in res['Parameters']})
+
+        with self._lock:
+            for name, value in values.items():
+                self._values[name] = (value, self._refresh_at())
+        return values
+
+    def _refresh(self, names):
+        try:
+            self.fetch(names)
+        except Exception as e:
+            log.error('cant refresh ssm values %s. e: %s' % (names, e))
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(names)
+
+    def get_many(self, names):
+        """returns a dict of name -> value (None if missing or ssm can't be reached) for the given names"""
+        now = time.time()
+        values, missing, stale = {}, [], []
+        with self._lock:
+            for name in names:
+                if name not in self._values:
+                    missing.append(name)
+                    continue
+                value, refresh_at = self._values[name]
+                if now - refresh_at > self.ttl_secs:
+                    missing.append(name)  # too old to serve
+                    continue
+                values[name] = value
+                if now > refresh_at and name not in self._refreshing:
+                    stale.append(name)
+            self._refreshing.update(stale)
+
+        if stale:
+            threading.Thread(target=self._refresh, args=(stale,), daemon=True).start()
+
+        if missing:
+            try:
+                values.update(self.fetch(missing))
+            except Exception as e:
+                log.error('cant get secure values: %s from ssm' % missing)
+                print(e)
+                # serve what we have, however old
+                with self._lock:
+                    for name in missing:
+                        values[name] = self._values[name][0] if name in self._values else None
+        return values
+
+    def get(self, name):
+        return self.get_many([name])[name]
+
+    def invalidate(self, names=None):
+        """drops the given names (or everything) so that the next get fetches them from ssm"""
+        with self._lock:
+            if names is None:
+                self._values.clear()
+            else:
+                for name in names:
+                    self._values.pop(name, None)
+
+
+parameter_caches = {}  # region -> SSMParameterCache
+parameter_caches_lock = threading.Lock()
+
+
+def get_parameter_cache(kms_key_region):
+    with parameter_caches_lock:
+        if kms_key_region not in parameter_caches:
+            parameter_caches[kms_key_region] = SSMParameterCache(kms_key_region)
+        return parameter_caches[kms_key_region]
+
+
+def get_ssm_parameters(param_names, kms_key_region):
+    """retrieves the given encrypted values (cached) from AWSs ssm. returns a dict of name -> value or None"""
+    return get_parameter_cache(kms_key_region).get_many(param_names)
+
+
 def get_ssm_parameter(param_name, kms_key_region):
-    """retreives an encrpyetd value from AWSs ssm or None"""
-    try:
-        ssm_client = boto3.client('ssm', region_name=kms_key_region)
-        print('getting param from ssm: %s' % param_name)
-        res = ssm_client.get_parameter(Name=param_name, WithDecryption=True)
-        return res['Parameter']['Value']
-    except Exception as e:
-        log.error('cant get secure value: %s from ssm' % param_name)
-        print(e)
-        return None
+    """retreives an encrpyetd value (cached) from AWSs ssm or None"""
+    return get_parameter_cache(kms_key_region).get(param_name)
+
+
+def invalidate_ssm_parameters(param_names=None):
+    """drops the given (or all) values from this process' ssm caches"""
+    with parameter_caches_lock:
+        caches = list(parameter_caches.values())
+    for cache in caches:
+        cache.invalidate(param_names)
 
 
 def get_security_passwords():
@@ -110,10 +230,10 @@ def get_security_passwords():
     passwords = []
     env = os.environ.get('ENV', 'test')
     env_key = get_env_key(env)
-    password = get_ssm_parameter('/config/' + env_key + '/misc/password', config.KMS_KEY_AWS_REGION)
-    password2 = get_ssm_parameter('/config/' + env_key + '/misc/password2', config.KMS_KEY_AWS_REGION)
+    names = ['/config/' + env_key + '/misc/password', '/config/' + env_key + '/misc/password2']
+    values = get_ssm_parameters(names, config.KMS_KEY_AWS_REGION)
 
-    for item in [password, password2]:
+    for item in [values[name] for name in names]:
         if item:
             passwords.append(item)
 
@@ -1,11 +1,11 @@
 from tippicserver import app, config
 from tippicserver.utils import InvalidUsage, increment_metric
-from time import sleep
 import kin
 import requests
 import random
 import logging as log
 import json
+import time
 
 
 def get_initial_reward():
@@ -53,6 +53,78 @@ def send_kin(public_address, amount, memo=None):
         print(e)
 
 
+MAX_OPS_PER_TX = 100  # stellar's limit
+BATCH_TX_MAX_SECS = 60  # a batch tx is only valid this long, so an unknown outcome settles after it
+
+BATCH_SENT = 'sent'
+BATCH_FAILED = 'failed'  # surely not applied: it failed before it was submitted, or horizon rejected it
+BATCH_UNKNOWN = 'unknown'  # may have been applied: e.g. a timeout after it was submitted
+# the errors horizon answers a submitted tx with when it isn't applied (see KinErrors.translate_horizon_error)
+TX_REJECTED_ERRORS = (kin.KinErrors.RequestError, kin.KinErrors.AccountError, kin.KinErrors.LowBalanceError)
+
+
+def send_kin_batch(payments, memo=None, on_signed=None):
+    """sends kin to several addresses in a single multi-op tx, on one of the account's channels.
+
+    payments is a list of (public_address, amount) tuples. returns a (BATCH_ status, tx_hash) tuple. the tx is
+    atomic: either all the payments were made or none. on_signed(tx_hash, max_time) is called right before the
+    tx is submitted - a tx that isn't on the ledger by its max_time never will be.
+    """
+    if not payments or len(payments) > MAX_OPS_PER_TX:
+        log.error('cant send a batch of %s payments' % len(payments))
+        return BATCH_FAILED, None
+
+    tx_hash = None
+    submitting = False
+    try:
+        address, amount = payments[0]
+        builder = app.kin_account.build_send_kin(address, amount, fee=0, memo_text=memo)
+        source = app.kin_account.get_public_address()
+        for address, amount in payments[1:]:
+            builder.append_payment_op(address, str(amount), source=source)
+        max_time = int(time.time()) + BATCH_TX_MAX_SECS
+        builder.add_time_bounds({'minTime': 0, 'maxTime': max_time})
+
+        # the channel is held until the tx is submitted
+        with app.kin_account.channel_manager.get_channel() as channel:
+            builder.set_channel(channel)
+            builder.sign(channel)
+            # also sign with the root account if a different channel was used
+            if builder.address != source:
+                builder.sign(app.kin_account.keypair.secret_seed)
+            tx_hash = builder.hash_hex()
+            if on_signed:
+                on_signed(tx_hash, max_time)
+            submitting = True
+            # the sdk loses the hash when it tops up the channel and submits again
+            tx_hash = app.kin_account.submit_transaction(builder) or tx_hash
+    except TX_REJECTED_ERRORS as e:
+        increment_metric('send_kin_batch_error')
+        log.error('a batch of %s payments was rejected. e: %s' % (len(payments), e))
+        return BATCH_FAILED, tx_hash
+    except Exception as e:
+        increment_metric('send_kin_batch_error')
+        log.error('caught exception sending a batch of %s payments (submitted: %s). e: %s' % (len(payments), submitting, e))
+        return (BATCH_UNKNOWN if submitting else BATCH_FAILED), tx_hash
+    return BATCH_SENT, tx_hash
+
+
+def is_tx_on_ledger(tx_hash):
+    """whether the given tx is on the ledger - looked up in the ingested payments, then on horizon. None on errors"""
+    from tippicserver.models import get_ledger_payment
+
+    if get_ledger_payment(tx_hash) is not None:
+        return True
+    try:
+        app.kin_sdk.get_transaction_data(tx_hash, simple=False)
+    except kin.KinErrors.ResourceNotFoundError:
+        return False
+    except Exception as e:
+        log.error('could not look up tx_hash: %s. e: %s' % (tx_hash, e))
+        return None
+    return True
+
+
 def send_kin_with_payment_service(public_address, amount, memo=None):
     """send kins to an address using the payment service"""
 
@@ -115,30 +187,29 @@ def add_signature(id, sender_address, recipient_address, amount, transaction):
         print(e)
 
 
-def extract_tx_payment_data(tx_hash):
-    """ensures that the given tx_hash is a valid payment tx,
-       and return a dict with the memo, amount and to_address"""
+TX_LOOKUP_MISSING = 'missing'  # not (yet) on the ledger
+TX_LOOKUP_INVALID = 'invalid'  # on the ledger, but not a payment
+TX_LOOKUP_VALID = 'valid'
+TX_LOOKUP_ERROR = 'error'  # horizon failed us - try again later
+
+
+def lookup_tx_payment_data(tx_hash):
+    """looks up the given tx_hash on horizon - once, without waiting for it to show up.
+
+    returns a (result, data) tuple, where result is one of the TX_LOOKUP_ values and data is
+    a dict with the memo, amount and to_address of valid payment txs
+    """
     if tx_hash is None:
         raise InvalidUsage('invalid params')
 
-    # get the tx_hash data. this might take a second,
-    # so retry while 'Resource Missing' is recevied
-    count = 0
-    tx_data = None
-    while count < config.STELLAR_TIMEOUT_SEC:
-        try:
-            tx_data = app.kin_sdk.get_transaction_data(tx_hash)
-
-        except kin.KinErrors.ResourceNotFoundError:
-            count = count + 1
-            sleep(1)
-        else:
-            break
-
-    if tx_data is None:
-        print('could not get tx_data for tx_hash: %s. waited %s seconds' % (tx_hash, count))
-        increment_metric('tx_data_timeout')
-        return False, {}
+    try:
+        tx_data = app.kin_sdk.get_transaction_data(tx_hash)
+    except kin.KinErrors.ResourceNotFoundError:
+        return TX_LOOKUP_MISSING, {}
+    except Exception as e:
+        log.error('could not get tx_data for tx_hash: %s. e: %s' % (tx_hash, e))
+        increment_metric('tx_data_error')
+        return TX_LOOKUP_ERROR, {}
 
     # get the simple op:
     op = tx_data.operation
@@ -147,11 +218,21 @@ def extract_tx_payment_data(tx_hash):
     from kin.transactions import OperationTypes
     if op.type != OperationTypes.PAYMENT:
         print('unexpected type: %s' % op.type)
-        return False, {}
+        return TX_LOOKUP_INVALID, {}
 
     # assemble the result dict
     data = {'memo': tx_data.memo, 'amount': op.amount, 'to_address': op.destination}
-    return True, data
+    return TX_LOOKUP_VALID, data
+
+
+def lookup_tx_payment_data_many(tx_hashes):
+    """looks up the given tx_hashes on horizon concurrently. returns a dict of tx_hash -> (result, data)"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not tx_hashes:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(len(tx_hashes), config.TX_VERIFICATION_HORIZON_CONCURRENCY)) as executor:
+        return dict(zip(tx_hashes, executor.map(lookup_tx_payment_data, tx_hashes)))
 
 
 def get_kin_balance(public_address):
@@ -0,0 +1,51 @@
+import unittest
+
+import testing.postgresql
+
+import tippicserver
+from tippicserver import db, models
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        # overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        tippicserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        tippicserver.app.testing = True
+        self.app = tippicserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_acl(self):
+        """test matching addresses and networks against the cached acl"""
+        for ip_addr, name in (('1.2.3.4', 'office'), ('10.0.0.0/8', 'vpc'), ('2001:db8::/32', 'v6'), ('not-an-ip', 'typo')):
+            db.session.add(models.ACL(ip_addr=ip_addr, name=name))
+        db.session.commit()
+        models.invalidate_acl()
+
+        self.assertTrue(models.is_in_acl('1.2.3.4'))
+        self.assertFalse(models.is_in_acl('1.2.3.5'))
+        self.assertTrue(models.is_in_acl('10.20.30.40'))
+        self.assertFalse(models.is_in_acl('11.0.0.1'))
+        self.assertTrue(models.is_in_acl('2001:db8::1'))
+        self.assertFalse(models.is_in_acl('2001:db9::1'))
+        self.assertFalse(models.is_in_acl('not-an-ip'))
+        self.assertFalse(models.is_in_acl(None))
+
+        # changes are picked up once the acl is invalidated
+        db.session.add(models.ACL(ip_addr='5.6.7.0/24', name='partner'))
+        db.session.commit()
+        resp = self.app.post('/acl/invalidate')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(models.is_in_acl('5.6.7.8'))
+
+
+if __name__ == '__main__':
+    unittest.main()
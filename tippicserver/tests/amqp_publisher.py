@@ -0,0 +1,163 @@
+import threading
+import time
+import unittest
+from queue import Empty
+from unittest import mock
+
+from tippicserver import amqp_publisher
+from tippicserver.amqp_publisher import AmqpPublisher, ChannelsManager
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class StubTx(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def select(self):
+        pass
+
+    def commit(self):
+        self.channel.connection.committed.extend(self.channel.pending)
+        self.channel.pending = []
+
+    def rollback(self):
+        self.channel.pending = []
+
+
+class StubChannel(object):
+    """a stand-in for an amqpstorm channel"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.basic = self
+        self.tx = StubTx(self)
+        self.pending = []
+        self.closed = False
+
+    def publish(self, body, routing_key, exchange, properties):
+        if self.connection.publishes_left is not None:
+            if self.connection.publishes_left <= 0:
+                raise Exception('connection lost')
+            self.connection.publishes_left -= 1
+        self.pending.append(body)
+
+    def close(self):
+        self.closed = True
+
+
+class StubConnection(object):
+    """a stand-in for an amqpstorm connection. the nth connection allows limits[n] publishes (None: unlimited)"""
+    limits = []
+    created = []
+    lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        with StubConnection.lock:
+            index = len(StubConnection.created)
+            StubConnection.created.append(self)
+        self.publishes_left = StubConnection.limits[index] if index < len(StubConnection.limits) else None
+        self.committed = []
+        self.is_open = True
+        self.is_opening = False
+        # widen the window for concurrent reconnects
+        time.sleep(0.05)
+
+    def channel(self):
+        return StubChannel(self)
+
+    def close(self):
+        self.is_open = False
+
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        StubConnection.limits = []
+        StubConnection.created = []
+        patcher = mock.patch.object(amqp_publisher, 'Connection', StubConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def channels_manager(self, pool_size):
+        return ChannelsManager({'ADDRESS': 'localhost', 'USER': '', 'PASSWORD': '', 'VIRTUAL_HOST': '/',
+                                'HEARTBEAT': 60, 'EXCHANGE_NAME': 'exchange-test', 'APP_ID': 'app-test',
+                                'CHANNEL_POOL_SIZE': pool_size})
+
+    def publisher(self, pool_size, batch_size):
+        publisher = AmqpPublisher()
+        self.assertTrue(publisher.init_config('test', 'localhost', 'queue', 'exchange', '/', '', '', 60, 'app', 10))
+        publisher.ESHU_CONFIG['CHANNEL_POOL_SIZE'] = pool_size
+        publisher.ESHU_CONFIG['PUBLISH_BATCH_SIZE'] = batch_size
+        return publisher
+
+    def test_get_channel_blocks(self):
+        """test get_channel blocks while the pool is empty, and wakes up when a channel is released"""
+        manager = self.channels_manager(1)
+        channel = manager.get_channel()
+        self.assertRaises(Empty, manager.get_channel, timeout=0.05)
+
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(manager.get_channel(timeout=5)))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertTrue(waiter.is_alive())
+        self.assertTrue(manager.release_channel(channel))
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(acquired, [channel])
+
+    def test_stale_channels_dropped(self):
+        """test the channels of a previous connection aren't returned to the pool"""
+        manager = self.channels_manager(2)
+        stale = manager.get_channel()
+        manager.establish_connection()
+        self.assertEqual(stale.generation + 1, manager.get_channel().generation)
+        self.assertTrue(stale._channel.closed)
+
+        self.assertFalse(manager.release_channel(stale))
+        fresh = manager.get_channel()
+        self.assertIsNot(fresh, stale)
+        self.assertRaises(Empty, manager.get_channel, timeout=0.05)
+
+    def test_single_reconnect(self):
+        """test concurrent failures over the same connection reconnect once"""
+        manager = self.channels_manager(4)
+        channels = [manager.get_channel() for _ in range(4)]
+        self.assertEqual(len(StubConnection.created), 1)
+
+        failures = [threading.Thread(target=manager.establish_connection, args=(channel.generation,))
+                    for channel in channels]
+        for failure in failures:
+            failure.start()
+        for failure in failures:
+            failure.join()
+        self.assertEqual(len(StubConnection.created), 2)
+        for channel in channels:
+            self.assertFalse(manager.release_channel(channel))
+        self.assertEqual(len(set(manager.get_channel(timeout=1) for _ in range(4))), 4)
+
+    def test_publish_many(self):
+        """test payloads are committed in batches, and a failed batch is re-sent once over a new connection"""
+        # the first connection dies after 3 publishes - the 2nd batch is rolled back and re-sent
+        StubConnection.limits = [3]
+        publisher = self.publisher(pool_size=2, batch_size=2)
+        payloads = ['message-%s' % i for i in range(5)]
+        self.assertEqual(publisher.publish_many('routing-key', payloads), 5)
+        self.assertEqual(len(StubConnection.created), 2)
+        self.assertEqual(StubConnection.created[0].committed, payloads[:2])
+        self.assertEqual(StubConnection.created[1].committed, payloads[2:])
+
+    def test_publish_many_failed_batch(self):
+        """test the published count stops at the batch that failed twice"""
+        StubConnection.limits = [2, 0, 0]
+        publisher = self.publisher(pool_size=2, batch_size=2)
+        payloads = ['message-%s' % i for i in range(5)]
+        self.assertEqual(publisher.publish_many('routing-key', payloads), 2)
+        self.assertEqual([connection.committed for connection in StubConnection.created], [payloads[:2], [], []])
+        self.assertFalse(publisher.publish('routing-key', 'message-5', retry=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import time
+import unittest
+
+import simplejson as json
+import testing.postgresql
+
+import tippicserver
+from tippicserver import db, config
+from tippicserver.db_pool import pool_sizes, db_engines, checkout_tracker, InstrumentedQueuePool
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        # overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        tippicserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        tippicserver.app.testing = True
+        self.app = tippicserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        self.leak_secs = config.DB_CONNECTION_LEAK_SECS
+
+    def tearDown(self):
+        config.DB_CONNECTION_LEAK_SECS = self.leak_secs
+        self.postgresql.stop()
+
+    def test_pool_sizes(self):
+        """test the pools keep a connection per thread, within the process's share of the budget"""
+        self.assertEqual(pool_sizes(1, 2, 80, 8), (3, 7))
+        self.assertEqual(pool_sizes(4, 2, 80, 8), (6, 4))
+        self.assertEqual(pool_sizes(20, 2, 80, 8), (10, 0))
+        self.assertEqual(pool_sizes(1, 2, 0, 8), (1, 0))
+        # the share is split between the process's engines
+        self.assertEqual(pool_sizes(1, 2, 80, 8, engines=2), (3, 2))
+        self.assertEqual(pool_sizes(4, 2, 80, 8, engines=3), (3, 0))
+        self.assertEqual(pool_sizes(1, 2, 0, 8, engines=3), (1, 0))
+
+        self.assertIsInstance(db.engine.pool, InstrumentedQueuePool)
+        resp = self.app.get('/stats/db')
+        self.assertEqual(resp.status_code, 200)
+        stats = json.loads(resp.data)['stats']
+        self.assertEqual(stats['capacity'], config.DB_CONNECTIONS_PER_HOST // config.DB_PROCESSES_PER_HOST // db_engines())
+        self.assertEqual(stats['leaked'], 0)
+
+    def test_leak_detection(self):
+        """test connections held too long are reported once, with the stack that checked them out"""
+        config.DB_CONNECTION_LEAK_SECS = 1
+        conn = db.engine.connect()
+        later = time.time() + 2
+        leaked = checkout_tracker.leaked(now=later)
+        self.assertEqual(len(leaked), 1)
+        held_secs, stack = leaked[0]
+        self.assertTrue(held_secs > 1)
+        self.assertIn('test_leak_detection', [frame.name for frame in stack])
+
+        self.assertEqual(checkout_tracker.report_leaks(now=later), 1)
+        self.assertEqual(checkout_tracker.report_leaks(now=later), 0)  # already reported
+
+        conn.close()
+        self.assertEqual(checkout_tracker.leaked(now=later), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
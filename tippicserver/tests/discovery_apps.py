@@ -0,0 +1,96 @@
+import json
+import threading
+import unittest
+from time import sleep
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import tippicserver
+from tippicserver import discovery_apps
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+APPS = {'apps': [{'memo': 'kik', 'meta_data': {'icon_url': 'https://kik/icon.png', 'app_name': 'Kik'}},
+                 {'memo': 'swel', 'meta_data': {'icon_url': 'https://swel/icon.png', 'app_name': 'Swelly'}}]}
+ETAG = '"v1"'
+
+
+class DiscoveryAppsHandler(BaseHTTPRequestHandler):
+    """a stand-in for the CDN. counts the requests and supports ETag revalidation"""
+    requests_count = 0
+    not_modified_count = 0
+
+    def do_GET(self):
+        DiscoveryAppsHandler.requests_count += 1
+        if self.headers.get('If-None-Match') == ETAG:
+            DiscoveryAppsHandler.not_modified_count += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(APPS).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', ETAG)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('localhost', 0), DiscoveryAppsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.link = 'http://localhost:%s/discovery_apps.json' % self.server.server_port
+        DiscoveryAppsHandler.requests_count = 0
+        DiscoveryAppsHandler.not_modified_count = 0
+        discovery_apps.clear_discovery_apps_cache()
+        tippicserver.app.redis.delete('discovery-apps:%s' % self.link)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_discovery_apps_cache(self):
+        """test fetching, caching and revalidating the discovery apps"""
+        apps = discovery_apps.get_discovery_apps(self.link)
+        self.assertEqual(DiscoveryAppsHandler.requests_count, 1)
+        self.assertEqual(apps.find('1-kik-a1b2c3')['meta_data']['app_name'], 'Kik')
+        self.assertEqual(apps.find('swel')['meta_data']['app_name'], 'Swelly')
+        self.assertEqual(apps.find('1-other-a1b2c3'), None)
+
+        # served from memory
+        discovery_apps.get_discovery_apps(self.link)
+        self.assertEqual(DiscoveryAppsHandler.requests_count, 1)
+
+        # another worker: served from redis
+        discovery_apps.clear_discovery_apps_cache()
+        apps = discovery_apps.get_discovery_apps(self.link)
+        self.assertEqual(DiscoveryAppsHandler.requests_count, 1)
+        self.assertEqual(apps.find('1-kik-a1b2c3')['memo'], 'kik')
+
+        # a stale entry is served as-is and revalidated in the background
+        apps.fetched_at -= discovery_apps.DISCOVERY_APPS_FRESH_SECS + 1
+        tippicserver.app.redis.delete('discovery-apps:%s' % self.link)
+        self.assertIs(discovery_apps.get_discovery_apps(self.link), apps)
+        for _ in range(50):
+            if not discovery_apps._refreshing:
+                break
+            sleep(0.1)
+        self.assertEqual(DiscoveryAppsHandler.requests_count, 2)
+        self.assertEqual(DiscoveryAppsHandler.not_modified_count, 1)
+        refreshed = discovery_apps.get_discovery_apps(self.link)
+        self.assertTrue(refreshed.age() < discovery_apps.DISCOVERY_APPS_FRESH_SECS)
+
+        # the CDN goes away: the stale copy is still served
+        self.server.shutdown()
+        self.server.server_close()
+        refreshed.fetched_at -= discovery_apps.DISCOVERY_APPS_MAX_STALE_SECS + 1
+        tippicserver.app.redis.delete('discovery-apps:%s' % self.link)
+        self.assertIs(discovery_apps.get_discovery_apps(self.link), refreshed)
+
+
+if __name__ == '__main__':
+    unittest.main()
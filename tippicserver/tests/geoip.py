@@ -0,0 +1,118 @@
+import ipaddress
+import json
+import unittest
+import uuid
+from unittest import mock
+
+import testing.postgresql
+
+import tippicserver
+from tippicserver import db, models
+from tippicserver.geoip import GeoIPService
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class StubReader(object):
+    """a stand-in for the maxminddb reader"""
+
+    def __init__(self, countries):
+        self.countries = {ipaddress.ip_network(network): country for network, country in countries.items()}
+        self.lookups = []
+
+    def get_with_prefix_len(self, address):
+        self.lookups.append(str(address))
+        for network, country in self.countries.items():
+            if address in network:
+                return {'country': {'iso_code': country}}, network.prefixlen
+        # an empty record, of the /16 the address is in
+        return None, 16
+
+
+class Tester(unittest.TestCase):
+
+    def test_lookups(self):
+        """test caching the lookups per network of the database"""
+        geoip = GeoIPService()
+        geoip._reader = StubReader({'1.2.3.0/25': 'IL', '1.2.3.128/25': 'US', '2001:db8::/32': 'DE'})
+
+        self.assertEqual(geoip.lookup('1.2.3.4'), 'IL')
+        self.assertEqual(geoip.lookup('1.2.3.100'), 'IL')  # same /25
+        self.assertEqual(geoip.lookup('1.2.3.200'), 'US')  # same /24, another network
+        self.assertEqual(geoip.lookup('2001:db8::1'), 'DE')
+        self.assertEqual(geoip.lookup('2001:db8:ffff::1'), 'DE')
+        self.assertEqual(geoip.lookup('5.6.7.8'), None)
+        self.assertEqual(geoip.lookup('5.6.200.8'), None)  # the empty /16 is cached too
+        self.assertEqual(geoip.lookup('not-an-ip'), None)
+        self.assertEqual(geoip._reader.lookups, ['1.2.3.4', '1.2.3.200', '2001:db8::1', '5.6.7.8'])
+
+        self.assertEqual(geoip.lookup_many(['1.2.3.4', '1.2.3.5', '5.6.7.9', '1.2.3.4']),
+                         {'1.2.3.4': 'IL', '1.2.3.5': 'IL', '5.6.7.9': None})
+        self.assertEqual(len(geoip._reader.lookups), 4)
+        self.assertEqual(geoip.cache_info().hits, 6)
+
+    def test_cache_size(self):
+        """test the least recently used networks are evicted"""
+        geoip = GeoIPService(cache_size=2)
+        geoip._reader = StubReader({'1.2.3.0/24': 'IL', '1.2.4.0/24': 'US', '1.2.5.0/24': 'DE'})
+        for ip_addr in ('1.2.3.1', '1.2.4.1', '1.2.3.2', '1.2.5.1', '1.2.3.3', '1.2.4.2'):
+            geoip.lookup(ip_addr)
+        self.assertEqual(geoip._reader.lookups, ['1.2.3.1', '1.2.4.1', '1.2.5.1', '1.2.4.2'])
+        self.assertEqual(geoip.cache_info().currsize, 2)
+
+
+class BackfillTester(unittest.TestCase):
+
+    def setUp(self):
+        # overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        tippicserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        tippicserver.app.testing = True
+        self.app = tippicserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def register(self):
+        user_id = uuid.uuid4()
+        resp = self.app.post('/user/register',
+                             data=json.dumps({
+                                 'user_id': str(user_id),
+                                 'os': 'android',
+                                 'device_model': 'samsung8',
+                                 'device_id': '234234',
+                                 'time_zone': '05:00',
+                                 'token': 'fake_token',
+                                 'app_ver': '1.0'}),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        return user_id
+
+    def test_backfill_country_iso_codes(self):
+        """test setting the missing countries of the stored ips, in batches"""
+        ips = ['1.2.3.4', '1.2.3.200', '5.6.7.8', None, '1.2.3.5']
+        user_ids = [self.register() for _ in ips]
+        for user_id, ip_address in zip(user_ids, ips):
+            db.engine.execute("update public.user_app_data set ip_address = %s, country_iso_code = null where user_id = %s;",
+                              (ip_address, str(user_id)))
+        # already known - left as is
+        db.engine.execute("update public.user_app_data set country_iso_code = 'FR' where user_id = %s;", (str(user_ids[4]),))
+
+        geoip = GeoIPService()
+        geoip._reader = StubReader({'1.2.3.0/25': 'IL', '1.2.3.128/25': 'US'})
+        with mock.patch.object(tippicserver.app, 'geoip', geoip):
+            self.assertEqual(models.backfill_country_iso_codes(batch_size=2), 2)
+            # nothing left to set
+            self.assertEqual(models.backfill_country_iso_codes(batch_size=2), 0)
+
+        countries = {str(user_id): country for user_id, country in
+                     db.engine.execute('select user_id, country_iso_code from public.user_app_data;').fetchall()}
+        self.assertEqual([countries[str(user_id)] for user_id in user_ids], ['IL', 'US', None, None, 'FR'])
+
+
+if __name__ == '__main__':
+    unittest.main()
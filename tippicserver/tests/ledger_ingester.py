@@ -0,0 +1,128 @@
+import json
+import unittest
+import uuid
+
+import testing.postgresql
+
+import tippicserver
+from tippicserver import db, models, ledger_ingester
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+USER_ADDRESS = 'GCTWHWZASR3QPR4D2WAVFDIIVZF4VXKAT2NYB7ZNTTWHOA63KWX3B4DA'
+AUTHOR_ADDRESS = 'GBC3SG6NGTSZ2OMH3FFGB7UVRQWILW367U4GSOOF4TFSZONV42UJXUH7'
+APP_ADDRESS = 'GAPPADDRESSAPPADDRESSAPPADDRESSAPPADDRESSAPPADDRESSAPPADD'
+STRANGER_ADDRESS = 'GSTRANGERSTRANGERSTRANGERSTRANGERSTRANGERSTRANGERSTRANGE'
+
+
+def payment_record(paging_token, tx_hash, from_address, to_address, amount='5.00000', op_type='payment'):
+    return {'id': paging_token, 'paging_token': paging_token, 'type': op_type, 'asset_type': 'native',
+            'transaction_hash': tx_hash, 'from': from_address, 'to': to_address, 'amount': amount,
+            'created_at': '2019-03-01T10:00:00Z'}
+
+
+def recorded_stream(records):
+    """a stand-in for horizon's payments event stream"""
+    lines = ['retry: 1000', 'event: open', 'data: "hello"', '']
+    for record in records:
+        lines += ['id: %s' % record['paging_token'], 'data: %s' % json.dumps(record), '']
+    return lines
+
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        # overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        tippicserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        tippicserver.app.testing = True
+        self.app = tippicserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_ingest_recorded_stream(self):
+        """test ingesting payments from a recorded stream, resuming and verifying against them"""
+        user_id = uuid.uuid4()
+        resp = self.app.post('/user/register',
+                             data=json.dumps({
+                                 'user_id': str(user_id),
+                                 'os': 'android',
+                                 'device_model': 'samsung8',
+                                 'device_id': '234234',
+                                 'time_zone': '05:00',
+                                 'token': 'fake_token',
+                                 'app_ver': '1.0'}),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        db.engine.execute("update public.user set public_address='%s' where user_id='%s';" % (USER_ADDRESS, user_id))
+
+        tip_hash, gift_hash, foreign_hash, account_hash = ('a' * 64), ('b' * 64), ('c' * 64), ('d' * 64)
+        records = [payment_record('100', tip_hash, USER_ADDRESS, AUTHOR_ADDRESS),
+                   payment_record('101', gift_hash, APP_ADDRESS, STRANGER_ADDRESS, '30.00000'),
+                   payment_record('102', foreign_hash, STRANGER_ADDRESS, AUTHOR_ADDRESS),
+                   payment_record('103', account_hash, APP_ADDRESS, USER_ADDRESS, op_type='create_account')]
+        cursor = ledger_ingester.ingest(recorded_stream(records), [APP_ADDRESS], batch_size=2)
+        self.assertEqual(cursor, '103')
+        self.assertEqual(models.get_ledger_cursor(), '103')
+
+        # only the payments touching our users or our own account are kept
+        stored = models.get_ledger_payments([tip_hash, gift_hash, foreign_hash, account_hash])
+        self.assertEqual(sorted(stored.keys()), [tip_hash, gift_hash])
+        self.assertEqual([payment.to_address for payment in stored[tip_hash]], [AUTHOR_ADDRESS])
+
+        # replaying part of the stream (a crash before the cursor was stored) is harmless
+        ledger_ingester.ingest(recorded_stream(records[:2]), [APP_ADDRESS])
+        self.assertEqual(len(models.get_ledger_payments([tip_hash, gift_hash])), 2)
+
+        # an ingested tx is verified as soon as it is reported
+        self.assertEqual(models.report_transaction({'tx_hash': tip_hash, 'user_id': str(user_id), 'amount': 5,
+                                                    'to_address': AUTHOR_ADDRESS, 'id': '1', 'type': 'picture'}),
+                         models.TX_REPORT_VERIFIED)
+        self.assertEqual([tx.tx_hash for tx in models.list_user_transactions(user_id)], [tip_hash])
+
+    def test_verify_against_payment_ops(self):
+        """test a reported tx is matched to the payment op it reports, and rejected if none matches"""
+        user_id = uuid.uuid4()
+        resp = self.app.post('/user/register',
+                             data=json.dumps({
+                                 'user_id': str(user_id),
+                                 'os': 'android',
+                                 'device_model': 'samsung8',
+                                 'device_id': '234234',
+                                 'time_zone': '05:00',
+                                 'token': 'fake_token',
+                                 'app_ver': '1.0'}),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        db.engine.execute("update public.user set public_address='%s' where user_id='%s';" % (USER_ADDRESS, user_id))
+
+        # two payment ops in each tx. op ids are the tx's id plus the op's index
+        tx_id = 7 << 32 | 3 << 12
+        multi_hash, other_hash = ('e' * 64), ('f' * 64)
+        records = [payment_record(str(tx_id | 1), multi_hash, USER_ADDRESS, STRANGER_ADDRESS, '1.00000'),
+                   payment_record(str(tx_id | 2), multi_hash, USER_ADDRESS, AUTHOR_ADDRESS, '5.00000'),
+                   payment_record(str(tx_id + 4096 | 1), other_hash, USER_ADDRESS, STRANGER_ADDRESS, '1.00000'),
+                   payment_record(str(tx_id + 4096 | 2), other_hash, USER_ADDRESS, AUTHOR_ADDRESS, '5.00000')]
+        ledger_ingester.ingest(recorded_stream(records), [APP_ADDRESS])
+        stored = models.get_ledger_payments([multi_hash])
+        self.assertEqual([payment.op_index for payment in stored[multi_hash]], [1, 2])
+
+        # the second op is the reported tip
+        self.assertEqual(models.report_transaction({'tx_hash': multi_hash, 'user_id': str(user_id), 'amount': 5,
+                                                    'to_address': AUTHOR_ADDRESS, 'id': '1', 'type': 'picture'}),
+                         models.TX_REPORT_VERIFIED)
+        # no op pays the reported amount
+        self.assertEqual(models.report_transaction({'tx_hash': other_hash, 'user_id': str(user_id), 'amount': 500,
+                                                    'to_address': AUTHOR_ADDRESS, 'id': '1', 'type': 'picture'}),
+                         models.TX_REPORT_REJECTED)
+        self.assertEqual([tx.tx_hash for tx in models.list_user_transactions(user_id)], [multi_hash])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -98,7 +98,7 @@ class Tester(unittest.TestCase):
                              headers={USER_ID_HEADER: str(userid1)},
                              content_type='application/json')
         print(json.loads(resp.data))
-        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.status_code, 202)
 
         # onboard user 2 to set address in server
         kp = Keypair.random()
@@ -109,7 +109,7 @@ class Tester(unittest.TestCase):
                              headers={USER_ID_HEADER: str(userid2)},
                              content_type='application/json')
         print(json.loads(resp.data))
-        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.status_code, 202)
 
         # user 1 updates his phone number to the server after client-side verification
         phone_num = '+972527702890'
@@ -45,6 +45,87 @@ class Tester(unittest.TestCase):
         paddr = self.onboard_with_phone( str(uuid.uuid4()), '+9720528802120')
         self.assertEqual(0, stellar.get_kin_balance(paddr))
 
+    def test_onboard_queued(self):
+        """test onboarding with the job, the payouts and the gift's follow-up on the rq workers"""
+        from unittest import mock
+        from rq.utils import import_attribute
+        from tippicserver import config, models, payouts
+
+        config.ONBOARDING_INLINE = False
+        config.PAYOUTS_INLINE = False
+        self.addCleanup(setattr, config, 'ONBOARDING_INLINE', True)
+        self.addCleanup(setattr, config, 'PAYOUTS_INLINE', True)
+        tippicserver.app.redis.delete(payouts.PAYOUTS_QUEUE_KEY, payouts.PAYOUTS_INFLIGHT_KEY,
+                                      payouts.PAYOUTS_SUBMITTED_KEY, payouts.PAYOUTS_SCHEDULED_KEY)
+
+        userid = uuid.uuid4()
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(userid),
+                            'os': 'android',
+                            'device_model': 'samsung8',
+                            'device_id': '234234',
+                            'time_zone': '05:00',
+                            'token': 'fake_token',
+                            'app_ver': '1.0'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        resp = self.app.post('/user/firebase/update-id-token',
+                    data=json.dumps({
+                        'token': 'fake-token',
+                        'phone_number': '+9720528802121'}),
+                    headers={USER_ID_HEADER: str(userid)},
+                    content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        # the jobs the workers would run: (queue, func, args)
+        jobs = []
+
+        def enqueue_on(queue):
+            return lambda func, args=(), timeout=None: jobs.append((queue, func, args))
+
+        def run_next_job(expected_queue):
+            queue, func, args = jobs.pop(0)
+            self.assertEqual(queue, expected_queue)
+            (import_attribute(func) if isinstance(func, str) else func)(*args)
+
+        def onboarding_status(token):
+            resp = self.app.get('/user/onboard/status?token=%s' % token, headers={USER_ID_HEADER: str(userid)})
+            self.assertEqual(resp.status_code, 200)
+            return json.loads(resp.data)['onboarding_status']
+
+        with mock.patch.object(tippicserver.app.rq_fast, 'enqueue_call', side_effect=enqueue_on('fast')), \
+                mock.patch.object(tippicserver.app.rq_payouts, 'enqueue_call', side_effect=enqueue_on('payouts')), \
+                mock.patch.object(stellar, 'active_account_exists', return_value=True), \
+                mock.patch.object(payouts, 'send_kin_batch', return_value=(stellar.BATCH_SENT, 'a' * 64)):
+            resp = self.app.post('/user/onboard',
+                data=json.dumps({
+                                'public_address': 'GCTWHWZASR3QPR4D2WAVFDIIVZF4VXKAT2NYB7ZNTTWHOA63KWX3B4DA'}),
+                headers={USER_ID_HEADER: str(userid)},
+                content_type='application/json')
+            self.assertEqual(resp.status_code, 202)
+            token = json.loads(resp.data)['token']
+            self.assertEqual(onboarding_status(token), 'queued')
+
+            # the onboarding job queues the gift and returns without waiting for it
+            run_next_job('fast')
+            self.assertEqual(onboarding_status(token), 'running')
+            # a retried job doesn't queue another gift
+            models.restart_onboarding_job(userid)
+            run_next_job('fast')
+            self.assertEqual(len(jobs), 1)
+
+            run_next_job('payouts')
+            self.assertEqual(onboarding_status(token), 'running')
+            # the gift's follow-up completes the job
+            run_next_job('fast')
+            self.assertEqual(jobs, [])
+
+        self.assertEqual(onboarding_status(token), 'done')
+        self.assertTrue(models.is_onboarded(userid))
+        self.assertEqual([tx.tx_hash for tx in models.list_user_transactions(userid)], ['a' * 64])
+
     def onboard_with_phone(self, userid, phone_num):
         resp = self.app.post('/user/register',
             data=json.dumps({
@@ -80,7 +161,15 @@ class Tester(unittest.TestCase):
             content_type='application/json')
 
         print(json.loads(resp.data))
+        self.assertEqual(resp.status_code, 202)
+        token = json.loads(resp.data)['token']
+
+        # the job ran inline - poll its status
+        resp = self.app.get('/user/onboard/status?token=%s' % token, headers={USER_ID_HEADER: str(userid)})
         self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['onboarding_status'], 'done')
+        resp = self.app.get('/user/onboard/status?token=%s' % uuid.uuid4(), headers={USER_ID_HEADER: str(userid)})
+        self.assertEqual(resp.status_code, 400)
 
         # try onboarding again with the same user - should fail
         print('onboarding same user second time should fail --------------')
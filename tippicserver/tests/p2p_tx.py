@@ -159,7 +159,7 @@ class Tester(unittest.TestCase):
             headers={USER_ID_HEADER: str(userid2)},
             content_type='application/json')
         print(json.loads(resp.data))
-        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.status_code, 202)
 
         # onboard user 3 to set address in server
         kp = Keypair.random()
@@ -170,7 +170,7 @@ class Tester(unittest.TestCase):
             headers={USER_ID_HEADER: str(userid3)},
             content_type='application/json')
         print(json.loads(resp.data))
-        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.status_code, 202)
 
         # onboard user 1 to set address in server
         kp = Keypair.random()
@@ -181,7 +181,7 @@ class Tester(unittest.TestCase):
             headers={USER_ID_HEADER: str(userid1)},
             content_type='application/json')
         print(json.loads(resp.data))
-        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.status_code, 202)
 
         # get user1 p2p tx history - should have 0 item
         resp = self.app.get('/user/transactions', headers={USER_ID_HEADER: str(userid1)})
@@ -255,6 +255,16 @@ class Tester(unittest.TestCase):
         self.assertEqual(data['status'], 'ok')
         self.assertEqual(data['address'], address3)
 
+        # user1 matches all of the above in one request
+        resp = self.app.post('/user/contacts/match',
+                             data=json.dumps({
+                                 'phone_numbers': [phone_num, '0528802120', '0528802121', '0500000000']}),
+                             headers={USER_ID_HEADER: str(userid1)},
+                             content_type='application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data['matches'], {phone_num: address2, '0528802120': address2, '0528802121': address3})
+
         # user1 sends money to user2
 
         # user1 reports tx to the server
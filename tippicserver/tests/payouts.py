@@ -0,0 +1,202 @@
+import json
+import time
+import unittest
+import uuid
+from unittest import mock
+
+import testing.postgresql
+
+import tippicserver
+from tippicserver import db, models, payouts, stellar
+from tippicserver.utils import GIFT
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+GOOD_ADDRESS = 'GCTWHWZASR3QPR4D2WAVFDIIVZF4VXKAT2NYB7ZNTTWHOA63KWX3B4DA'
+BAD_ADDRESS = 'GBC3SG6NGTSZ2OMH3FFGB7UVRQWILW367U4GSOOF4TFSZONV42UJXUH7'
+
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        # overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        tippicserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        tippicserver.app.testing = True
+        self.app = tippicserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        tippicserver.app.redis.delete(payouts.PAYOUTS_QUEUE_KEY, payouts.PAYOUTS_INFLIGHT_KEY, payouts.PAYOUTS_SUBMITTED_KEY,
+                                      'lock:%s' % payouts.PAYOUTS_LOCK_NAME)
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def register(self):
+        user_id = uuid.uuid4()
+        resp = self.app.post('/user/register',
+                             data=json.dumps({
+                                 'user_id': str(user_id),
+                                 'os': 'android',
+                                 'device_model': 'samsung8',
+                                 'device_id': '234234',
+                                 'time_zone': '05:00',
+                                 'token': 'fake_token',
+                                 'app_ver': '1.0'}),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        return user_id
+
+    def test_batched_payouts(self):
+        """test packing payouts into multi-op txs, and isolating a bad payout"""
+        sent_batches = []
+
+        def send_kin_batch(payments, memo=None, on_signed=None):
+            sent_batches.append(payments)
+            tx_hash = '%064d' % len(sent_batches)
+            on_signed(tx_hash, time.time() + stellar.BATCH_TX_MAX_SECS)
+            if any(address == BAD_ADDRESS for address, amount in payments):
+                return stellar.BATCH_FAILED, tx_hash  # the whole tx is rejected
+            return stellar.BATCH_SENT, tx_hash
+
+        user_ids = [self.register() for _ in range(3)]
+        addresses = [GOOD_ADDRESS, BAD_ADDRESS, GOOD_ADDRESS]
+        with mock.patch.object(payouts, 'send_kin_batch', side_effect=send_kin_batch), \
+                mock.patch.object(payouts, 'schedule_payouts'):
+            for user_id, address in zip(user_ids, addresses):
+                self.assertTrue(payouts.enqueue_payout('gift:%s' % user_id, user_id, address, 30, GIFT, 'onboarding-gift'))
+            # idempotent by payout_id
+            self.assertFalse(payouts.enqueue_payout('gift:%s' % user_ids[0], user_ids[0], GOOD_ADDRESS, 30, GIFT, 'onboarding-gift'))
+            payouts.process_payouts()
+
+        # one batch with all three, then one by one
+        self.assertEqual([len(batch) for batch in sent_batches], [3, 1, 1, 1])
+        results = [payouts.get_payout_result('gift:%s' % user_id) for user_id in user_ids]
+        self.assertEqual([result['status'] for result in results], [payouts.PAYOUT_SENT, payouts.PAYOUT_FAILED, payouts.PAYOUT_SENT])
+        self.assertEqual(len(models.list_user_transactions(user_ids[0])), 1)
+        self.assertEqual(models.list_user_transactions(user_ids[1]), [])
+        # the failed payout can be queued again
+        with mock.patch.object(payouts, 'schedule_payouts'):
+            self.assertTrue(payouts.enqueue_payout('gift:%s' % user_ids[1], user_ids[1], GOOD_ADDRESS, 30, GIFT, 'onboarding-gift'))
+        self.assertIsNone(payouts.get_payout_result('gift:%s' % user_ids[1]))
+
+
+    def test_unknown_outcome(self):
+        """test a payout whose tx may have been applied isn't sent again until the tx settles"""
+        sent_batches = []
+
+        def send_kin_batch(payments, memo=None, on_signed=None):
+            sent_batches.append(payments)
+            tx_hash = '%064d' % len(sent_batches)
+            on_signed(tx_hash, time.time() + stellar.BATCH_TX_MAX_SECS)
+            if len(sent_batches) == 1:
+                return stellar.BATCH_UNKNOWN, tx_hash  # e.g. timed out after submitting
+            return stellar.BATCH_SENT, tx_hash
+
+        user_ids = [self.register() for _ in range(2)]
+        settled_at = time.time() + stellar.BATCH_TX_MAX_SECS + payouts.PAYOUT_SETTLE_GRACE_SECS + 1
+        with mock.patch.object(payouts, 'send_kin_batch', side_effect=send_kin_batch), \
+                mock.patch.object(payouts, 'schedule_payouts'):
+            for user_id in user_ids:
+                self.assertTrue(payouts.enqueue_payout('gift:%s' % user_id, user_id, GOOD_ADDRESS, 30, GIFT, 'onboarding-gift'))
+            payouts.process_payouts()
+            # not failed, not retried one by one - and not settled before the tx's max_time
+            self.assertEqual(len(sent_batches), 1)
+            self.assertIsNone(payouts.get_payout_result('gift:%s' % user_ids[0]))
+            self.assertEqual(payouts.resolve_stale_payouts(), 0)
+
+            # the tx didn't make it: both are sent again
+            with mock.patch.object(payouts, 'is_tx_on_ledger', return_value=False):
+                self.assertEqual(payouts.resolve_stale_payouts(now=settled_at), 2)
+            payouts.process_payouts()
+
+        self.assertEqual([len(batch) for batch in sent_batches], [2, 2])
+        results = [payouts.get_payout_result('gift:%s' % user_id) for user_id in user_ids]
+        self.assertEqual(sorted(result['tx_hash'] for result in results), ['%064d:0' % 2, '%064d:1' % 2])
+        self.assertIsNone(payouts.secs_to_next_stale_payout())
+
+    def test_unknown_outcome_applied(self):
+        """test a payout whose tx turns out to be on the ledger is completed with it"""
+        user_id = self.register()
+        with mock.patch.object(payouts, 'send_kin_batch', return_value=(stellar.BATCH_UNKNOWN, None)), \
+                mock.patch.object(payouts, 'schedule_payouts'):
+            self.assertTrue(payouts.enqueue_payout('gift:%s' % user_id, user_id, GOOD_ADDRESS, 30, GIFT, 'onboarding-gift'))
+            payouts.process_payouts()
+        payout = payouts.decode_payout(tippicserver.app.redis.zrange(payouts.PAYOUTS_INFLIGHT_KEY, 0, 0)[0])
+        payouts.record_submission([payout], 'e' * 64, time.time())
+
+        settled_at = time.time() + payouts.PAYOUT_SETTLE_GRACE_SECS + 1
+        with mock.patch.object(payouts, 'is_tx_on_ledger', return_value=None):
+            self.assertEqual(payouts.resolve_stale_payouts(now=settled_at), 0)  # horizon failed - still in flight
+        self.assertIsNotNone(payouts.secs_to_next_stale_payout())
+        with mock.patch.object(payouts, 'is_tx_on_ledger', return_value=True):
+            self.assertEqual(payouts.resolve_stale_payouts(now=settled_at + payouts.PAYOUT_LEASE_SECS), 1)
+
+        self.assertEqual(payouts.get_payout_result('gift:%s' % user_id), {'status': payouts.PAYOUT_SENT, 'tx_hash': 'e' * 64})
+        self.assertEqual([tx.tx_hash for tx in models.list_user_transactions(user_id)], ['e' * 64])
+        self.assertIsNone(payouts.secs_to_next_stale_payout())
+
+    def test_concurrent_job(self):
+        """test a second job that runs while the first is still in its fallback loop doesn't pay twice"""
+        attempts = []
+        submitted = []
+
+        def send_kin_batch(payments, memo=None, on_signed=None):
+            attempts.append(payments)
+            tx_hash = '%064d' % len(attempts)
+            if len(attempts) == 2:
+                # the 1st one-by-one send after the failed batch: another job starts, and finds the lock taken
+                self.assertFalse(payouts.process_payouts())
+                self.assertEqual(len(attempts), 2)
+                # the leases of all the popped payouts run out, and they are settled (and requeued) elsewhere
+                for entry in tippicserver.app.redis.zrange(payouts.PAYOUTS_INFLIGHT_KEY, 0, -1):
+                    payouts.extend_lease(tippicserver.app.redis, entry, 0)
+                with mock.patch.object(payouts, 'is_tx_on_ledger', return_value=False):
+                    self.assertEqual(payouts.resolve_stale_payouts(), 3)
+            try:
+                on_signed(tx_hash, time.time() + stellar.BATCH_TX_MAX_SECS)
+            except payouts.PayoutLeaseLost:
+                return stellar.BATCH_FAILED, tx_hash  # as send_kin_batch does when on_signed raises
+            submitted.append(payments)
+            if any(address == BAD_ADDRESS for address, amount in payments):
+                return stellar.BATCH_FAILED, tx_hash
+            return stellar.BATCH_SENT, tx_hash
+
+        user_ids = [self.register() for _ in range(3)]
+        addresses = [GOOD_ADDRESS, BAD_ADDRESS, GOOD_ADDRESS]
+        with mock.patch.object(payouts, 'send_kin_batch', side_effect=send_kin_batch), \
+                mock.patch.object(payouts, 'schedule_payouts'):
+            for user_id, address in zip(user_ids, addresses):
+                self.assertTrue(payouts.enqueue_payout('gift:%s' % user_id, user_id, address, 30, GIFT, 'onboarding-gift'))
+            self.assertTrue(payouts.process_payouts())
+
+        # the interrupted send wasn't submitted, the rest of the fallback skipped the lost payouts,
+        # and the requeued payouts were sent once
+        self.assertEqual([len(batch) for batch in attempts], [3, 1, 3, 1, 1, 1])
+        self.assertEqual([len(batch) for batch in submitted], [3, 3, 1, 1, 1])
+        results = [payouts.get_payout_result('gift:%s' % user_id) for user_id in user_ids]
+        self.assertEqual([result['status'] for result in results], [payouts.PAYOUT_SENT, payouts.PAYOUT_FAILED, payouts.PAYOUT_SENT])
+        self.assertEqual(len(models.list_user_transactions(user_ids[0])), 1)
+        self.assertEqual(len(models.list_user_transactions(user_ids[2])), 1)
+        self.assertIsNone(payouts.secs_to_next_stale_payout())
+
+    def test_crashed_worker(self):
+        """test the payouts popped by a worker that died are sent by the next job"""
+        user_id = self.register()
+        with mock.patch.object(payouts, 'schedule_payouts'):
+            self.assertTrue(payouts.enqueue_payout('gift:%s' % user_id, user_id, GOOD_ADDRESS, 30, GIFT, 'onboarding-gift'))
+        self.assertEqual(len(payouts.pop_payouts(payouts.MAX_OPS_PER_TX)), 1)  # and the worker dies
+
+        # still leased
+        self.assertEqual(payouts.resolve_stale_payouts(), 0)
+        self.assertEqual(payouts.resolve_stale_payouts(now=time.time() + payouts.PAYOUT_LEASE_SECS + 1), 1)
+        with mock.patch.object(payouts, 'send_kin_batch', return_value=(stellar.BATCH_SENT, 'f' * 64)) as send:
+            payouts.process_payouts()
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(payouts.get_payout_result('gift:%s' % user_id)['status'], payouts.PAYOUT_SENT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -123,5 +123,52 @@ class Tester(unittest.TestCase):
             content_type='application/json')
         self.assertEqual(resp.status_code, 200)
 
+        # both numbers are in the cached blacklist, and survive a rebuild from the table
+        self.assertEqual(models.is_phone_number_blacklisted(phone_num), True)
+        self.assertEqual(models.is_userid_blacklisted(userid2), True)
+        self.assertEqual(models.is_phone_number_blacklisted('+9720528802122'), False)
+        resp = self.app.post('/blacklist/rebuild')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['count'], 2)
+        self.assertEqual(models.is_phone_number_blacklisted(phone_num2), True)
+        self.assertEqual(models.is_userid_blacklisted(userid), True)
+
+    def test_rebuild_off_the_request(self):
+        """the blacklist set is rebuilt by a job, while the checks use the table or the current filter"""
+        from unittest import mock
+        from tippicserver.models import blacklisted_phone_numbers as blacklist
+
+        # a previous test's db may have had the same url - and so the same blacklist keys
+        fingerprint = blacklist.get_db_fingerprint()
+        tippicserver.app.redis.delete(*[key % fingerprint for key in (
+            blacklist.BLACKLIST_KEY, blacklist.BLACKLIST_EPOCH_KEY, blacklist.BLACKLIST_FRESH_KEY,
+            blacklist.BLACKLIST_REBUILD_SCHEDULED_KEY)])
+
+        phone_number = '+9720526602766'
+        with mock.patch.object(tippicserver.app.rq_fast, 'enqueue_call') as enqueue:
+            blacklist.blacklist_filter['checked_at'] = 0
+            self.assertTrue(models.blacklist_phone_number(phone_number))
+            # not built yet: the table answers, and a single rebuild is queued
+            self.assertTrue(models.is_phone_number_blacklisted(phone_number))
+            self.assertFalse(models.is_phone_number_blacklisted('+9720526602767'))
+            self.assertEqual(enqueue.call_count, 1)
+            self.assertEqual(enqueue.call_args[1]['func'], blacklist.rebuild_blacklist)
+
+            # the job ran
+            self.assertEqual(blacklist.rebuild_blacklist(), 1)
+            self.assertTrue(models.is_phone_number_blacklisted(phone_number))
+            bloom = blacklist.get_blacklist_filter()
+            self.assertIsNotNone(bloom)
+
+            # due for a rebuild: the current filter is served meanwhile
+            tippicserver.app.redis.delete(blacklist.BLACKLIST_FRESH_KEY % fingerprint)
+            blacklist.blacklist_filter['checked_at'] = 0
+            with mock.patch.object(blacklist, 'rebuild_blacklist') as rebuild:
+                self.assertIs(blacklist.get_blacklist_filter(), bloom)
+                self.assertTrue(models.is_phone_number_blacklisted(phone_number))
+            self.assertEqual(rebuild.call_count, 0)
+            self.assertEqual(enqueue.call_count, 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -24,6 +24,8 @@ class Tester(unittest.TestCase):
         db.drop_all()
         db.create_all()
         tippicserver.config.PHONE_VERIFICATION_REQUIRED = True
+        # the current picture is cached across tests (redis is shared)
+        tippicserver.models.invalidate_current_picture_cache()
 
     def tearDown(self):
         self.postgresql.stop()
@@ -275,6 +277,99 @@ class Tester(unittest.TestCase):
 
         self.assertEqual(data, {'picture': {}})
 
+    def test_pictures_summery_tips_sum(self):
+        """Test the pictures summery sums the picture's tips - both summed from the txs and materialized"""
+        from tippicserver import models
+        from tippicserver.utils import PICTURE
+
+        tippicserver.config.PHONE_VERIFICATION_REQUIRED = False
+        materialized = tippicserver.config.PICTURE_TIPS_SUM_MATERIALIZED
+        self.addCleanup(setattr, tippicserver.config, 'PICTURE_TIPS_SUM_MATERIALIZED', materialized)
+
+        author_id, tipper_id = uuid.uuid4(), uuid.uuid4()
+        for userid in (author_id, tipper_id):
+            resp = self.app.post('/user/register',
+                                 data=json.dumps({
+                                     'user_id': str(userid),
+                                     'os': 'iOS',
+                                     'device_model': 'iPhone X',
+                                     'device_id': '234234',
+                                     'time_zone': '05:00',
+                                     'token': 'fake_token',
+                                     'app_ver': '1.0'}),
+                                 headers={},
+                                 content_type='application/json')
+            self.assertEqual(resp.status_code, 200)
+
+        resp = self.app.post('/picture/add',
+                             data=json.dumps({
+                                 'pictures': [{
+                                     "skip_image_test": "true",
+                                     "user_id": str(author_id),
+                                     "image_url": "https://example.com/picture.jpg",
+                                     "title": "tipped picture",
+                                     "username": "the author"}]}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        # the first picture request sets the current picture index
+        resp = self.app.get('/user/picture',
+                            headers={USER_ID_HEADER: str(tipper_id)},
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        picture_id = json.loads(resp.data)['picture']['picture_id']
+
+        author_address = 'GCTWHWZASR3QPR4D2WAVFDIIVZF4VXKAT2NYB7ZNTTWHOA63KWX3B4DA'
+        self.assertTrue(models.create_tx('tx1', str(tipper_id), author_address, 5, PICTURE, picture_id))
+        self.assertTrue(models.create_tx('tx2', str(tipper_id), author_address, 7, PICTURE, picture_id))
+        # a duplicate tx doesn't count twice
+        self.assertFalse(models.create_tx('tx2', str(tipper_id), author_address, 7, PICTURE, picture_id))
+
+        for materialized in (False, True):
+            tippicserver.config.PICTURE_TIPS_SUM_MATERIALIZED = materialized
+            resp = self.app.get('/user/pictures-summery',
+                                headers={USER_ID_HEADER: str(author_id)},
+                                content_type='application/json')
+            self.assertEqual(resp.status_code, 200)
+            summery = json.loads(resp.data)['summery']
+            self.assertEqual(len(summery), 1)
+            self.assertEqual(summery[0]['picture_id'], picture_id)
+            self.assertEqual(summery[0]['tips_sum'], 12)
+
+    def test_current_picture_cache(self):
+        """Test a load that raced an invalidation, or found no picture, isn't cached"""
+        from unittest import mock
+        from tippicserver import models
+        from tippicserver.models import picture as picture_model
+
+        author_id = uuid.uuid4()
+        models.create_user(author_id, 'iOS', 'iPhone X', 'fake_token', '05:00', '234234', '1.0', None)
+
+        # no pictures yet
+        self.assertEqual(picture_model.get_current_picture(), {})
+        version = int(tippicserver.app.redis.get(picture_model.CURRENT_PICTURE_VERSION_KEY))
+        self.assertIsNone(tippicserver.app.redis.get(picture_model.CURRENT_PICTURE_CACHE_KEY % version))
+
+        self.assertTrue(models.add_picture({"skip_image_test": "true", "user_id": str(author_id),
+                                            "image_url": "https://example.com/picture.jpg",
+                                            "title": "the picture", "username": "the author"}))
+        stale_picture = picture_model.load_current_picture()
+
+        def racing_load():
+            # the current picture changes while this load reads the db
+            picture_model.invalidate_current_picture_cache()
+            return stale_picture
+
+        with mock.patch.object(picture_model, 'load_current_picture', side_effect=racing_load):
+            self.assertEqual(picture_model.get_current_picture(), stale_picture)
+        # the stale picture was cached under the previous version only
+        version = int(tippicserver.app.redis.get(picture_model.CURRENT_PICTURE_VERSION_KEY))
+        self.assertIsNone(tippicserver.app.redis.get(picture_model.CURRENT_PICTURE_CACHE_KEY % version))
+        self.assertEqual(picture_model._current_picture_local_cache, {})
+
+        self.assertEqual(picture_model.get_current_picture()['title'], 'the picture')
+        self.assertIsNotNone(tippicserver.app.redis.get(picture_model.CURRENT_PICTURE_CACHE_KEY % version))
+
 
 if __name__ == '__main__':
     unittest.main()
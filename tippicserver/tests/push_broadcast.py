@@ -0,0 +1,126 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+import tippicserver
+from tippicserver import db, models
+from tippicserver.models import broadcast as broadcast_module
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class StubPublisher(object):
+    """records the published tokens instead of sending them to eshu"""
+
+    def __init__(self):
+        self.sent = []
+        self.fail_after = None
+
+    def _send(self, os_type, tokens):
+        if self.fail_after is not None and len(self.sent) >= self.fail_after:
+            raise Exception('eshu is down')
+        self.sent.append((os_type, list(tokens)))
+        return len(tokens)
+
+    def send_gcm(self, routing_key, payload, tokens, dry_run, ttl):
+        return self._send('android', tokens)
+
+    def send_apns(self, routing_key, payload, tokens):
+        return self._send('iOS', tokens)
+
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        # overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        tippicserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        tippicserver.app.testing = True
+        self.app = tippicserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        self.publishers = tippicserver.app.amqp_publishers
+        tippicserver.app.amqp_publishers = {'beta': StubPublisher(), 'prod': StubPublisher()}
+        self.page_size = broadcast_module.PUSH_BROADCAST_PAGE_SIZE
+        broadcast_module.PUSH_BROADCAST_PAGE_SIZE = 2
+
+    def tearDown(self):
+        tippicserver.app.amqp_publishers = self.publishers
+        broadcast_module.PUSH_BROADCAST_PAGE_SIZE = self.page_size
+        self.postgresql.stop()
+
+    def test_push_broadcast(self):
+        """test sending a broadcast per os and push env, failing and resuming it"""
+        # ordered user ids, so the pages are known: [android-0, android-1], [android-2, ios-prod], [ios-beta]
+        for i in range(3):
+            models.create_user(uuid.UUID(int=i + 1), 'android', 'samsung8', 'android-token-%s' % i, '05:00', str(i), '1.0', None)
+        models.create_user(uuid.UUID(int=4), 'iOS', 'iphone', 'ios-prod-token', '05:00', '3', '1.0', models.TIPPIC_IOS_PACKAGE_ID_PROD)
+        models.create_user(uuid.UUID(int=5), 'iOS', 'iphone', 'ios-beta-token', '05:00', '4', '1.0', 'org.kinecosystem.tippic.beta')
+        models.create_user(uuid.UUID(int=6), 'android', 'samsung8', None, '05:00', '5', '1.0', None)  # no token
+
+        resp = self.app.post('/push/broadcast', data=json.dumps({'payload': {'type': 'news'}}), content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        broadcast_id = json.loads(resp.data)['broadcast_id']
+
+        # eshu goes down on the last page
+        beta = tippicserver.app.amqp_publishers['beta']
+        prod = tippicserver.app.amqp_publishers['prod']
+        beta.fail_after = 2
+        with self.assertRaises(Exception):
+            models.push_broadcast(broadcast_id)
+        broadcast = models.get_push_broadcast(broadcast_id)
+        self.assertEqual(broadcast['status'], models.BROADCAST_FAILED)
+        self.assertEqual(broadcast['cursor'], str(uuid.UUID(int=4)))
+        self.assertEqual(broadcast['sent'], 4)
+
+        beta.fail_after = None
+        resp = self.app.post('/push/broadcast/%s/resume' % broadcast_id)
+        self.assertTrue(json.loads(resp.data)['resumed'])
+        models.push_broadcast(broadcast_id)
+
+        resp = self.app.get('/push/broadcast/%s' % broadcast_id)
+        broadcast = json.loads(resp.data)['broadcast']
+        self.assertEqual(broadcast['status'], models.BROADCAST_DONE)
+        self.assertEqual(broadcast['users'], 5)
+        self.assertEqual(broadcast['sent'], 5)
+        self.assertEqual(broadcast['failed'], 0)
+        self.assertEqual(beta.sent, [('android', ['android-token-0', 'android-token-1']), ('android', ['android-token-2']),
+                                     ('iOS', ['ios-beta-token'])])
+        self.assertEqual(prod.sent, [('iOS', ['ios-prod-token'])])
+
+        # a finished broadcast isn't resumed
+        resp = self.app.post('/push/broadcast/%s/resume' % broadcast_id)
+        self.assertFalse(json.loads(resp.data)['resumed'])
+
+
+    def test_cancel_last_page(self):
+        """test a broadcast cancelled while it sends its last page stays cancelled"""
+        models.create_user(uuid.UUID(int=1), 'android', 'samsung8', 'android-token-0', '05:00', '0', '1.0', None)
+        broadcast_id = models.create_push_broadcast({'type': 'news'})
+
+        beta = tippicserver.app.amqp_publishers['beta']
+        send_gcm = beta.send_gcm
+
+        def send_and_cancel(*args):
+            models.cancel_push_broadcast(broadcast_id)
+            return send_gcm(*args)
+
+        beta.send_gcm = send_and_cancel
+        models.push_broadcast(broadcast_id)
+        broadcast = models.get_push_broadcast(broadcast_id)
+        self.assertEqual(broadcast['status'], models.BROADCAST_CANCELLED)
+        self.assertEqual(broadcast['sent'], 1)
+
+        # resumed from the checkpoint - nothing left to send
+        beta.send_gcm = send_gcm
+        self.assertTrue(models.resume_push_broadcast(broadcast_id))
+        models.push_broadcast(broadcast_id)
+        self.assertEqual(models.get_push_broadcast(broadcast_id)['status'], models.BROADCAST_DONE)
+        self.assertEqual(beta.sent, [('android', ['android-token-0'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import json
+import unittest
+
+import testing.postgresql
+from sqlalchemy import event
+
+import tippicserver
+from tippicserver import db, models, config
+from tippicserver.utils import PICTURE, GIFT
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+SEED_USERS = 500
+HOT_TABLES = {'user', 'transaction', 'p2_p_transaction', 'picture'}
+
+
+def seq_scans(plan):
+    """returns the relations scanned sequentially anywhere in the given (json) plan node"""
+    scans = []
+    if plan.get('Node Type') == 'Seq Scan':
+        scans.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        scans.extend(seq_scans(child))
+    return scans
+
+
+class Tester(unittest.TestCase):
+    """makes sure the hot queries are served by the indexes declared in the models"""
+
+    def setUp(self):
+        # overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        tippicserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        tippicserver.app.testing = True
+        db.drop_all()
+        db.create_all()
+        self.seed()
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.record_statement)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.record_statement)
+        db.session.remove()
+        self.postgresql.stop()
+
+    def seed(self):
+        db.engine.execute("""
+            insert into public.user (user_id, username, os_type, device_model, time_zone, onboarded, public_address, enc_phone_number, deactivated)
+                select md5(i::text)::uuid, 'user' || i, 'android', 'samsung8', 0, true, 'GADDRESS' || i, 'enc' || mod(i, 100), mod(i, 3) = 0
+                from generate_series(1, %(users)s) i;
+            insert into public.transaction (tx_hash, user_id, to_address, amount, tx_for_item_id, tx_type)
+                select 'tx' || i, md5((mod(i, %(users)s) + 1)::text)::uuid, 'GADDRESS' || (mod(i, 97) + 1), 5, 'picture' || mod(i, 50),
+                       case when mod(i, 4) = 0 then '%(gift)s' else '%(picture)s' end
+                from generate_series(1, %(users)s * 10) i;
+            insert into public.p2_p_transaction (tx_hash, sender_user_id, receiver_user_id, amount, sender_address, receiver_address)
+                select 'p2p' || i, md5((mod(i, %(users)s) + 1)::text)::uuid, md5((mod(i + 7, %(users)s) + 1)::text)::uuid, 3,
+                       'GADDRESS' || (mod(i, %(users)s) + 1), 'GADDRESS' || (mod(i + 7, %(users)s) + 1)
+                from generate_series(1, %(users)s * 5) i;
+            insert into public.picture (picture_id, picture_order_index, title, image_url, author, is_active)
+                select 'picture' || i, i, 'title', 'https://image', json_build_object('user_id', md5((mod(i, 20) + 1)::text)::uuid), true
+                from generate_series(1, 200) i;
+            insert into public.system_config (sid, current_picture_index) values (nextval('sid'), 150);
+            analyze;
+        """ % {'users': SEED_USERS, 'gift': GIFT, 'picture': PICTURE})
+
+    def record_statement(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().lower().startswith('select'):
+            self.statements.append((statement, parameters))
+
+    def assert_no_seq_scans(self, name, func, *args):
+        """calls func and fails if any of the selects it ran would scan a hot table sequentially.
+
+        seq scans are disabled for the plan, so one only shows up when no index can serve the query
+        """
+        self.statements = []
+        func(*args)
+        self.assertTrue(self.statements, '%s ran no queries' % name)
+
+        conn = db.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('set enable_seqscan = off;')
+            for statement, parameters in self.statements:
+                cursor.execute('explain (format json) ' + statement, parameters)
+                plan = cursor.fetchone()[0]
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                scanned = [relation for relation in seq_scans(plan[0]['Plan']) if relation in HOT_TABLES]
+                self.assertEqual(scanned, [], '%s: seq scan on %s for: %s' % (name, scanned, statement))
+        finally:
+            conn.close()
+
+    def test_hot_queries_use_indexes(self):
+        """test that the hot query functions don't fall back to seq scans"""
+        import hashlib
+        from uuid import UUID
+        user_id = UUID(hashlib.md5(b'7').hexdigest())
+        address = 'GADDRESS7'
+
+        self.assert_no_seq_scans('list_user_transactions', models.list_user_transactions, user_id, 50)
+        self.assert_no_seq_scans('list_user_incoming_tips', models.list_user_incoming_tips, user_id, address, 50)
+        self.assert_no_seq_scans('list_user_transactions_feed', models.list_user_transactions_feed, user_id, address, 50)
+        self.assert_no_seq_scans('list_user_transactions_feed (paged)', models.list_user_transactions_feed, user_id,
+                                 address, 50, models.encode_tx_cursor(db.engine.execute('select now()').scalar(), 'tx1'))
+        self.assert_no_seq_scans('list_p2p_transactions_for_user_id', models.list_p2p_transactions_for_user_id, user_id, 50)
+        self.assert_no_seq_scans('get_active_user_id_by_enc_phone', models.get_active_user_id_by_enc_phone, 'enc7')
+        self.assert_no_seq_scans('get_address_by_enc_phone_number', models.get_address_by_enc_phone_number, 'enc7')
+        self.assert_no_seq_scans('get_addresses_by_phone_numbers', models.get_addresses_by_phone_numbers, ['+972500000007', '+972500000008'])
+        self.assert_no_seq_scans('get_active_user_id_by_phone', models.get_active_user_id_by_phone, '+972500000007')
+        self.assert_no_seq_scans('get_userid_by_address', models.get_userid_by_address, address)
+        self.assert_no_seq_scans('set_username', models.set_username, user_id, 'user8')
+
+        # both the materialized tips sums and the lateral sum over the txs
+        materialized = config.PICTURE_TIPS_SUM_MATERIALIZED
+        try:
+            config.PICTURE_TIPS_SUM_MATERIALIZED = True
+            self.assert_no_seq_scans('get_pictures_summery', models.get_pictures_summery, user_id)
+            config.PICTURE_TIPS_SUM_MATERIALIZED = False
+            self.assert_no_seq_scans('get_pictures_summery (lateral)', models.get_pictures_summery, user_id)
+        finally:
+            config.PICTURE_TIPS_SUM_MATERIALIZED = materialized
+
+    def test_migrations(self):
+        """test that the migrations are a no-op on a database created from the models"""
+        from tippicserver.migrations import run_migrations, get_migrations_status, MIGRATIONS
+        self.assertTrue(all(not applied for _, _, applied in get_migrations_status()))
+        self.assertTrue(run_migrations())
+        self.assertTrue(all(applied for _, _, applied in get_migrations_status()))
+        self.assertEqual(len(get_migrations_status()), len(MIGRATIONS))
+        # running again does nothing
+        self.assertTrue(run_migrations())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import uuid
+
+import testing.postgresql
+
+import tippicserver
+from tippicserver import db, models
+from tippicserver.replica import Replica, REPLICA_BIND, PRIMARY
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        # the primary and the replica are separate postgres instances - replication is simulated by writing the
+        # replica's rows directly, so each read shows which one it came from
+        self.postgresql = testing.postgresql.Postgresql()
+        self.replica_postgresql = testing.postgresql.Postgresql()
+        tippicserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        tippicserver.app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: self.replica_postgresql.url()}
+        tippicserver.app.testing = True
+        self.app = tippicserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        self.replica = Replica(db, max_lag_secs=5, lag_check_secs=0)
+        db.Model.metadata.create_all(bind=self.replica.engine)
+        db.enable_replica(self.replica)
+        self.replica.forced = REPLICA_BIND
+
+        self.user_id = uuid.uuid4()
+        models.create_user(self.user_id, 'android', 'primary-model', 'token', '05:00', '1', '1.0', None)
+        self.replica.engine.execute("""insert into public.user (user_id, os_type, device_model, time_zone)
+                                       values ('%s', 'iOS', 'replica-model', 0)""" % self.user_id)
+
+    def tearDown(self):
+        db.disable_replica()
+        del tippicserver.app.config['SQLALCHEMY_BINDS']
+        self.replica_postgresql.stop()
+        self.postgresql.stop()
+
+    def test_read_only_helpers(self):
+        """test the read-only helpers read from the replica in GET requests only"""
+        with tippicserver.app.test_request_context(method='GET'):
+            self.assertEqual(models.get_user(self.user_id).device_model, 'replica-model')
+            self.assertEqual(models.get_user_os_type(self.user_id), 'iOS')
+
+        with tippicserver.app.test_request_context(method='GET'):
+            self.replica.engine.execute("insert into public.backup_question (question_text) values ('replica question')")
+            self.assertEqual([q['text'] for q in models.generate_backup_questions_list()], ['replica question'])
+            self.assertEqual(models.list_user_transactions(self.user_id), [])
+
+        # writers read from the primary
+        with tippicserver.app.test_request_context(method='POST'):
+            self.assertEqual(models.get_user(self.user_id).device_model, 'primary-model')
+
+        # and so does everything outside of requests
+        self.assertEqual(models.get_user(self.user_id).device_model, 'primary-model')
+
+        # queries that aren't tagged read-only stay on the primary
+        with tippicserver.app.test_request_context(method='GET'):
+            self.assertEqual(models.User.query.get(self.user_id).device_model, 'primary-model')
+
+    def test_read_your_writes(self):
+        """test a request reads from the primary after it wrote"""
+        with tippicserver.app.test_request_context(method='GET'):
+            self.assertEqual(models.get_user(self.user_id).os_type, 'iOS')
+            models.update_user_token(self.user_id, 'new-token')
+            self.assertEqual(models.get_user(self.user_id).os_type, 'android')
+            self.assertEqual(models.get_user(self.user_id).push_token, 'new-token')
+
+        # the next request reads from the replica again
+        with tippicserver.app.test_request_context(method='GET'):
+            self.assertEqual(models.get_user(self.user_id).os_type, 'iOS')
+
+    def test_current_picture_from_primary(self):
+        """test the current picture, which is cached for all the users, isn't read from the replica"""
+        self.assertTrue(models.add_picture({'skip_image_test': 'true', 'user_id': str(self.user_id),
+                                            'image_url': 'https://example.com/picture.jpg', 'title': 'primary picture',
+                                            'username': 'the author'}))
+        app_data = db.engine.execute('select * from public.user_app_data').fetchall()
+        self.replica.engine.execute(models.UserAppData.__table__.insert(), [dict(row) for row in app_data])
+        models.invalidate_current_picture_cache()
+
+        with tippicserver.app.test_request_context(method='GET'):
+            self.assertEqual(models.get_picture_for_user(self.user_id)['title'], 'primary picture')
+        # the picture index was initialized on the primary
+        self.assertEqual(db.engine.execute('select count(*) from public.system_config').scalar(), 1)
+        self.assertEqual(self.replica.engine.execute('select count(*) from public.system_config').scalar(), 0)
+
+    def test_replica_lag(self):
+        """test the reads fall back to the primary when the replica lags"""
+        self.replica.forced = None
+        # a stand-alone postgres isn't in recovery, so it has no lag
+        with tippicserver.app.test_request_context(method='GET'):
+            self.assertEqual(models.get_user(self.user_id).os_type, 'iOS')
+
+        self.replica.lag = lambda: 30
+        with tippicserver.app.test_request_context(method='GET'):
+            self.assertEqual(models.get_user(self.user_id).os_type, 'android')
+
+        self.replica.lag = lambda: None  # unknown lag
+        with tippicserver.app.test_request_context(method='GET'):
+            self.assertEqual(models.get_user(self.user_id).os_type, 'android')
+
+        self.replica.forced = PRIMARY
+        self.replica.lag = lambda: 0
+        with tippicserver.app.test_request_context(method='GET'):
+            self.assertEqual(models.get_user(self.user_id).os_type, 'android')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+import unittest
+import uuid
+from collections import Counter
+from unittest import mock
+
+import testing.postgresql
+from sqlalchemy import create_engine
+
+import tippicserver
+from tippicserver import db, models
+from tippicserver.sharding import HashRing, ShardRouter, DEFAULT_SHARD
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+USERS_COUNT = 30
+
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        # the default db and two more shards, each on its own postgres
+        self.postgresql = testing.postgresql.Postgresql()
+        self.shards = {'shard-1': testing.postgresql.Postgresql(), 'shard-2': testing.postgresql.Postgresql()}
+        tippicserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        tippicserver.app.testing = True
+        self.app = tippicserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        self.router = ShardRouter(db, {name: shard.url() for name, shard in self.shards.items()})
+        self.router.create_all()
+        db.enable_sharding(self.router)
+
+    def tearDown(self):
+        db.disable_sharding()
+        for shard in self.shards.values():
+            shard.stop()
+        self.postgresql.stop()
+
+    def shard_engine(self, shard):
+        return db.engine if shard == DEFAULT_SHARD else create_engine(self.shards[shard].url())
+
+    def test_hash_ring(self):
+        """test the ring spreads the keys evenly, and adding a node moves only its share of them"""
+        keys = [str(uuid.UUID(int=i)) for i in range(3000)]
+        ring = HashRing(['a', 'b', 'c'])
+        counts = Counter(ring.get_node(key) for key in keys)
+        self.assertEqual(set(counts), {'a', 'b', 'c'})
+        for count in counts.values():
+            self.assertTrue(700 < count < 1300)
+
+        bigger_ring = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys if ring.get_node(key) != bigger_ring.get_node(key)]
+        self.assertTrue(all(bigger_ring.get_node(key) == 'd' for key in moved))
+        self.assertTrue(len(moved) < len(keys) / 2)
+
+    def test_sharded_users(self):
+        """test the per-user rows are written to and read from the user's shard"""
+        user_ids = [uuid.uuid4() for _ in range(USERS_COUNT)]
+        for i, user_id in enumerate(user_ids):
+            models.create_user(user_id, 'android', 'samsung8', 'token-%s' % i, '05:00', str(i), '1.0', None)
+
+        # every user lives on its own shard only
+        for user_id in user_ids:
+            shard = self.router.shard_for(user_id)
+            for name in self.router.shard_names:
+                count = self.shard_engine(name).execute("select count(*) from public.user where user_id = '%s'" % user_id).scalar()
+                self.assertEqual(count, 1 if name == shard else 0)
+        self.assertEqual(len(set(self.router.shard_for(user_id) for user_id in user_ids)), 3)
+
+        # the per-user reads find them
+        for i, user_id in enumerate(user_ids):
+            self.assertEqual(models.get_user(user_id).push_token, 'token-%s' % i)
+            self.assertEqual(models.get_user_app_data(str(user_id)).app_ver, '1.0')
+            self.assertIsNotNone(models.get_token_obj_by_user_id(user_id))
+
+        # scatter-gather
+        self.assertEqual(models.User.query.count(), USERS_COUNT)
+        self.assertEqual(sum(row[0] for row in self.router.scatter_gather('select count(*) from public.user')), USERS_COUNT)
+
+    def test_cross_user_lookups(self):
+        """test looking users up by address and phone number through the directory"""
+        user_id = uuid.uuid4()
+        other_user_id = uuid.uuid4()
+        models.create_user(user_id, 'android', 'samsung8', 'token', '05:00', '1', '1.0', None)
+        models.create_user(other_user_id, 'android', 'samsung8', 'token', '05:00', '2', '1.0', None)
+        models.set_onboarded(user_id, True, 'GCFXHS4GXL6BVUCXBWXGTITROWLVYXQKQLF4YH5O5JT3YZXCYPAFBJZB')
+        models.set_user_phone_number(user_id, '+972527777777')
+
+        self.assertEqual(models.get_userid_by_address('GCFXHS4GXL6BVUCXBWXGTITROWLVYXQKQLF4YH5O5JT3YZXCYPAFBJZB'), user_id)
+        self.assertIsNone(models.get_userid_by_address('GBNOSUCHADDRESS'))
+        enc_phone_number = tippicserver.app.encryption.encrypt('+972527777777')
+        self.assertEqual(models.get_address_by_enc_phone_number(enc_phone_number),
+                         'GCFXHS4GXL6BVUCXBWXGTITROWLVYXQKQLF4YH5O5JT3YZXCYPAFBJZB')
+
+        # the directory is on the default shard, and tracks the users' shards
+        entry = models.UserDirectory.query.get(user_id)
+        self.assertEqual(entry.shard, self.router.shard_for(user_id))
+
+        # deactivated users aren't matched
+        models.deactivate_by_enc_phone_number(enc_phone_number, other_user_id)
+        self.assertIsNone(models.get_address_by_enc_phone_number(enc_phone_number))
+
+    def test_sharded_transactions(self):
+        """test the txs are written to the user's shard, and the totals to the default one"""
+        user_id = uuid.uuid4()
+        models.create_user(user_id, 'android', 'samsung8', 'token', '05:00', '1', '1.0', None)
+        self.assertTrue(models.create_tx('tx-hash-1', user_id, 'GADDRESS', 10, 'tip', 'picture-1'))
+        self.assertEqual([tx.tx_hash for tx in models.list_user_transactions(user_id)], ['tx-hash-1'])
+
+        shard = self.router.shard_for(user_id)
+        self.assertEqual(self.shard_engine(shard).execute('select count(*) from public.transaction').scalar(), 1)
+        self.assertEqual(db.engine.execute('select count(*) from public.tip_total').scalar() > 0, True)
+
+    def test_sharded_readers(self):
+        """test the feed and the phone number lookups read every shard"""
+        author_address = 'GCTWHWZASR3QPR4D2WAVFDIIVZF4VXKAT2NYB7ZNTTWHOA63KWX3B4DA'
+        author_id = uuid.uuid4()
+        models.create_user(author_id, 'android', 'samsung8', 'token', '05:00', 'author', '1.0', None)
+        models.set_onboarded(author_id, True, author_address)
+        models.set_user_phone_number(author_id, '+972527777777')
+
+        # tippers on every shard
+        tipper_ids = [uuid.uuid4() for _ in range(USERS_COUNT)]
+        for i, tipper_id in enumerate(tipper_ids):
+            models.create_user(tipper_id, 'android', 'samsung8', 'token', '05:00', str(i), '1.0', None)
+            self.assertTrue(models.create_tx('tx-hash-%s' % i, tipper_id, author_address, 1, 'picture', 'picture-1'))
+        self.assertTrue(models.create_tx('tx-hash-own', author_id, 'GADDRESS', 1, 'tip', 'picture-2'))
+        self.assertEqual(len(set(self.router.shard_for(tipper_id) for tipper_id in tipper_ids)), 3)
+
+        feed = models.list_user_transactions_feed(author_id, author_address, 100)
+        self.assertEqual(len(feed), USERS_COUNT + 1)
+        self.assertEqual(sorted(tx.tx_hash for tx in feed if tx.incoming_tip),
+                         sorted('tx-hash-%s' % i for i in range(USERS_COUNT)))
+        self.assertEqual(feed, sorted(feed, key=lambda tx: (tx.update_at, tx.tx_hash), reverse=True))
+        self.assertEqual(len(models.list_user_transactions_feed(author_id, author_address, 5)), 5)
+
+        self.assertEqual(models.get_addresses_by_phone_numbers(['+972527777777', '+972520000000']),
+                         {'+972527777777': author_address})
+
+    def test_default_shard_writes(self):
+        """test the tables that stay on the default db take the users of the other shards"""
+        user_ids = []
+        while len(user_ids) < 2:
+            user_id = uuid.uuid4()
+            if self.router.shard_for(user_id) != DEFAULT_SHARD:
+                user_ids.append(user_id)
+        addresses = ['GCFXHS4GXL6BVUCXBWXGTITROWLVYXQKQLF4YH5O5JT3YZXCYPAFBJZB',
+                     'GCTWHWZASR3QPR4D2WAVFDIIVZF4VXKAT2NYB7ZNTTWHOA63KWX3B4DA']
+        for i, (user_id, address) in enumerate(zip(user_ids, addresses)):
+            models.create_user(user_id, 'android', 'samsung8', 'token', '05:00', str(i), '1.0', None)
+            models.set_onboarded(user_id, True, address)
+        sender_id, receiver_id = user_ids
+
+        # onboarding
+        with mock.patch.object(models.onboarding, 'enqueue_onboarding_job'):
+            token, status = models.start_onboarding(sender_id, addresses[0])
+        self.assertEqual(status, models.ONBOARDING_QUEUED)
+        self.assertIsNotNone(models.get_onboarding_job(sender_id))
+
+        # a reported tx
+        tippicserver.config.TX_VERIFICATION_INLINE = False
+        self.addCleanup(setattr, tippicserver.config, 'TX_VERIFICATION_INLINE', True)
+        self.assertEqual(models.report_transaction({'tx_hash': 'a' * 64, 'user_id': str(sender_id), 'amount': 5,
+                                                    'to_address': addresses[1], 'id': '1', 'type': 'picture'}),
+                         models.TX_REPORT_PENDING)
+
+        # a p2p tx
+        self.assertEqual(models.add_p2p_tx('b' * 64, sender_id, addresses[1], 5)[0], True)
+        self.assertEqual(db.engine.execute("select receiver_user_id from public.p2_p_transaction where tx_hash = '%s'"
+                                           % ('b' * 64)).scalar(), receiver_id)
+
+        # a picture report
+        self.assertTrue(models.report_picture(str(receiver_id), 'picture-1'))
+
+    def test_migrations(self):
+        """test the migrations are applied to every shard, and the cross-shard backfills only before sharding"""
+        from tippicserver.migrations import run_migrations, get_migrations_status, CROSS_SHARD_MIGRATIONS
+
+        self.assertFalse(run_migrations())
+        for version in CROSS_SHARD_MIGRATIONS:
+            db.engine.execute("insert into public.schema_migration (version, description) values ('%s', 'applied before sharding')"
+                              % version)
+        self.assertTrue(run_migrations())
+        for name in self.router.shard_names:
+            self.assertTrue(all(applied for _, _, applied in get_migrations_status(self.shard_engine(name))))
+
+    def test_directory_backfill(self):
+        """test the backfill rebuilds the directory entries from the shards"""
+        user_ids = [uuid.uuid4() for _ in range(USERS_COUNT)]
+        for i, user_id in enumerate(user_ids):
+            models.create_user(user_id, 'android', 'samsung8', 'token', '05:00', str(i), '1.0', None)
+        models.set_onboarded(user_ids[0], True, 'GCFXHS4GXL6BVUCXBWXGTITROWLVYXQKQLF4YH5O5JT3YZXCYPAFBJZB')
+
+        # lose some entries, and corrupt another
+        db.engine.execute("delete from public.user_directory where user_id <> '%s'" % user_ids[0])
+        db.engine.execute("update public.user_directory set public_address = null where user_id = '%s'" % user_ids[0])
+        self.assertIsNone(models.get_userid_by_address('GCFXHS4GXL6BVUCXBWXGTITROWLVYXQKQLF4YH5O5JT3YZXCYPAFBJZB'))
+
+        self.assertEqual(models.backfill_user_directory(batch_size=7), USERS_COUNT)
+        for user_id in user_ids:
+            self.assertEqual(models.UserDirectory.query.get(user_id).shard, self.router.shard_for(user_id))
+        self.assertEqual(models.get_userid_by_address('GCFXHS4GXL6BVUCXBWXGTITROWLVYXQKQLF4YH5O5JT3YZXCYPAFBJZB'), user_ids[0])
+
+        # up to date entries aren't rewritten
+        self.assertEqual(models.backfill_user_directory(batch_size=7), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
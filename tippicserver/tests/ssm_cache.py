@@ -0,0 +1,73 @@
+import time
+import unittest
+
+from tippicserver.ssm import SSMParameterCache
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class StubSSMClient(object):
+    """a stand-in for boto3's ssm client"""
+
+    def __init__(self, values):
+        self.values = values
+        self.calls = []
+        self.fail = False
+
+    def get_parameters(self, Names, WithDecryption):
+        self.calls.append(list(Names))
+        if self.fail:
+            raise Exception('ssm is down')
+        if len(Names) > 10:
+            raise Exception('too many names')
+        return {'Parameters': [{'Name': name, 'Value': self.values[name]} for name in Names if name in self.values],
+                'InvalidParameters': [name for name in Names if name not in self.values]}
+
+
+class Tester(unittest.TestCase):
+
+    def test_cache(self):
+        """test batching, caching, refreshing and invalidating ssm values"""
+        names = ['/config/test/param%s' % i for i in range(12)]
+        client = StubSSMClient({name: 'value-%s' % name for name in names})
+        cache = SSMParameterCache('us-east-1', ttl_secs=60, client=client)
+
+        # fetched in batches of 10, missing names are None
+        values = cache.get_many(names + ['/config/test/missing'])
+        self.assertEqual(values[names[11]], 'value-%s' % names[11])
+        self.assertIsNone(values['/config/test/missing'])
+        self.assertEqual([len(call) for call in client.calls], [10, 3])
+
+        # served from memory, including the missing one
+        self.assertEqual(cache.get(names[0]), 'value-%s' % names[0])
+        self.assertIsNone(cache.get('/config/test/missing'))
+        self.assertEqual(len(client.calls), 2)
+
+        # past its ttl, the stale value is served while it's refreshed in the background
+        client.values[names[0]] = 'rotated'
+        cache._values[names[0]] = ('value-%s' % names[0], time.time() - 1)
+        self.assertEqual(cache.get(names[0]), 'value-%s' % names[0])
+        for _ in range(50):
+            if cache.get(names[0]) == 'rotated':
+                break
+            time.sleep(0.1)
+        self.assertEqual(cache.get(names[0]), 'rotated')
+
+        # if ssm can't be reached, whatever is cached is served
+        client.fail = True
+        cache._values[names[1]] = ('value-%s' % names[1], time.time() - 61)
+        self.assertEqual(cache.get(names[1]), 'value-%s' % names[1])
+        self.assertIsNone(cache.get('/config/test/never-fetched'))
+
+        # invalidated values are fetched again
+        client.fail = False
+        client.values[names[2]] = 'rotated2'
+        cache.invalidate([names[2]])
+        self.assertEqual(cache.get(names[2]), 'rotated2')
+        cache.invalidate()
+        self.assertEqual(cache._values, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
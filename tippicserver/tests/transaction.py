@@ -118,6 +118,168 @@ class Tester(unittest.TestCase):
                              content_type='application/json')
         self.assertEqual(resp.status_code, 400)
 
+    def test_tip_totals(self):
+        """ Test the running tip totals and their reconciliation """
+        from tippicserver import models
+        from tippicserver.utils import GIFT, PICTURE
+
+        user_id = uuid.uuid4()
+        resp = self.app.post('/user/register',
+                             data=json.dumps({
+                                 'user_id': str(user_id),
+                                 'os': 'iOS',
+                                 'device_model': 'iPhone X',
+                                 'device_id': '234234',
+                                 'time_zone': '05:00',
+                                 'token': 'fake_token',
+                                 'app_ver': '1.0'}),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        author_address = 'GCTWHWZASR3QPR4D2WAVFDIIVZF4VXKAT2NYB7ZNTTWHOA63KWX3B4DA'
+
+        self.assertTrue(models.create_tx('tx1', str(user_id), 'GUSERADDRESS', 30, GIFT, 'onboarding-gift'))
+        self.assertTrue(models.create_tx('tx2', str(user_id), author_address, 5, PICTURE, 'picture-1'))
+        self.assertTrue(models.create_tx('tx3', str(user_id), author_address, 7, PICTURE, 'picture-1'))
+        # duplicates are rejected and don't count
+        self.assertFalse(models.create_tx('tx3', str(user_id), author_address, 7, PICTURE, 'picture-1'))
+        # the tx and its totals commit together
+        from unittest import mock
+        with mock.patch('tippicserver.models.transaction.increment_totals', side_effect=Exception('totals failed')):
+            self.assertFalse(models.create_tx('tx4', str(user_id), author_address, 9, PICTURE, 'picture-1'))
+        self.assertIsNone(models.Transaction.query.get('tx4'))
+
+        self.assertEqual(models.get_tx_totals(), {'to_public': 30, 'from_public': 0})
+        totals = models.get_user_totals(user_id, author_address)
+        self.assertEqual(totals['gifts'], 30)
+        self.assertEqual(totals['tips_given'], 12)
+        self.assertEqual(totals['tips_received'], 12)
+
+        # introduce drift and reconcile it away
+        db.engine.execute("update public.tip_total set total = 1000 where scope='%s';" % models.SCOPE_TX_TYPE)
+        self.assertEqual(models.get_tx_totals()['to_public'], 1000)
+        self.assertTrue(models.reconcile_tip_totals())
+        self.assertEqual(models.get_tx_totals()['to_public'], 30)
+        self.assertEqual(models.get_user_totals(user_id, author_address)['tips_given'], 12)
+
+
+    def test_transaction_verification(self):
+        """ Test verifying the reported txs in the background """
+        from unittest import mock
+        from tippicserver import models, stellar
+        from tippicserver.models import transaction_report
+
+        user_id = uuid.uuid4()
+        resp = self.app.post('/user/register',
+                             data=json.dumps({
+                                 'user_id': str(user_id),
+                                 'os': 'iOS',
+                                 'device_model': 'iPhone X',
+                                 'device_id': '234234',
+                                 'time_zone': '05:00',
+                                 'token': 'fake_token',
+                                 'app_ver': '1.0'}),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        tippicserver.config.TX_VERIFICATION_INLINE = False
+        self.addCleanup(setattr, tippicserver.config, 'TX_VERIFICATION_INLINE', True)
+        valid_hash, invalid_hash, missing_hash = ('a' * 64), ('b' * 64), ('c' * 64)
+        for tx_hash in (valid_hash, invalid_hash, missing_hash):
+            self.assertEqual(models.report_transaction({'tx_hash': tx_hash, 'user_id': str(user_id), 'amount': 5,
+                                                        'to_address': 'GCTWHWZASR3QPR4D2WAVFDIIVZF4VXKAT2NYB7ZNTTWHOA63KWX3B4DA',
+                                                        'id': '1', 'type': 'picture'}), models.TX_REPORT_PENDING)
+        self.assertEqual(models.get_transaction_report_status(valid_hash, user_id), models.TX_REPORT_PENDING)
+        self.assertEqual(models.list_user_transactions(user_id), [])
+
+        lookups = {valid_hash: (stellar.TX_LOOKUP_VALID, {'amount': 5, 'to_address': 'GCTWHWZASR3QPR4D2WAVFDIIVZF4VXKAT2NYB7ZNTTWHOA63KWX3B4DA'}),
+                   invalid_hash: (stellar.TX_LOOKUP_INVALID, {}),
+                   missing_hash: (stellar.TX_LOOKUP_MISSING, {})}
+        with mock.patch.object(stellar, 'lookup_tx_payment_data', side_effect=lambda tx_hash: lookups[tx_hash]), \
+                mock.patch.object(transaction_report, 'TX_VERIFICATION_JOB_MAX_SECS', 2):
+            transaction_report.verify_transaction_reports()
+
+        self.assertEqual(models.get_transaction_report_status(valid_hash, user_id), models.TX_REPORT_VERIFIED)
+        self.assertEqual(models.get_transaction_report_status(invalid_hash, user_id), models.TX_REPORT_REJECTED)
+        # not on the ledger yet - still retried
+        self.assertEqual(models.get_transaction_report_status(missing_hash, user_id), models.TX_REPORT_PENDING)
+        self.assertEqual([tx.tx_hash for tx in models.list_user_transactions(user_id)], [valid_hash])
+        # the verified result is published to the long-polling requests
+        self.assertEqual(models.wait_for_transaction_report(valid_hash, 1), models.TX_REPORT_VERIFIED)
+
+        resp = self.app.get('/user/transaction/status?tx_hash=%s' % invalid_hash, headers={USER_ID_HEADER: str(user_id)})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['tx_status'], models.TX_REPORT_REJECTED)
+
+    def test_tx_cursor(self):
+        """test encoding and decoding the /user/transactions paging cursor"""
+        from datetime import datetime, timezone
+        from tippicserver.models.transaction import encode_tx_cursor, decode_tx_cursor
+        from tippicserver.utils import InvalidUsage
+
+        update_at = datetime(2019, 3, 1, 10, 20, 30, 123456, tzinfo=timezone.utc)
+        cursor = encode_tx_cursor(update_at, 'abcd-1234')
+        self.assertEqual(decode_tx_cursor(cursor), (update_at, 'abcd-1234'))
+        with self.assertRaises(InvalidUsage):
+            decode_tx_cursor('not-a-cursor')
+
+    def test_transactions_paging(self):
+        """test paging /user/transactions through the merged feed of the user's txs and incoming tips"""
+        from unittest import mock
+        from tippicserver.utils import PICTURE, GIFT, GIVE_TIP, GET_TIP
+
+        userid1, userid2 = uuid.uuid4(), uuid.uuid4()
+        for userid in (userid1, userid2):
+            resp = self.app.post('/user/register',
+                                 data=json.dumps({
+                                     'user_id': str(userid),
+                                     'os': 'android',
+                                     'device_model': 'samsung8',
+                                     'device_id': '234234',
+                                     'time_zone': '05:00',
+                                     'token': 'fake_token',
+                                     'app_ver': '1.0'}),
+                                 headers={},
+                                 content_type='application/json')
+            self.assertEqual(resp.status_code, 200)
+
+        address1 = 'GCTWHWZASR3QPR4D2WAVFDIIVZF4VXKAT2NYB7ZNTTWHOA63KWX3B4DA'
+        other_address = 'GBC3SG6NGTSZ2OMH3FFGB7UVRQWILW367U4GSOOF4TFSZONV42UJXUH7'
+        db.engine.execute("update public.user set public_address='%s' where user_id='%s';" % (address1, userid1))
+
+        # three txs tie on update_at, and a page ends between them
+        earlier, later = '2019-03-01 10:00:00+00', '2019-03-01 10:00:01+00'
+        for tx_hash, user_id, to_address, amount, tx_type, update_at in [
+                ('tx-a', userid1, other_address, 10, PICTURE, earlier),
+                ('tx-b', userid2, address1, 20, PICTURE, earlier),
+                ('tx-c', userid1, address1, 30, GIFT, earlier),
+                ('tx-d', userid1, other_address, 40, PICTURE, later),
+                ('tx-e', userid2, address1, 50, PICTURE, later)]:
+            db.engine.execute("""insert into public.transaction (tx_hash, user_id, to_address, amount, tx_for_item_id, tx_type, update_at)
+                                 values ('%s', '%s', '%s', %s, 'item', '%s', '%s');"""
+                              % (tx_hash, user_id, to_address, amount, tx_type, update_at))
+
+        pages = []
+        before = None
+        with mock.patch('tippicserver.utils.MAX_TXS_PER_USER', 2):
+            while True:
+                resp = self.app.get('/user/transactions' + ('?before=%s' % before if before else ''),
+                                    headers={USER_ID_HEADER: str(userid1)})
+                self.assertEqual(resp.status_code, 200)
+                data = json.loads(resp.data)
+                pages.append([(tx['type'], tx['amount']) for tx in data['txs']])
+                before = data['next']
+                if before is None:
+                    break
+
+        self.assertEqual(pages, [[(GET_TIP, 50), (GIVE_TIP, -40)],
+                                 [(GIFT, 30), (GET_TIP, 20)],
+                                 [(GIVE_TIP, -10)]])
+
+        resp = self.app.get('/user/transactions?before=not-a-cursor', headers={USER_ID_HEADER: str(userid1)})
+        self.assertEqual(resp.status_code, 400)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -237,6 +237,174 @@ class Tester(unittest.TestCase):
         print(data)
         self.assertEqual(data, [])
 
+    def test_version_policy(self):
+        """test the cached version thresholds"""
+        from tippicserver import models
+
+        db.engine.execute("insert into public.system_config (sid, current_picture_index) values (nextval('sid'), 0);")
+        models.invalidate_version_policy()
+
+        user_id = uuid.uuid4()
+        resp = self.app.post('/user/register',
+                             data=json.dumps({
+                                 'user_id': str(user_id),
+                                 'os': 'android',
+                                 'device_model': 'samsung8',
+                                 'device_id': '234234',
+                                 'time_zone': '05:00',
+                                 'token': 'fake_token',
+                                 'app_ver': '1.0.2'}),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        # no thresholds are set
+        policy = models.get_version_policy()
+        self.assertEqual(policy.should_force_update('android', '1.0.2'), False)
+        self.assertIs(models.get_version_policy(), policy)
+
+        # writing the thresholds drops the cached policy
+        resp = self.app.post('/system/versions/force-update-below',
+                             data=json.dumps({'os_type': 'android', 'version': '1.0.10'}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        resp = self.app.post('/system/versions/update-available-below',
+                             data=json.dumps({'os_type': 'iOS', 'version': '2.0'}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNot(models.get_version_policy(), policy)
+
+        resp = self.app.post('/user/app-launch',
+                             data=json.dumps({'app_ver': '1.0.2'}),
+                             headers={USER_ID_HEADER: str(user_id)},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        # compared like LooseVersion - 1.0.2 < 1.0.10
+        self.assertEqual(data['config']['force_update'], True)
+        self.assertEqual(data['config']['is_update_available'], False)
+        self.assertEqual(models.is_update_available('iOS', '1.9'), True)
+
+        # the serialized config is built once per (os, app_ver) and dropped with the policy
+        payload = models.get_client_config_payload('android', '1.0.2')
+        self.assertEqual(json.loads(payload.decode())['config'], data['config'])
+        self.assertIs(models.get_client_config_payload('android', '1.0.2'), payload)
+        models.invalidate_version_policy()
+        self.assertIsNot(models.get_client_config_payload('android', '1.0.2'), payload)
+
+    def test_user_context(self):
+        """test the request-scoped user context"""
+        from tippicserver import models
+
+        user_id = uuid.uuid4()
+        resp = self.app.post('/user/register',
+                             data=json.dumps({
+                                 'user_id': str(user_id),
+                                 'os': 'android',
+                                 'device_model': 'samsung8',
+                                 'device_id': '234234',
+                                 'time_zone': '05:00',
+                                 'token': 'fake_token',
+                                 'app_ver': '1.0'}),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        # outside of a request there's no context
+        self.assertEqual(models.get_user_context(str(user_id)), None)
+
+        with tippicserver.app.test_request_context():
+            context = models.get_user_context(str(user_id))
+            self.assertEqual(str(context.user.user_id), str(user_id))
+            self.assertEqual(context.user_app_data.app_ver, '1.0')
+            self.assertNotEqual(context.push_auth_token, None)
+            self.assertEqual(context.blacklisted, False)
+            # the same object is served for the rest of the request
+            self.assertIs(models.get_user_context(str(user_id)), context)
+            self.assertEqual(models.get_user_os_type(str(user_id)), 'android')
+            self.assertEqual(models.is_user_phone_verified(str(user_id)), False)
+
+            # unknown users get an empty context
+            self.assertEqual(models.get_user_context(str(uuid.uuid4())).user, None)
+
+        with tippicserver.app.test_request_context():
+            models.set_user_phone_number(str(user_id), '+9720528802120')
+            self.assertEqual(models.is_user_phone_verified(str(user_id)), True)
+            models.blacklist_phone_by_user_id(str(user_id))
+            self.assertEqual(models.is_userid_blacklisted(str(user_id)), True)
+
+    def test_phone_number_index(self):
+        """test matching phone numbers by their blind index, and by the encrypted number until it's backfilled"""
+        from tippicserver import models, config
+
+        encryption = tippicserver.app.encryption
+        self.assertEqual(encryption.encrypt('+972528802120'), encryption.encrypt('+972528802120'))
+        self.assertEqual(encryption.decrypt(encryption.encrypt('+972528802120')), '+972528802120')
+        self.assertEqual(len(encryption.blind_index('+972528802120')), 32)
+        self.assertNotEqual(encryption.blind_index('+972528802120'), encryption.blind_index('+972528802121'))
+
+        user_id = uuid.uuid4()
+        models.create_user(user_id, 'android', 'samsung8', 'fake_token', '05:00', '234234', '1.0', None)
+        models.set_onboarded(user_id, True, 'GADDRESS')
+        models.set_user_phone_number(user_id, '+972528802120')
+        self.assertEqual(models.get_active_user_id_by_phone('+972528802120'), user_id)
+
+        # a user from before the index is matched by the encrypted number
+        db.engine.execute("update public.user set phone_number_index = null;")
+        self.assertEqual(models.get_active_user_id_by_phone('+972528802120'), user_id)
+        self.assertEqual(models.get_addresses_by_phone_numbers(['+972528802120', '+972528802121']), {'+972528802120': 'GADDRESS'})
+        self.assertEqual(models.count_registrations_for_phone_number('+972528802120'), 1)
+
+        self.assertEqual(models.backfill_phone_number_indexes(), 1)
+        self.assertEqual(models.backfill_phone_number_indexes(), 0)
+        index_only = config.PHONE_NUMBER_INDEX_ONLY
+        try:
+            config.PHONE_NUMBER_INDEX_ONLY = True
+            self.assertEqual(models.get_active_user_id_by_phone('+972528802120'), user_id)
+            self.assertEqual(models.get_addresses_by_phone_numbers(['+972528802120']), {'+972528802120': 'GADDRESS'})
+            self.assertEqual(models.get_all_user_id_by_phone('+972528802121'), [])
+        finally:
+            config.PHONE_NUMBER_INDEX_ONLY = index_only
+
+    def test_contacts_match(self):
+        """test matching a list of contacts to addresses in one request"""
+        from tippicserver import models
+
+        sender_id = uuid.uuid4()
+        models.create_user(sender_id, 'android', 'samsung8', 'fake_token', '05:00', '1', '1.0', None)
+        models.set_user_phone_number(sender_id, '+972527702890')
+        # the 3rd user's number was stored with the leading zero, the 4th user is deactivated
+        for i, phone_number in enumerate(['+972528802120', '+9720528802121', '+972528802122']):
+            user_id = uuid.uuid4()
+            models.create_user(user_id, 'android', 'samsung8', 'fake_token', '05:00', str(i + 2), '1.0', None)
+            models.set_onboarded(user_id, True, 'GADDRESS%s' % (i + 2))
+            models.set_user_phone_number(user_id, phone_number)
+        models.deactivate_user(user_id)
+
+        resp = self.app.post('/user/contacts/match',
+                             data=json.dumps({'phone_numbers': ['+972528802120', '0528802120', '0528802121',
+                                                                '0528802122', '0500000000']}),
+                             headers={USER_ID_HEADER: str(sender_id)},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['matches'],
+                         {'+972528802120': 'GADDRESS2', '0528802120': 'GADDRESS2', '0528802121': 'GADDRESS3'})
+
+        # up to MAX_CONTACTS_PER_MATCH numbers per request
+        phone_numbers = ['05000%05d' % i for i in range(1000)]
+        resp = self.app.post('/user/contacts/match', data=json.dumps({'phone_numbers': phone_numbers}),
+                             headers={USER_ID_HEADER: str(sender_id)}, content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['matches'], {})
+        resp = self.app.post('/user/contacts/match', data=json.dumps({'phone_numbers': phone_numbers + ['0528802120']}),
+                             headers={USER_ID_HEADER: str(sender_id)}, content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+
+        # a bad payload
+        resp = self.app.post('/user/contacts/match', data=json.dumps({'phone_numbers': '0528802120'}),
+                             headers={USER_ID_HEADER: str(sender_id)}, content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -80,6 +80,45 @@ class Tester(unittest.TestCase):
         # this user_config function:
         print(models.get_user_config(str(userid)))
 
+    def test_app_launch_batches(self):
+        """test applying queued app launches in a batch"""
+        userids = [uuid.uuid4(), uuid.uuid4()]
+        for userid in userids:
+            resp = self.app.post('/user/register',
+                                data=json.dumps({
+                                'user_id': str(userid),
+                                'os': 'android',
+                                'device_model': 'samsung8',
+                                'device_id': '234234',
+                                'time_zone': '05:00',
+                                'token': 'fake_token',
+                                'app_ver': '1.0'}),
+                                headers={},
+                                content_type='application/json')
+            self.assertEqual(resp.status_code, 200)
+
+        # the latest launch per user wins, and unchanged rows aren't written
+        launches = [{'user_id': str(userids[0]), 'ip_address': '1.1.1.1', 'app_ver': '1.0', 'launched_at': 100},
+                    {'user_id': str(userids[0]), 'ip_address': '8.8.8.8', 'app_ver': '1.1', 'launched_at': 200},
+                    {'user_id': str(userids[1]), 'ip_address': None, 'app_ver': '1.0', 'launched_at': 100}]
+        self.assertEqual(models.apply_app_launches(launches), 1)
+        app_data = models.UserAppData.query.filter_by(user_id=userids[0]).first()
+        self.assertEqual(app_data.app_ver, '1.1')
+        self.assertEqual(app_data.ip_address, '8.8.8.8')
+        self.assertEqual(models.apply_app_launches(launches), 0)
+
+        # launches through the api are applied right away on tests
+        resp = self.app.post('/user/app-launch',
+                            data=json.dumps({
+                            'app_ver': '1.2'}),
+                            headers={USER_ID_HEADER: str(userids[1]), 'X-Forwarded-For': 'not-an-ip'},
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        db.session.expire_all()
+        app_data = models.UserAppData.query.filter_by(user_id=userids[1]).first()
+        self.assertEqual(app_data.app_ver, '1.2')
+        self.assertEqual(app_data.ip_address, None)
+
 
 if __name__ == '__main__':
     unittest.main()
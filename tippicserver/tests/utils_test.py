@@ -54,6 +54,15 @@ class Tester(unittest.TestCase):
         self.assertEqual(send_push, send_push_r)
         self.assertEqual(timestamp_r, timestamp)
 
+    def test_parse_phone_numbers(self):
+        """test parsing phone numbers in bulk, by the sender's region"""
+        parsed = utils.parse_phone_numbers(['+972528802120', '0528802120', '052-880-2121', 'not a number'], '+972527702890')
+        self.assertEqual(parsed, {'+972528802120': '+972528802120', '0528802120': '+972528802120',
+                                  '052-880-2121': '+972528802121', 'not a number': 'not a number'})
+        self.assertEqual(utils.parse_phone_number('0528802120', '+972527702890'), '+972528802120')
+        self.assertEqual(utils.parse_phone_number('0528802120', None), '0528802120')
+        self.assertTrue(utils.parse_phone_number_for_region.cache_info().hits > 0)
+
 
 
 if __name__ == '__main__':
@@ -1,3 +1,5 @@
+import contextlib
+import functools
 import json
 import logging as log
 import os
@@ -32,11 +34,6 @@ MAX_TXS_PER_USER = 100
 REDIS_USERID_PREFIX = 'userid'
 
 
-def get_discovery_apps(link):
-    import urllib.request, json
-    with urllib.request.urlopen(link) as url:
-        return json.loads(url.read().decode())['apps']
-
 def generate_order_id(is_manual=False):
     # generate a unique-ish id for txs, this goes into the memo field of txs
     env = config.DEPLOYMENT_ENV[0:1]  # either 's(tage)', 't(est)' or 'p(rod)'
@@ -61,6 +58,14 @@ def gauge_metric(metric_name, value, tags_str=''):
     statsd.gauge(metric_name, value, tags=[tags])
 
 
+def histogram_metric(metric_name, value, tags_str=''):
+    """report a sample of a distribution (latencies, durations) with the given name and value"""
+    tags = 'app:tippic,env:%s' % config.DEPLOYMENT_ENV
+    if tags_str:
+        tags = tags + ',' + tags_str
+    statsd.histogram(metric_name, value, tags=[tags])
+
+
 def errors_to_string(errorcode):
     """ translate error codes to human-readable reasons """
     if errorcode == ERROR_ORDERS_COOLDOWN:
@@ -189,58 +194,89 @@ def test_image(url):
 def sqlalchemy_pool_status():
     """returns and prints a dict with various db stats"""
     from tippicserver import db
+    from tippicserver.db_pool import checkout_tracker
     from sqlalchemy.pool import QueuePool
     pool_size = QueuePool.size(db.engine.pool)
     checkedin = QueuePool.checkedin(db.engine.pool)
     overflow = QueuePool.overflow(db.engine.pool)
     checkedout = QueuePool.checkedout(db.engine.pool)
+    capacity = pool_size + db.engine.pool._max_overflow
+    leaked = len(checkout_tracker.leaked())
 
     log.info("Pool size: %d  Connections in pool: %d " \
            "Current Overflow: %d Current Checked out " \
-           "connections: %d" % (pool_size, checkedin, overflow, checkedout))
-    return {'pool_size': pool_size, 'checkedin': checkedin, 'overflow': overflow, 'checkedout': checkedout}
+           "connections: %d Capacity: %d Leaked: %d" % (pool_size, checkedin, overflow, checkedout, capacity, leaked))
+    return {'pool_size': pool_size, 'checkedin': checkedin, 'overflow': overflow, 'checkedout': checkedout,
+            'capacity': capacity, 'leaked': leaked}
+
+
+@contextlib.contextmanager
+def db_transaction(engine=None):
+    """yields a connection to the given engine (default: db.engine) in an explicit transaction.
+
+    the prod/stage engines autocommit every statement, so statements that must commit together run in one of these.
+    """
+    from tippicserver import db
+    with (engine or db.engine).connect() as conn:
+        conn = conn.execution_options(isolation_level='READ COMMITTED')
+        with conn.begin():
+            yield conn
+
+
+PHONE_NUMBER_CACHE_SIZE = 100000
 
 
 def parse_phone_number(number_to_parse, sender_number):
     """try to convert a raw input phone number into e.164"""
-    #  first, try to parse the number as-is:
-    parsed_number = parse_phone_number_naively(number_to_parse)
+    parsed_number = parse_phone_number_for_region(number_to_parse, get_phone_number_region(sender_number))
     if parsed_number:
-        log.info('parse_phone_number: naively parsed phone number')
         return parsed_number
 
-    # try to parse with the sender's number as a clue
-    if sender_number:
-        parsed_number = parse_phone_number_by_sender_country_code(sender_number, number_to_parse)
-        if parsed_number:
-            log.info('parse_phone_number: parsed phone number by sender_number')
-            return parsed_number
-
     # give up, just return the original number:
     log.error('parse_phone_number: failed to parse phone number. returning raw number')
     return number_to_parse
 
 
-def parse_phone_number_naively(number_to_parse):
-    """naively attempt to format a number into e.164. should fail (return None) for local numbers"""
+def parse_phone_numbers(numbers_to_parse, sender_number):
+    """converts the given raw phone numbers into e.164 in one pass. returns a dict of raw -> parsed (or raw) number"""
+    region = get_phone_number_region(sender_number)
+    return {number: parse_phone_number_for_region(number, region) or number for number in numbers_to_parse}
+
+
+@functools.lru_cache(maxsize=PHONE_NUMBER_CACHE_SIZE)
+def parse_phone_number_for_region(number_to_parse, region):
+    """returns the e.164 form of the given number - as-is, or else as a local number of the given region. None on failure"""
+    #  first, try to parse the number as-is:
+    parsed_number = parse_phone_number_naively(number_to_parse)
+    if parsed_number:
+        return parsed_number
+
+    # try to parse with the sender's region as a clue
+    if region:
+        try:
+            return phonenumbers.format_number(phonenumbers.parse(number_to_parse, region), phonenumbers.PhoneNumberFormat.E164)
+        except phonenumbers.NumberParseException:
+            log.error('parse_phone_number_for_region: cant parse number with sender\'s region')
+    return None
+
+
+@functools.lru_cache(maxsize=PHONE_NUMBER_CACHE_SIZE)
+def get_phone_number_region(phone_number):
+    """returns the region code (e.g. IL) of the given e.164 number, or None"""
+    if not phone_number:
+        return None
     try:
-        formatted_sent_number = phonenumbers.parse(number_to_parse, None)
-    except phonenumbers.NumberParseException as e:
-        log.error('parse_phone_number_naively: cant parse number')
+        return phonenumbers.region_code_for_country_code(phonenumbers.parse(phone_number, None).country_code)
+    except phonenumbers.NumberParseException:
+        log.error('get_phone_number_region: cant parse the sender\'s number')
         return None
-    else:
-        return phonenumbers.format_number(formatted_sent_number, phonenumbers.PhoneNumberFormat.E164)
 
 
-def parse_phone_number_by_sender_country_code(sender_number, number_to_parse):
-    """this function attempts to format the given 'sent_number' into a phone_number,
-    based on the the 'sender_number''s country code"""
+def parse_phone_number_naively(number_to_parse):
+    """naively attempt to format a number into e.164. should fail (return None) for local numbers"""
     try:
-        formatted_sender_number = phonenumbers.parse(sender_number, None)
-        country_code = formatted_sender_number.country_code
-        formatted_sent_number = phonenumbers.parse(number_to_parse, phonenumbers.region_code_for_country_code(country_code))
+        formatted_sent_number = phonenumbers.parse(number_to_parse, None)
     except phonenumbers.NumberParseException as e:
-        log.error('parse_phone_number_by_sender_country_code: cant parse number with sender\'s country code')
         return None
     else:
         return phonenumbers.format_number(formatted_sent_number, phonenumbers.PhoneNumberFormat.E164)
@@ -250,7 +286,7 @@ def print_creation_statement():
     """prints out db creation statement. useful"""
     from sqlalchemy.schema import CreateTable
     from sqlalchemy.dialects import postgresql
-    from .models import UserAppData, User, ACL, BackupQuestion, PhoneBackupHints, EmailTemplate, BlacklistedEncPhoneNumber, SystemConfig, PushAuthToken,Picture, Transaction,ReportedPictures
+    from .models import UserAppData, User, ACL, BackupQuestion, PhoneBackupHints, EmailTemplate, BlacklistedEncPhoneNumber, SystemConfig, PushAuthToken,Picture, Transaction,ReportedPictures, TipTotal, TransactionReport, LedgerPayment, LedgerCursor, OnboardingJob
     log.info(CreateTable(User.__table__).compile(dialect=postgresql.dialect()))
     log.info(CreateTable(UserAppData.__table__).compile(dialect=postgresql.dialect()))
     log.info(CreateTable(ACL.__table__).compile(dialect=postgresql.dialect()))
@@ -263,6 +299,11 @@ def print_creation_statement():
     log.info(CreateTable(Picture.__table__).compile(dialect=postgresql.dialect()))
     log.info(CreateTable(Transaction.__table__).compile(dialect=postgresql.dialect()))
     log.info(CreateTable(ReportedPictures.__table__).compile(dialect=postgresql.dialect()))
+    log.info(CreateTable(TipTotal.__table__).compile(dialect=postgresql.dialect()))
+    log.info(CreateTable(TransactionReport.__table__).compile(dialect=postgresql.dialect()))
+    log.info(CreateTable(LedgerPayment.__table__).compile(dialect=postgresql.dialect()))
+    log.info(CreateTable(LedgerCursor.__table__).compile(dialect=postgresql.dialect()))
+    log.info(CreateTable(OnboardingJob.__table__).compile(dialect=postgresql.dialect()))
 
 
 def random_string(length=8):
@@ -353,14 +394,9 @@ def passed_captcha(captcha_token):
 
 
 def get_country_code_by_ip(ip_addr):
-    try:
-        if not ip_addr:
-            return None
-        return app.geoip_reader.get(ip_addr)['country']['iso_code']
-    except Exception as e:
-        log.error('cant convert ip %s to country code' % ip_addr)
-
+    if not ip_addr:
         return None
+    return app.geoip.lookup(ip_addr)
 
 
 def commit_json_changed_to_orm(obj_to_commit, changed_fields_list):
@@ -11,11 +11,16 @@ from tippicserver.models import nuke_user_data, get_user_report, get_user_tx_rep
     user_exists, get_unauthed_users, get_all_user_id_by_phone, delete_all_user_data, blacklist_phone_number, \
     blacklist_phone_by_user_id, \
     get_tx_totals, set_should_solve_captcha, \
-    set_update_available_below, set_force_update_below, add_picture, skip_picture_wait
+    set_update_available_below, set_force_update_below, add_picture, skip_picture_wait, reconcile_tip_totals, \
+    schedule_transaction_verification, invalidate_acl, rebuild_blacklist, backfill_country_iso_codes, backfill_phone_number_indexes, \
+    backfill_user_directory, \
+    create_push_broadcast, get_push_broadcast, resume_push_broadcast, cancel_push_broadcast
 from tippicserver.utils import InvalidUsage, InternalError, increment_metric, gauge_metric, sqlalchemy_pool_status
 from tippicserver.views_common import limit_to_acl, limit_to_localhost, limit_to_password
 from tippicserver.stellar import get_kin_balance
 
+DB_MIGRATIONS_TIMEOUT_SECS = 60 * 60
+
 
 @app.route('/health', methods=['GET'])
 def get_health():
@@ -214,6 +219,15 @@ def user_phone_number_blacklist_endpoint():
     return jsonify(status='ok')
 
 
+@app.route('/blacklist/rebuild', methods=['POST'])
+def rebuild_blacklist_endpoint():
+    """rebuilds the cached phone numbers blacklist from the table"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    return jsonify(status='ok', count=rebuild_blacklist())
+
+
 @app.route('/user/blacklist', methods=['POST'])
 def blacklist_user_endpoint():
     """"""
@@ -267,6 +281,138 @@ def total_kins_endpoint():
     return jsonify(status='ok', total=get_tx_totals())
 
 
+@app.route('/tx/totals/reconcile', methods=['POST'])
+def reconcile_tip_totals_endpoint():
+    """recomputes the running kin totals from the tx tables and reports drift. also used to backfill them"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    app.rq_slow.enqueue(reconcile_tip_totals)
+    return jsonify(status='ok')
+
+
+@app.route('/tx/verify', methods=['POST'])
+def verify_transaction_reports_endpoint():
+    """makes sure the reported txs verification job is queued. the job normally schedules itself"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    schedule_transaction_verification()
+    return jsonify(status='ok')
+
+
+@app.route('/acl/invalidate', methods=['POST'])
+def invalidate_acl_endpoint():
+    """makes all the server processes reload the acl. call after editing the acl table"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    invalidate_acl()
+    return jsonify(status='ok')
+
+
+@app.route('/users/country-codes/backfill', methods=['POST'])
+def backfill_country_codes_endpoint():
+    """sets the missing country codes of the users' app data from their ips, on the slow queue"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    app.rq_slow.enqueue_call(func=backfill_country_iso_codes, timeout=DB_MIGRATIONS_TIMEOUT_SECS)
+    return jsonify(status='ok')
+
+
+@app.route('/users/phone-number-index/backfill', methods=['POST'])
+def backfill_phone_number_indexes_endpoint():
+    """sets the missing blind indexes of the users' phone numbers, on the slow queue"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    app.rq_slow.enqueue_call(func=backfill_phone_number_indexes, timeout=DB_MIGRATIONS_TIMEOUT_SECS)
+    return jsonify(status='ok')
+
+
+@app.route('/users/directory/backfill', methods=['POST'])
+def backfill_user_directory_endpoint():
+    """writes the directory entries of the users on all the shards, on the slow queue"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    app.rq_slow.enqueue_call(func=backfill_user_directory, timeout=DB_MIGRATIONS_TIMEOUT_SECS)
+    return jsonify(status='ok')
+
+
+@app.route('/push/broadcast', methods=['POST'])
+def push_broadcast_endpoint():
+    """queues a push message to all the active users, or to the users of the given os types"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    try:
+        payload = request.get_json(silent=True)
+        push_payload = payload['payload']
+        os_types = payload.get('os_types', None)
+        dry_run = payload.get('dry_run', False) == True
+    except Exception as e:
+        print(e)
+        raise InvalidUsage('bad-request')
+
+    broadcast_id = create_push_broadcast(push_payload, os_types, dry_run)
+    return jsonify(status='ok', broadcast_id=broadcast_id)
+
+
+@app.route('/push/broadcast/<broadcast_id>', methods=['GET'])
+def get_push_broadcast_endpoint(broadcast_id):
+    """returns the progress of the given push broadcast"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    broadcast = get_push_broadcast(broadcast_id)
+    if not broadcast:
+        raise InvalidUsage('no such broadcast')
+    return jsonify(status='ok', broadcast=broadcast)
+
+
+@app.route('/push/broadcast/<broadcast_id>/resume', methods=['POST'])
+def resume_push_broadcast_endpoint(broadcast_id):
+    """requeues a failed or cancelled push broadcast from its last checkpoint"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    return jsonify(status='ok', resumed=resume_push_broadcast(broadcast_id))
+
+
+@app.route('/push/broadcast/<broadcast_id>/cancel', methods=['POST'])
+def cancel_push_broadcast_endpoint(broadcast_id):
+    """stops the given push broadcast. it can be resumed later"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    cancel_push_broadcast(broadcast_id)
+    return jsonify(status='ok')
+
+
+@app.route('/db/migrations', methods=['GET'])
+def get_db_migrations_endpoint():
+    """returns the schema migrations and whether each was applied"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    from tippicserver.migrations import get_migrations_status
+    return jsonify(status='ok', migrations=[{'version': version, 'description': description, 'applied': applied}
+                                            for version, description, applied in get_migrations_status()])
+
+
+@app.route('/db/migrate', methods=['POST'])
+def db_migrate_endpoint():
+    """applies the pending schema migrations on the slow queue. concurrent index builds may take a while"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    from tippicserver.migrations import run_migrations
+    app.rq_slow.enqueue_call(func=run_migrations, timeout=DB_MIGRATIONS_TIMEOUT_SECS)
+    return jsonify(status='ok')
+
+
 @app.route('/users/captcha/set', methods=['POST'])
 def user_set_captcha_endpoint():
     if not config.DEBUG:
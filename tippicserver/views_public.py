@@ -2,7 +2,6 @@
 The Kin App Server public API is defined here.
 """
 import logging as log
-from distutils.version import LooseVersion
 from uuid import UUID
 
 import arrow
@@ -11,25 +10,30 @@ from flask import request, jsonify, abort
 from flask_api import status
 
 from tippicserver import app, config, utils
-from tippicserver.models import create_user, update_user_token, update_user_app_version, is_onboarded, set_onboarded, \
+from tippicserver.models import create_user, update_user_token, is_onboarded, set_onboarded, \
     create_tx, list_user_transactions, list_user_incoming_tips, \
-    add_p2p_tx, set_user_phone_number, match_phone_number_to_address, \
+    add_p2p_tx, set_user_phone_number, match_phone_number_to_address, match_phone_numbers_to_addresses, \
     list_p2p_transactions_for_user_id, ack_auth_token, \
-    is_user_authenticated, is_user_phone_verified, get_user_config, get_email_template_by_type, get_backup_hints, \
+    is_user_authenticated, is_user_phone_verified, get_user_config_payload, get_email_template_by_type, get_backup_hints, \
     generate_backup_questions_list, store_backup_hints, \
     validate_auth_token, restore_user_by_address, should_block_user_by_client_version, deactivate_user, \
     get_user_os_type, count_registrations_for_phone_number, \
-    update_ip_address, is_userid_blacklisted, get_picture_for_user, get_associated_user_ids, report_transaction, \
-    user_exists, set_username, block_user, unblock_user, get_pictures_summery, get_user_blocked_users, report_picture
-from tippicserver.stellar import create_account, send_kin, active_account_exists, get_initial_reward, add_signature
+    record_app_launch, is_userid_blacklisted, get_picture_for_user, get_associated_user_ids, report_transaction, \
+    wait_for_transaction_report, get_transaction_report_status, TX_REPORT_REJECTED, get_ledger_payment, \
+    user_exists, set_username, block_user, unblock_user, get_pictures_summery, get_user_blocked_users, report_picture, \
+    start_onboarding, get_onboarding_status, get_client_config_payload
+from tippicserver.stellar import send_kin, add_signature
 from tippicserver.utils import InvalidUsage, InternalError, increment_metric, gauge_metric, MAX_TXS_PER_USER, \
     extract_phone_number_from_firebase_id_token, \
-    get_global_config, read_payment_data_from_cache
+    read_payment_data_from_cache
 from tippicserver.views_common import get_source_ip, extract_headers, limit_to_acl
 from .utils import OS_ANDROID, OS_IOS
 from .config import DISCOVERY_APPS_ANDROID_URL, DISCOVERY_APPS_OSX_URL
 
 
+MAX_CONTACTS_PER_MATCH = 1000
+
+
 def get_payment_lock_name(user_id, task_id):
     """generate a user and task specific lock for payments."""
     return "pay:%s-%s" % (user_id, task_id)
@@ -47,14 +51,18 @@ def app_launch():
     try:
         user_id, auth_token = extract_headers(request)
         app_ver = payload.get('app_ver', None)
+        if None in (user_id, app_ver):
+            raise InvalidUsage('bad-request')
     except Exception as e:
         raise InvalidUsage('bad-request')
 
-    update_ip_address(user_id, get_source_ip(request))
+    # the config is the same for all the users with this os and app version - serialized once
+    config_payload = get_user_config_payload(user_id, app_ver)
 
-    update_user_app_version(user_id, app_ver)
+    # written to user_app_data in batches, by the app launch writer
+    record_app_launch(user_id, get_source_ip(request), app_ver)
 
-    return jsonify(status='ok', config=get_user_config(user_id))
+    return app.response_class(config_payload, mimetype='application/json')
 
 
 @app.route('/user/contact', methods=['POST'])
@@ -86,6 +94,36 @@ def get_address_by_phone_api():
     return jsonify(status='ok', address=address)
 
 
+@app.route('/user/contacts/match', methods=['POST'])
+def match_contacts_api():
+    """tries to match the given list of contacts' phone numbers against users, in one go"""
+    if not config.P2P_TRANSFERS_ENABLED:
+        # this api is disabled, clients should not have asked for it
+        print('/user/contacts/match api is disabled by server config')
+        raise InvalidUsage('api-disabled')
+
+    payload = request.get_json(silent=True)
+    try:
+        user_id, auth_token = extract_headers(request)
+        phone_numbers = payload.get('phone_numbers', None)
+        if user_id is None or not isinstance(phone_numbers, list) or not all(isinstance(number, str) for number in phone_numbers):
+            raise InvalidUsage('bad-request')
+    except Exception as e:
+        print(e)
+        raise InvalidUsage('bad-request')
+
+    if len(phone_numbers) > MAX_CONTACTS_PER_MATCH:
+        raise InvalidUsage('too-many-contacts')
+
+    if is_userid_blacklisted(user_id):
+        print('blocked user_id %s from matching p2p - user_id blacklisted' % user_id)
+        return jsonify(status='error', reason='no_match'), status.HTTP_404_NOT_FOUND
+
+    matches = match_phone_numbers_to_addresses(phone_numbers, user_id)
+    increment_metric('contacts-matched', len(matches))
+    return jsonify(status='ok', matches=matches)
+
+
 @app.route('/user/auth/ack', methods=['POST'])
 def ack_auth_token_api():
     """endpoint used by clients to ack the auth-token they received"""
@@ -267,6 +305,7 @@ def add_signature_api():
 def get_transactions_api():
     """return a list of the last X txs for this user
 
+    pass the returned 'next' cursor as ?before= to get the following page.
     each item in the list contains:
         - the tx_hash
         - amount of kins transferred
@@ -275,28 +314,27 @@ def get_transactions_api():
     """
     from tippicserver.models.user import get_address_by_userid
     from tippicserver.models.transaction import get_transactions_json
-    from tippicserver.utils import get_discovery_apps
+    from tippicserver.discovery_apps import get_discovery_apps
     try:
         user_id, auth_token = extract_headers(request)
+        before = request.args.get('before', None)  # optional cursor, returned as 'next' by the previous page
         public_address = get_address_by_userid(user_id)
         platform = get_user_os_type(user_id)
         link = DISCOVERY_APPS_ANDROID_URL if platform == OS_ANDROID else DISCOVERY_APPS_OSX_URL
         
-        discovery_apps = get_discovery_apps(link)
-        detailed_txs = get_transactions_json(user_id, public_address, discovery_apps)
-
-        # sort by date
-        detailed_txs = sorted(detailed_txs, key=lambda k: k['date'], reverse=True)
-        if len(detailed_txs) > MAX_TXS_PER_USER:
-            detailed_txs = detailed_txs[:MAX_TXS_PER_USER]
+        discovery_apps = get_discovery_apps(link)  # cached, may be None if the CDN was never reachable
+        # already merged, sorted by date and limited to MAX_TXS_PER_USER
+        detailed_txs, next_cursor = get_transactions_json(user_id, public_address, discovery_apps, before)
 
+    except InvalidUsage:
+        raise
     except Exception as e:
         import traceback
         log.error('cant get txs for user')
         traceback.print_exc()
         return jsonify(status='error', txs=[])
 
-    return jsonify(status='ok', txs=detailed_txs)
+    return jsonify(status='ok', txs=detailed_txs, next=next_cursor)
 
 
 def authorize(user_id):
@@ -344,61 +382,27 @@ def onboard_user():
         raise InvalidUsage('user already has an account and has been awarded')
     elif onboarded is None:
         raise InvalidUsage('no such user exists')
-    else:
-        # create an account, provided none is already being created
-        lock = redis_lock.Lock(app.redis, 'address:%s' % public_address)
-        if lock.acquire(blocking=False):
-            try:
-                if not active_account_exists(public_address):
-                    print('creating account with address %s and amount %s' % (public_address, config.STELLAR_INITIAL_ACCOUNT_BALANCE))
-                    tx_id = create_account(public_address, config.STELLAR_INITIAL_ACCOUNT_BALANCE)
-                    if not tx_id:
-                        raise InternalError('failed to create account at %s' % public_address)
-                    elif not award_user(user_id, public_address):
-                        raise InternalError('unable to award user with %d Kin' % get_initial_reward())
-                elif not award_user(user_id, public_address):
-                    raise InternalError('unable to award user with %d Kin' % get_initial_reward())
-            except Exception as e:
-                print('exception trying to create account:%s' % e)
-                raise InternalError('unable to create account')
-            finally:
-                lock.release()
-        else:
-            raise InvalidUsage('already creating account for user_id: %s and address: %s' % (user_id, public_address))
-
-        increment_metric('user_onboarded')
-        return jsonify(status='ok')
 
+    # the account is created and the user awarded by a job. calling this again returns the same job
+    token, onboarding_status = start_onboarding(user_id, public_address)
+    return jsonify(status='ok', onboarding_status=onboarding_status, token=token), status.HTTP_202_ACCEPTED
 
-def award_user(user_id, public_address):
-    from tippicserver.models.transaction import create_tx
-    from tippicserver.utils import GIFT
 
-    onboarded = False
-    reward = get_initial_reward()
-
-    
-    for other_id in get_associated_user_ids(user_id):
-        if is_onboarded(other_id):
-            set_onboarded(user_id, True, public_address)
-            onboarded = True
-            print('user %s with same phone number has been previously awarded %d Kin. Will not award again' % (other_id, reward))
-            break
-
-    if not onboarded:
-        try:
-            send_tx = send_kin(public_address, reward)
-            if send_tx:
-                onboarded = True
-                create_tx(send_tx, user_id, public_address, reward, GIFT, "onboarding-gift")
-                set_onboarded(user_id, True, public_address)
-                print('sent %d KIN to user %s ' % (reward, user_id))
-            else:
-                print('unable to send %d KIN to user %s ' % (reward, user_id))
-        except Exception as e2:
-            print('exception %s trying to send kin to user ' % e2)
+@app.route('/user/onboard/status', methods=['GET'])
+def onboard_status_api():
+    """returns the status of the user's onboarding job: queued, running, done or failed"""
+    try:
+        user_id, auth_token = extract_headers(request)
+        token = request.args.get('token', None)
+        if user_id is None:
+            raise InvalidUsage('bad-request')
+    except Exception as e:
+        raise InvalidUsage('bad-request')
 
-    return onboarded
+    onboarding_status = get_onboarding_status(user_id, token)
+    if onboarding_status is None:
+        raise InvalidUsage('no such onboarding')
+    return jsonify(status='ok', onboarding_status=onboarding_status)
 
 
 @app.route('/user/register', methods=['POST'])
@@ -448,35 +452,8 @@ def register_api():
             else:
                 print('updated userid %s data' % user_id)
 
-            #TODO find a way to dry up this code which is redundant with get_user_config()
-
-            # turn off phone verfication for older clients:
-            disable_phone_verification = False
-            disable_backup_nag = False
-            if os == OS_ANDROID and LooseVersion(app_ver) <= LooseVersion(config.BLOCK_ONBOARDING_ANDROID_VERSION):
-                    disable_phone_verification = True
-                    disable_backup_nag = True
-            elif os == OS_IOS and LooseVersion(app_ver) <= LooseVersion(config.BLOCK_ONBOARDING_IOS_VERSION):
-                    disable_phone_verification = True
-                    disable_backup_nag = True
-
-            global_config = get_global_config()
-            if disable_phone_verification:
-                print('disabling phone verification for registering userid %s' % user_id)
-                global_config['phone_verification_enabled'] = False
-            if disable_backup_nag:
-                print('disabling backup nag for registering userid %s' % user_id)
-                global_config['backup_nag'] = False
-
-            # if should_force_update(os, app_ver):
-            #     global_config['force_update'] = True
-
-            # if is_update_available(os, app_ver):
-            #     global_config['is_update_available'] = True
-
-
             # return global config - the user doesn't have user-specific config (yet)
-            return jsonify(status='ok', config=global_config)
+            return app.response_class(get_client_config_payload(os, app_ver, on_register=True), mimetype='application/json')
 
 
 @app.route('/user/transaction/p2p', methods=['POST'])
@@ -671,6 +648,10 @@ def payment_service_callback_endpoint():
                 except Exception as e:
                     log.error('failed to calculate payment request duration. e=%s' % e)
 
+                # the ledger ingester normally stored the payment before the callback arrived
+                if get_ledger_payment(tx_hash) is None:
+                    log.warning('payment callback for tx_hash %s: payment not ingested yet' % tx_hash)
+                    increment_metric('payment-callback-not-ingested')
                 create_tx(tx_hash, user_id, public_address, False, amount, {'task_id': task_id, 'memo': memo})
                 increment_metric('payment-callback-success')
                 #
@@ -891,12 +872,39 @@ def report_transaction_api():
         return jsonify(status='denied'), status.HTTP_403_FORBIDDEN
 
     transaction = request.get_json(silent=True)
+    if not transaction:
+        raise InvalidUsage('invalid payload')
     transaction['user_id'] = user_id
-    if report_transaction(transaction):
-        return jsonify(status='ok')
-    else:
+    # the tx is verified against horizon in the background. clients that need the outcome
+    # can pass ?wait=<secs> (up to STELLAR_TIMEOUT_SEC) or poll /user/transaction/status
+    tx_status = report_transaction(transaction)
+    if tx_status is None:
         raise InvalidUsage('failed to add picture')
 
+    try:
+        wait_secs = min(float(request.args.get('wait', 0)), config.STELLAR_TIMEOUT_SEC)
+    except ValueError:
+        raise InvalidUsage('bad-request')
+    if wait_secs > 0:
+        tx_status = wait_for_transaction_report(transaction['tx_hash'], wait_secs)
+    if tx_status == TX_REPORT_REJECTED:
+        raise InvalidUsage('transaction rejected')
+    return jsonify(status='ok', tx_status=tx_status)
+
+
+@app.route('/user/transaction/status', methods=['GET'])
+def get_transaction_status_api():
+    """returns the verification status of a reported tx: pending, verified or rejected"""
+    user_id, auth_token = extract_headers(request)
+    tx_hash = request.args.get('tx_hash')
+    if user_id is None or tx_hash is None:
+        raise InvalidUsage('bad-request')
+
+    tx_status = get_transaction_report_status(tx_hash, user_id)
+    if tx_status is None:
+        raise InvalidUsage('no such tx_hash')
+    return jsonify(status='ok', tx_status=tx_status)
+
 
 @app.route('/validation/get-nonce', methods=['GET'])
 def get_validation_nonce():